@@ -4,9 +4,47 @@ webserver or transit format. Main endpoint is `query`, which takes a
 dictionary request and returns a dictionary response.
 """
 
+import collections
+import os
+import sys
+import time
+import traceback
+
+import whales.cancellation
+import whales.compute
+import whales.metrics
 import whales.models
+import whales.pondering
+import whales.sessions
 import whales.util.chess
 
+# Commands of the API. Metrics are labeled with these, and any other
+# command is labeled "unknown", so that clients can't create any number
+# of metrics.
+COMMANDS = [
+    "list_models",
+    "get_move",
+    "get_moves",
+    "new_session",
+    "session_move",
+    "end_session",
+]
+
+# Stats of model searches that are added up in the metrics, and
+# returned to clients that ask for them, mapping from their key in the
+# search's stats to their key in the response.
+SEARCH_STATS = {
+    "nodes": "nodes",
+    "evals": "evals",
+    "lazy_evals": "lazyEvals",
+    "cutoffs": "cutoffs",
+    "terminals": "terminals",
+}
+
+# Largest number of items a get_moves request may have. Can be
+# overridden with the WHALES_MAX_BATCH_ITEMS environment variable.
+MAX_BATCH_ITEMS = int(os.environ.get("WHALES_MAX_BATCH_ITEMS") or 64)
+
 
 class APIError(Exception):
     """
@@ -34,32 +72,304 @@ def error_response(message):
     return {"error": message}
 
 
-def query(request):
+def check_required_params(request, params):
+    """
+    Raise APIError if the given dictionary API request is missing any of
+    the given parameters.
+    """
+    for param in params:
+        if param not in request:
+            raise APIError("missing required parameter {}".format(repr(param)))
+
+
+def get_time_limit(request):
+    """
+    Return the optional time limit of the given dictionary API request,
+    in seconds, or None if it has none. Raise APIError if it is not a
+    positive number.
+    """
+    time_limit = request.get("timeLimit")
+    if time_limit is not None and (
+        isinstance(time_limit, bool)
+        or not isinstance(time_limit, (int, float))
+        or time_limit <= 0
+    ):
+        raise APIError("invalid timeLimit {}".format(repr(time_limit)))
+    return time_limit
+
+
+def get_session(request):
+    """
+    Return the session named by the sessionId of the given dictionary
+    API request. Raise APIError if there is no such session.
+    """
+    check_required_params(request, ["sessionId"])
+    session_id = request["sessionId"]
+    try:
+        return whales.sessions.SESSIONS.get(session_id)
+    except (whales.sessions.NoSuchSessionError, TypeError):
+        raise APIError("unknown session {}".format(repr(session_id)))
+
+
+def get_stats_flag(request):
+    """
+    Return whether the given dictionary API request asks for the stats
+    of the model's search. Raise APIError if its stats parameter is not
+    a boolean.
+    """
+    stats = request.get("stats", False)
+    if not isinstance(stats, bool):
+        raise APIError("invalid stats {}".format(repr(stats)))
+    return stats
+
+
+def run_with_stats(model_name, fn):
+    """
+    Call fn with a new Counter for the stats of a model search, and
+    return a tuple of its result and a dictionary of the stats to
+    report to the client. The stats are also added to the metrics of
+    the model by the given name, even if fn raises.
+    """
+    stats = collections.Counter()
+    start = time.perf_counter()
+    try:
+        result = fn(stats)
+    finally:
+        seconds = time.perf_counter() - start
+        metrics = whales.metrics.METRICS
+        for key in SEARCH_STATS:
+            metrics.increment("search_" + key, stats[key], model=model_name)
+        if "depth" in stats:
+            metrics.observe(
+                "search_depth",
+                stats["depth"],
+                buckets=whales.metrics.DEPTH_BUCKETS,
+                model=model_name,
+            )
+        metrics.observe("model_seconds", seconds, model=model_name)
+    response_stats = {
+        response_key: stats[key] for key, response_key in SEARCH_STATS.items()
+    }
+    response_stats["depth"] = stats.get("depth")
+    response_stats["seconds"] = seconds
+    return result, response_stats
+
+
+def status():
+    """
+    Return a dictionary reporting the load on the server: the state of
+    the compute pool that API requests run on and of the pool that the
+    items of get_moves requests run on, including how many are waiting,
+    how many requests have been cancelled for each reason, and
+    if pondering is on, the stats of the Ponderer.
+    """
+    cancelled = whales.metrics.METRICS.get_counts("cancelled_requests")
+    response = {
+        "computePool": whales.compute.COMPUTE_POOL.get_stats(),
+        "batchPool": whales.compute.BATCH_POOL.get_stats(),
+        "cancelledRequests": {labels["reason"]: count for labels, count in cancelled},
+    }
+    if whales.pondering.PONDERER is not None:
+        stats = whales.pondering.PONDERER.get_stats()
+        stats["hitRate"] = stats.pop("hit_rate")
+        response["pondering"] = stats
+    return response
+
+
+def query(request, cancel_token=None):
     """
     Given a dictionary with an API request, return a dictionary with the
     response.
+
+    If cancel_token is given, a `whales.cancellation.CancelToken`, the
+    request is abandoned soon after the token is cancelled, and the
+    response is an error.
+
+    The time taken by each command, errors by type, and cancelled
+    requests by the reason they were cancelled are recorded in
+    `whales.metrics.METRICS`.
+    """
+    start = time.perf_counter()
+    command = "unknown"
+    if isinstance(request, dict) and request.get("command") in COMMANDS:
+        command = request["command"]
+    error_type = None
+    try:
+        return handle_query(request, cancel_token=cancel_token)
+    except APIError as e:
+        error_type = type(e).__name__
+        return error_response(str(e))
+    except whales.cancellation.Cancelled as e:
+        error_type = type(e).__name__
+        reason = str(e)
+        whales.metrics.METRICS.increment("cancelled_requests", reason=reason)
+        if reason == whales.cancellation.DEADLINE:
+            return error_response("request timed out")
+        return error_response("request cancelled")
+    except Exception as e:
+        error_type = type(e).__name__
+        raise
+    finally:
+        whales.metrics.METRICS.observe(
+            "api_request_seconds", time.perf_counter() - start, command=command
+        )
+        if error_type is not None:
+            whales.metrics.METRICS.increment(
+                "api_errors", command=command, type=error_type
+            )
+
+
+def get_move(request, cancel_token=None):
+    """
+    Given a dictionary with a get_move API request (or an item of a
+    get_moves request), return a dictionary with the response, or raise
+    APIError if the request is not valid. Raise
+    `whales.cancellation.Cancelled` if the given CancelToken is
+    cancelled while the model is running.
+    """
+    if not isinstance(request, dict):
+        raise APIError("invalid item")
+    # Items of get_moves may wait for a thread for a while, so don't
+    # start them if the request has been given up on in the meantime.
+    if cancel_token is not None:
+        cancel_token.check()
+    check_required_params(request, ["model", "pgn"])
+    model_name = request["model"]
+    old_pgn = request["pgn"]
+    time_limit = get_time_limit(request)
+    want_stats = get_stats_flag(request)
+    if model_name not in whales.models.MODELS:
+        raise APIError("unknown model {}".format(repr(model_name)))
+    try:
+        new_pgn, stats = run_with_stats(
+            model_name,
+            lambda stats: whales.models.run_model(
+                model_name,
+                old_pgn,
+                time_limit,
+                cancel_token=cancel_token,
+                stats=stats,
+            ),
+        )
+    except whales.util.chess.InvalidPGNError:
+        raise APIError("invalid PGN")
+    response = {"pgn": new_pgn}
+    if want_stats:
+        response["stats"] = stats
+    return normal_response(response)
+
+
+def handle_query(request, cancel_token=None):
+    """
+    Given a dictionary with an API request, return a dictionary with the
+    response, or raise APIError if the request is not valid. Raise
+    `whales.cancellation.Cancelled` if the given CancelToken is
+    cancelled while a model is running.
     """
     if not isinstance(request, dict):
-        return error_response("invalid JSON")
+        raise APIError("invalid JSON")
     if "command" not in request:
-        return error_response("no command specified")
+        raise APIError("no command specified")
     command = request["command"]
     if command == "list_models":
         info = whales.models.get_model_info()
         return normal_response({"models": info})
     if command == "get_move":
-        for param in ["model", "pgn"]:
-            if param not in request:
-                return error_response(
-                    "missing required parameter {}".format(repr(param))
+        return get_move(request, cancel_token=cancel_token)
+    if command == "get_moves":
+        check_required_params(request, ["items"])
+        items = request["items"]
+        if not isinstance(items, list):
+            raise APIError("invalid items")
+        if len(items) > MAX_BATCH_ITEMS:
+            raise APIError("too many items (at most {})".format(MAX_BATCH_ITEMS))
+        futures = []
+        for item in items:
+            try:
+                futures.append(
+                    whales.compute.BATCH_POOL.submit(
+                        get_move, item, cancel_token=cancel_token
+                    )
                 )
+            except whales.compute.PoolFullError:
+                futures.append(None)
+        results = []
+        for future in futures:
+            if future is None:
+                results.append(error_response("server busy"))
+                continue
+            try:
+                results.append(future.result())
+            except APIError as e:
+                results.append(error_response(str(e)))
+            except whales.cancellation.Cancelled:
+                raise
+            except Exception as e:
+                # One item going wrong shouldn't lose the moves of the
+                # others, so report it in its place.
+                traceback.print_exc(file=sys.stderr)
+                whales.metrics.METRICS.increment(
+                    "api_errors", command=command, type=type(e).__name__
+                )
+                results.append(error_response("internal error"))
+        return normal_response({"results": results})
+    if command == "new_session":
+        check_required_params(request, ["model"])
         model_name = request["model"]
-        old_pgn = request["pgn"]
+        if model_name not in whales.models.MODELS:
+            raise APIError("unknown model {}".format(repr(model_name)))
         try:
-            new_pgn = whales.models.run_model(model_name, old_pgn)
-        except whales.models.NoSuchModelError:
-            return error_response("unknown model {}".format(repr(model_name)))
+            board = whales.util.chess.pgn_to_board(request.get("pgn", ""))
         except whales.util.chess.InvalidPGNError:
-            return error_response("invalid PGN")
-        return normal_response({"pgn": new_pgn})
-    return error_response("unknown command {}".format(repr(command)))
+            raise APIError("invalid PGN")
+        session = whales.sessions.SESSIONS.create(model_name, board)
+        return normal_response({"sessionId": session.session_id})
+    if command == "session_move":
+        session = get_session(request)
+        time_limit = get_time_limit(request)
+        want_stats = get_stats_flag(request)
+        model = whales.models.get_model(session.model_name)
+        stats = None
+        # Only one request at a time may use the board of a session.
+        with session.lock:
+            board = session.board
+            if "move" in request:
+                try:
+                    move = whales.util.chess.uci_to_move(board, request["move"])
+                except (whales.util.chess.InvalidMoveError, TypeError):
+                    raise APIError("invalid move {}".format(repr(request["move"])))
+                board.push(move)
+            reply = None
+            if not board.is_game_over():
+                try:
+                    reply, stats = run_with_stats(
+                        session.model_name,
+                        lambda stats: model(
+                            board,
+                            time_limit=time_limit,
+                            cancel_token=cancel_token,
+                            stats=stats,
+                        ),
+                    )
+                except BaseException:
+                    # Leave the session as it was before the request, so
+                    # that the client can try the move again.
+                    if "move" in request:
+                        board.pop()
+                    raise
+                board.push(reply)
+        whales.sessions.SESSIONS.touch(session)
+        response = {"move": reply.uci() if reply is not None else None}
+        if want_stats:
+            response["stats"] = stats
+        return normal_response(response)
+    if command == "end_session":
+        session = get_session(request)
+        try:
+            whales.sessions.SESSIONS.delete(session.session_id)
+        except whales.sessions.NoSuchSessionError:
+            # The session expired or was ended by another request in the
+            # meantime, which is just as good.
+            pass
+        return normal_response({})
+    raise APIError("unknown command {}".format(repr(command)))
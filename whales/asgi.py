@@ -0,0 +1,209 @@
+"""
+Module that contains an ASGI app serving the API, as an alternative to
+the Flask app in `whales.server` for running under an async server such
+as uvicorn:
+
+    $ uvicorn whales.asgi:app
+
+The app serves the same JSON API at `/api/v1/http`, the same status
+report at `/api/v1/status` and the same metrics at `/metrics`, but not
+the HTML pages or static files.
+Requests are run on `whales.compute.COMPUTE_POOL`, while the event loop
+sends keep-alive whitespace to clients whose requests are still
+running, so that no thread is tied up per waiting connection. When the
+client disconnects, the request's `whales.cancellation.CancelToken` is
+cancelled straight away, so the work stops too. The app only uses the
+standard library.
+"""
+
+import asyncio
+import json
+
+import whales.api
+import whales.cancellation
+import whales.compute
+import whales.metrics
+
+# Number of seconds between bytes of whitespace sent to keep the
+# connection of a long request alive, as for the Flask app.
+PING_SECONDS = 20
+
+# Content types accepted as JSON, apart from those ending in "+json",
+# as for Flask's `Request.get_json`.
+JSON_CONTENT_TYPES = {"application/json"}
+
+
+def dumps(obj):
+    """
+    Return the JSON string for the given object, formatted the same way
+    as by the Flask app.
+    """
+    return json.dumps(obj, sort_keys=True)
+
+
+def get_header(scope, name):
+    """
+    Return the value of the header with the given lowercase name in the
+    ASGI scope of a request, as a string, or None if it has none.
+    """
+    for key, value in scope["headers"]:
+        if key.decode("latin-1").lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+def parse_json_request(scope, body):
+    """
+    Return the JSON body of a request with the given ASGI scope and body
+    bytes, or None if it is missing or invalid or its content type is
+    not JSON.
+    """
+    content_type = get_header(scope, "content-type") or ""
+    mimetype = content_type.split(";")[0].strip().lower()
+    if mimetype not in JSON_CONTENT_TYPES and not mimetype.endswith("+json"):
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def run_query(request, cancel_token):
+    """
+    Return the JSON string of the API response to the given request,
+    which is None if the request had no valid JSON, abandoning it if the
+    given CancelToken is cancelled.
+    """
+    if request is None:
+        return dumps(whales.api.error_response("invalid or missing JSON"))
+    return dumps(whales.api.query(request, cancel_token=cancel_token))
+
+
+async def read_body(receive):
+    """
+    Read and return the whole body of a request from the given ASGI
+    receive function.
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def wait_for_disconnect(receive):
+    """
+    Wait until the client disconnects, once the whole request body has
+    been read from the given ASGI receive function.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def send_response(send, status, body, content_type="application/json"):
+    """
+    Send a complete response with the given status and body string
+    through the given ASGI send function.
+    """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type.encode("latin-1"))],
+        }
+    )
+    await send({"type": "http.response.body", "body": body.encode("utf-8")})
+
+
+async def handle_api(scope, receive, send):
+    """
+    Handle a request to the API endpoint.
+    """
+    if scope["method"] != "POST":
+        await send_response(send, 405, "Method Not Allowed", "text/plain")
+        return
+    request = parse_json_request(scope, await read_body(receive))
+    token = whales.cancellation.request_token()
+    try:
+        future = whales.compute.COMPUTE_POOL.submit(run_query, request, token)
+    except whales.compute.PoolFullError:
+        await send_response(send, 503, dumps(whales.api.error_response("server busy")))
+        return
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    result = asyncio.wrap_future(future)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while True:
+            # Waiting for the result times out without cancelling it.
+            await asyncio.wait(
+                [result, disconnect],
+                timeout=PING_SECONDS,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if result.done():
+                body = result.result()
+                await send({"type": "http.response.body", "body": body.encode("utf-8")})
+                return
+            if disconnect.done():
+                token.cancel(whales.cancellation.DISCONNECT)
+                # Requests that never started are counted here, and the
+                # rest by `whales.api.query`.
+                if future.cancel():
+                    whales.metrics.METRICS.increment(
+                        "cancelled_requests", reason=token.reason
+                    )
+                return
+            await send({"type": "http.response.body", "body": b" ", "more_body": True})
+    finally:
+        disconnect.cancel()
+
+
+async def handle_lifespan(receive, send):
+    """
+    Handle the ASGI lifespan protocol, for servers that use it. There is
+    nothing to set up or tear down.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI app serving the API.
+    """
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if scope["path"] == "/api/v1/http":
+        await handle_api(scope, receive, send)
+    elif scope["path"] == "/api/v1/status" and scope["method"] == "GET":
+        await send_response(send, 200, dumps(whales.api.status()))
+    elif scope["path"] == "/metrics" and scope["method"] == "GET":
+        await send_response(
+            send,
+            200,
+            whales.metrics.METRICS.render_prometheus(),
+            whales.metrics.PROMETHEUS_CONTENT_TYPE,
+        )
+    else:
+        await send_response(send, 404, "Not Found", "text/plain")
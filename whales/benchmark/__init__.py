@@ -0,0 +1,103 @@
+"""
+Package containing benchmarks for the search and neural net code, so
+that changes to them can be measured rather than guessed at. Each
+module in the package is a benchmark that can be run with `python -m`.
+This module contains what they share: the fixed suite of test positions
+and the evaluation functions to search with.
+"""
+
+import os
+
+import chess
+
+# EPD file with the standard suite of test positions. Each line has an
+# "id" operation naming the position.
+POSITIONS_FILE = os.path.join(os.path.dirname(__file__), "positions.epd")
+
+# Names of the evaluators that can be passed to `get_evaluator`.
+EVALUATOR_NAMES = ["chess_alpha_zero", "chess_alpha_zero_int8", "material"]
+
+# Value of each kind of piece for the material evaluator.
+MATERIAL_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 0,
+}
+
+
+def load_positions(path=POSITIONS_FILE):
+    """
+    Read the EPD file at the given path and return a list of (name,
+    board) tuples, one for each line, where name is the "id" of the
+    position and board is a python-chess Board.
+    """
+    positions = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            board, operations = chess.Board.from_epd(line)
+            positions.append((operations.get("id", board.fen()), board))
+    return positions
+
+
+def material_eval(board):
+    """
+    Evaluate the board by counting material, scaled so that a queen is
+    worth 0.1. This is a stand-in for the neural net when benchmarking
+    the search itself, since it is fast and needs no model file.
+    """
+    # Count pieces straight from the bitboards, so that the evaluator
+    # takes as little as possible of the time being measured.
+    score = 0
+    for piece_type, value in MATERIAL_VALUES.items():
+        score += value * (
+            chess.popcount(board.pieces_mask(piece_type, chess.WHITE))
+            - chess.popcount(board.pieces_mask(piece_type, chess.BLACK))
+        )
+    return score / 90
+
+
+def get_evaluator(name):
+    """
+    Return a dictionary with the functions to search with for the
+    evaluator by the given name, one of EVALUATOR_NAMES. The keys are
+    "eval_fn", "batch_eval_fn" and "policy_fn", as accepted by
+    `whales.minimax_ab.minimax.minimax` and
+    `whales.minimax_ab.ordering.MoveOrdering`. Functions the evaluator
+    doesn't have are None.
+    """
+    if name == "material":
+        return {"eval_fn": material_eval, "batch_eval_fn": None, "policy_fn": None}
+    if name in ("chess_alpha_zero", "chess_alpha_zero_int8"):
+        # Imported here so that benchmarks with the material evaluator
+        # don't need the neural net to be loaded.
+        import whales.models as models
+        import whales.neural_net.interface as neural_net
+
+        predict = neural_net.NEURAL_NET_PREDICT[name]
+
+        def eval_fn(board):
+            return models.minimax_chess_alpha_transform(predict(board), board)
+
+        def batch_eval_fn(boards):
+            policies, values = predict(boards)
+            return [
+                models.minimax_chess_alpha_transform(
+                    [policies[i : i + 1], values[i : i + 1]], board
+                )
+                for i, board in enumerate(boards)
+            ]
+
+        def policy_fn(board):
+            return models.minimax_chess_alpha_policy_transform(predict(board), board)
+
+        return {
+            "eval_fn": eval_fn,
+            "batch_eval_fn": batch_eval_fn,
+            "policy_fn": policy_fn,
+        }
+    raise ValueError("unknown evaluator {}".format(repr(name)))
@@ -0,0 +1,112 @@
+"""
+Benchmark for the throughput of the get_moves API command. Asks a model
+for a move in each of a number of games, three ways: one get_move
+request after another, as many get_move requests at once as there are
+games (as separate clients would send them), and a single get_moves
+request with every game. Reports the moves per second of each, and the
+number and average size of neural net batches they took.
+
+Run with `python -m whales.benchmark.batch_api`. The requests go
+straight to `whales.api.query`, without the web server, and the models
+and neural net caches are replaced before each way, so that none of
+them answers from positions another already saw. The games are random
+games from `whales.neural_net.quantize.random_boards`.
+"""
+
+import argparse
+import concurrent.futures
+import time
+
+import whales.benchmark.engine as engine
+import whales.neural_net.quantize as quantize
+import whales.util.chess
+
+
+def run_sequential(requests, api):
+    """
+    Send each of the get_move requests to the API in turn, and return
+    their responses.
+    """
+    return [api.query(request) for request in requests]
+
+
+def run_concurrent(requests, api):
+    """
+    Send all of the get_move requests to the API at once, each from its
+    own thread, and return their responses.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        return list(executor.map(api.query, requests))
+
+
+def run_batch(requests, api):
+    """
+    Send all of the get_move requests to the API as the items of one
+    get_moves request, and return their responses.
+    """
+    items = [
+        {key: value for key, value in request.items() if key != "command"}
+        for request in requests
+    ]
+    return api.query({"command": "get_moves", "items": items})["results"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of get_moves against get_move."
+    )
+    parser.add_argument("--model", default="new")
+    parser.add_argument("--games", type=int, default=32)
+    args = parser.parse_args()
+
+    # Imported here so that --help doesn't have to load the neural nets.
+    import whales.api as api
+    import whales.models as models
+
+    requests = [
+        {
+            "command": "get_move",
+            "model": args.model,
+            "pgn": whales.util.chess.board_to_pgn(board),
+        }
+        for board in quantize.random_boards(args.games, max_plies=30)
+    ]
+    # Load the neural nets before timing anything.
+    api.query(requests[0])
+
+    print(
+        "{:<12} {:>9} {:>10} {:>9} {:>11}".format(
+            "way", "seconds", "moves/sec", "batches", "batch size"
+        )
+    )
+    for name, run in [
+        ("sequential", run_sequential),
+        ("concurrent", run_concurrent),
+        ("get_moves", run_batch),
+    ]:
+        # Replace the models, so that they don't answer from the
+        # transposition tables the last way filled.
+        models.MODELS = models.make_models()
+        engine.clear_neural_net_caches()
+        before = engine.neural_net_counters()
+        start = time.perf_counter()
+        responses = run(requests, api)
+        seconds = time.perf_counter() - start
+        counters = engine.neural_net_counters()
+        counters.subtract(before)
+        errors = [response["error"] for response in responses if response["error"]]
+        if errors:
+            print("{}: errors {}".format(name, errors))
+        print(
+            "{:<12} {:>9.3f} {:>10.1f} {:>9} {:>11.1f}".format(
+                name,
+                seconds,
+                len(requests) / seconds,
+                counters["batches"],
+                counters["rows"] / max(counters["batches"], 1),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
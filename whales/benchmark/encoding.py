@@ -0,0 +1,122 @@
+"""
+Benchmark for the chess_alpha_zero input encoders. Checks that the
+bitboard encoder (`boards_to_arrays_alpha_chess`) gives output that is
+bit-for-bit identical to the original FEN-based encoder
+(`board_to_arrays_alpha_chess`), and compares how long each takes per
+board.
+
+The positions checked are the test positions plus random games played
+out from each of them, which covers castling rights, en passant,
+promotions and both players to move.
+
+Run with `python -m whales.benchmark.encoding`. Exits with a nonzero
+status if the encoders disagree on any position.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+import whales.benchmark as benchmark
+import whales.neural_net.chess_alpha_data as chess_alpha_data
+
+
+def random_positions(start_boards, num_games, max_plies, seed):
+    """
+    Return a list of every position reached while playing num_games
+    random games of at most max_plies plies from each of the given
+    python-chess Boards.
+    """
+    rng = random.Random(seed)
+    positions = []
+    for start_board in start_boards:
+        for _ in range(num_games):
+            board = start_board.copy()
+            positions.append(board.copy())
+            for _ in range(max_plies):
+                moves = list(board.legal_moves)
+                if not moves:
+                    break
+                board.push(rng.choice(moves))
+                positions.append(board.copy())
+    return positions
+
+
+def find_mismatches(boards):
+    """
+    Encode the given boards with both encoders and return a list of the
+    boards where the results are not bit-for-bit identical.
+    """
+    expected = [chess_alpha_data.board_to_arrays_alpha_chess(b) for b in boards]
+    actual = chess_alpha_data.boards_to_arrays_alpha_chess(boards)
+    mismatches = []
+    for board, expected_array, actual_array in zip(boards, expected, actual):
+        # Compare the bits rather than the floats, so that even a
+        # negative zero would count as a difference.
+        expected_bits = np.asarray(expected_array, dtype=np.float32).view(np.uint32)
+        if not np.array_equal(expected_bits, actual_array.view(np.uint32)):
+            mismatches.append(board)
+    return mismatches
+
+
+def time_per_board(encode, boards, repeats):
+    """
+    Return the fastest time, out of repeats runs, that the given
+    function took to encode the given boards, divided by the number of
+    boards.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        encode(boards)
+        best = min(best, time.perf_counter() - start)
+    return best / len(boards)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check and time the chess_alpha_zero input encoders."
+    )
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--plies", type=int, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    start_boards = [board for _, board in benchmark.load_positions(args.positions)]
+    boards = random_positions(start_boards, args.games, args.plies, args.seed)
+
+    mismatches = find_mismatches(boards)
+    print("checked {} positions, {} mismatches".format(len(boards), len(mismatches)))
+    for board in mismatches[:10]:
+        print("  mismatch: {}".format(board.fen()))
+
+    buffer = np.empty((len(boards), 18, 8, 8), dtype=np.float32)
+    timings = [
+        (
+            "fen (one board at a time)",
+            lambda bs: [chess_alpha_data.board_to_arrays_alpha_chess(b) for b in bs],
+        ),
+        (
+            "bitboard (one board at a time)",
+            lambda bs: [chess_alpha_data.boards_to_arrays_alpha_chess([b]) for b in bs],
+        ),
+        (
+            "bitboard (whole batch)",
+            lambda bs: chess_alpha_data.boards_to_arrays_alpha_chess(bs, out=buffer),
+        ),
+    ]
+    for name, encode in timings:
+        seconds = time_per_board(encode, boards, args.repeats)
+        print("{:<32} {:>8.1f} us/board".format(name, seconds * 1e6))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
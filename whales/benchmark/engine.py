@@ -0,0 +1,306 @@
+"""
+Benchmark for the engines as a whole. Runs every model in
+`whales.models.MODELS`, and plain minimax at chosen depths, over the
+test positions, and reports for each run the wall time, the nodes
+searched and leaves evaluated (and the rates of both), the depth
+reached, the number and average size of neural net batches, the
+average time the neural net took per batch, and the peak memory
+allocated by Python and numpy.
+
+Run with `python -m whales.benchmark.engine`. The results can be
+written to a JSON file with --output, and compared against the results
+of an earlier run (say, before a change) with --baseline. Then the
+benchmark exits with a nonzero status if any engine got slower, or
+searched more nodes, by more than the threshold.
+
+The times for plain minimax are the time to reach each depth. Models
+use their own depths and time limits, unless --time-limit is given,
+and report the depth they reached. Every run starts cold: models are
+made afresh (see `whales.models.make_models`), so that they don't
+reuse their transposition tables, and the neural net caches are
+cleared. The peak memory is
+measured in a separate run, as for `whales.benchmark.search`, and
+doesn't include memory allocated by onnxruntime itself.
+"""
+
+import argparse
+import collections
+import json
+import sys
+import time
+import tracemalloc
+
+import whales.benchmark as benchmark
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+import whales.minimax_ab.transposition as transposition
+
+# Default fraction by which an engine may get slower, or search more
+# nodes, than in the baseline before it is reported as a regression.
+DEFAULT_THRESHOLD = 0.1
+
+# Keys of the totals that are compared against the baseline, and are
+# regressions if they go up.
+COMPARED_KEYS = ["seconds", "nodes"]
+
+
+def neural_net_counters():
+    """
+    Return a Counter with the batches, rows and run time of every neural
+    net scheduler, or an empty Counter if the neural nets aren't loaded.
+    """
+    counters = collections.Counter()
+    neural_net = sys.modules.get("whales.neural_net.interface")
+    if neural_net is None:
+        return counters
+    for scheduler in neural_net.NEURAL_NET_SCHEDULERS.values():
+        stats = scheduler.get_stats()
+        counters["batches"] += stats["batches"]
+        counters["rows"] += stats["rows"]
+        counters["run_seconds"] += stats["run_seconds"]
+    return counters
+
+
+def clear_neural_net_caches():
+    """
+    Clear the prediction cache of every neural net, if they are loaded.
+    """
+    neural_net = sys.modules.get("whales.neural_net.interface")
+    if neural_net is not None:
+        for cache in neural_net.NEURAL_NET_CACHES.values():
+            cache.clear()
+
+
+def model_engine(model_name, time_limit):
+    """
+    Return a function that makes an engine which runs a fresh copy of
+    the model by the given name. An engine is a function that takes a
+    board and a Counter for search stats and makes a move.
+    """
+    # Imported here for the same reason as in `main`.
+    import whales.models as models
+
+    def make_engine():
+        model = models.make_models()[model_name]["callable"]
+
+        def engine(board, stats):
+            model(board, time_limit=time_limit, stats=stats)
+
+        return engine
+
+    return make_engine
+
+
+def minimax_engine(evaluator, depth):
+    """
+    Return a function that makes an engine (see `model_engine`) which
+    runs plain minimax to the given depth with the given evaluator (see
+    `benchmark.get_evaluator`), with a fresh transposition table and
+    MoveOrdering.
+    """
+
+    def engine(board, stats):
+        minimax.minimax(
+            board,
+            evaluator["eval_fn"],
+            depth,
+            batch_eval_fn=evaluator["batch_eval_fn"],
+            table=transposition.TranspositionTable(),
+            ordering=ordering.MoveOrdering(policy_fn=evaluator["policy_fn"]),
+            stats=stats,
+        )
+        stats["depth"] = depth
+
+    return lambda: engine
+
+
+def measure(make_engine, board, track_memory=True):
+    """
+    Run a new engine from make_engine (see `model_engine`) on a copy of
+    the board, and return a dictionary with what it did. If track_memory
+    is true, run another new engine to measure its peak memory.
+    """
+    engine = make_engine()
+    clear_neural_net_caches()
+    stats = collections.Counter()
+    nn_before = neural_net_counters()
+    start = time.perf_counter()
+    engine(board.copy(), stats)
+    seconds = time.perf_counter() - start
+    nn = neural_net_counters()
+    nn.subtract(nn_before)
+
+    result = {
+        "seconds": seconds,
+        "nodes": stats["nodes"],
+        "evals": stats["evals"],
+        "depth": stats["depth"],
+        "nn_batches": nn["batches"],
+        "nn_rows": nn["rows"],
+        "nn_seconds": nn["run_seconds"],
+        "peak_bytes": None,
+    }
+    if track_memory:
+        engine = make_engine()
+        clear_neural_net_caches()
+        tracemalloc.start()
+        engine(board.copy(), collections.Counter())
+        _, result["peak_bytes"] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result
+
+
+def total_results(results):
+    """
+    Return a dictionary of the totals of a list of results of `measure`,
+    with the peak memory being the largest of them.
+    """
+    total = collections.Counter()
+    for result in results:
+        for key, value in result.items():
+            if key not in ("depth", "peak_bytes"):
+                total[key] += value
+    total = dict(total)
+    peaks = [r["peak_bytes"] for r in results if r["peak_bytes"] is not None]
+    total["peak_bytes"] = max(peaks, default=None)
+    return total
+
+
+def compare(totals, baseline_totals, threshold):
+    """
+    Compare the totals of each engine against those of the baseline, and
+    return a list of messages about the ones that went up by more than
+    the given fraction. Engines missing from either are ignored.
+    """
+    regressions = []
+    for name, total in totals.items():
+        if name not in baseline_totals:
+            continue
+        for key in COMPARED_KEYS:
+            before = baseline_totals[name][key]
+            after = total[key]
+            if after > before * (1 + threshold):
+                regressions.append(
+                    "{}: {} went from {:.4g} to {:.4g}".format(name, key, before, after)
+                )
+    return regressions
+
+
+def format_row(name, position, result):
+    """
+    Return a line of the results table for a result of `measure` (or
+    totals of them).
+    """
+    seconds = result["seconds"]
+    batches = result["nn_batches"]
+    peak = result["peak_bytes"]
+    return "{:<36} {:<22} {:>9.3f} {:>9} {:>10.0f} {:>10.0f} {:>5} {:>7} {:>7} {:>9}".format(
+        name,
+        position,
+        seconds,
+        result["nodes"],
+        result["nodes"] / seconds,
+        result["evals"] / seconds,
+        result.get("depth", ""),
+        "{:.1f}".format(result["nn_rows"] / batches) if batches else "-",
+        "{:.2f}".format(result["nn_seconds"] / batches * 1000) if batches else "-",
+        "{:.0f}".format(peak / 1024) if peak is not None else "-",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark every model, and plain minimax, on the test "
+        "positions."
+    )
+    parser.add_argument(
+        "--models",
+        nargs="*",
+        default=None,
+        help="names of the models to run (default: all)",
+    )
+    parser.add_argument(
+        "--minimax-depths",
+        type=int,
+        nargs="*",
+        default=[2, 3],
+        help="depths to run plain minimax to",
+    )
+    parser.add_argument(
+        "--evaluator", choices=benchmark.EVALUATOR_NAMES, default="material"
+    )
+    parser.add_argument("--time-limit", type=float, default=None)
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    engines = collections.OrderedDict()
+    if args.models != []:
+        # Imported here so that benchmarks of plain minimax with the
+        # material evaluator don't need the neural net to be loaded.
+        import whales.models as models
+
+        for name in args.models or models.MODELS:
+            # Fail before starting if there is no model by that name.
+            models.get_model(name)
+            engines[name] = model_engine(name, args.time_limit)
+    if args.minimax_depths:
+        evaluator = benchmark.get_evaluator(args.evaluator)
+        for depth in args.minimax_depths:
+            name = "minimax-{}-depth{}".format(args.evaluator, depth)
+            engines[name] = minimax_engine(evaluator, depth)
+    positions = benchmark.load_positions(args.positions)
+
+    print(
+        "{:<36} {:<22} {:>9} {:>9} {:>10} {:>10} {:>5} {:>7} {:>7} {:>9}".format(
+            "engine",
+            "position",
+            "seconds",
+            "nodes",
+            "nodes/sec",
+            "evals/sec",
+            "depth",
+            "batch",
+            "nn ms",
+            "peak KiB",
+        )
+    )
+    results = []
+    totals = collections.OrderedDict()
+    for engine_name, make_engine in engines.items():
+        engine_results = []
+        for position_name, board in positions:
+            result = measure(make_engine, board, track_memory=not args.no_memory)
+            print(format_row(engine_name, position_name, result))
+            engine_results.append(result)
+            results.append(dict(result, engine=engine_name, position=position_name))
+        totals[engine_name] = total_results(engine_results)
+        print(format_row(engine_name, "total", totals[engine_name]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(
+                {
+                    "positions": [name for name, _ in positions],
+                    "results": results,
+                    "totals": totals,
+                },
+                file,
+                indent=2,
+            )
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(totals, baseline["totals"], args.threshold)
+        for message in regressions:
+            print("regression: {}".format(message))
+        if regressions:
+            sys.exit(1)
+        print("no regressions against {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
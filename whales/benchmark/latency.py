@@ -0,0 +1,73 @@
+"""
+Benchmark for the latency of answering a single move request. Runs each
+of the given models on every test position, and reports the median and
+worst time per move, and how many batches and rows the neural net was
+run on per move.
+
+Run with `python -m whales.benchmark.latency`. The neural net caches are
+cleared before every move, so that each is answered from cold, and the
+neural nets are warmed up first, so that loading them isn't counted.
+Models are made afresh for every move (see `whales.models.make_models`),
+so that they don't reuse their transposition tables.
+"""
+
+import argparse
+import statistics
+import time
+
+import whales.benchmark as benchmark
+import whales.benchmark.engine as engine
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark how long models take to answer a move request."
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=["policy-chess-alpha-zero", "new"],
+        help="internal names of the models to run",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    # Imported here so that --help doesn't have to load the neural nets.
+    import whales.models as models
+    import whales.neural_net.interface as neural_net
+
+    for lazy_session in neural_net.NEURAL_NET_DICT.values():
+        lazy_session.warm_up()
+    positions = benchmark.load_positions(args.positions)
+
+    print(
+        "{:<36} {:>10} {:>10} {:>9} {:>9}".format(
+            "model", "median ms", "max ms", "batches", "rows"
+        )
+    )
+    for model_name in args.models:
+        times = []
+        before = engine.neural_net_counters()
+        for _ in range(args.repeat):
+            for _, board in positions:
+                model = models.make_models()[model_name]["callable"]
+                engine.clear_neural_net_caches()
+                start = time.perf_counter()
+                model(board.copy())
+                times.append(time.perf_counter() - start)
+        counters = engine.neural_net_counters()
+        counters.subtract(before)
+        print(
+            "{:<36} {:>10.1f} {:>10.1f} {:>9.1f} {:>9.1f}".format(
+                model_name,
+                statistics.median(times) * 1000,
+                max(times) * 1000,
+                counters["batches"] / len(times),
+                counters["rows"] / len(times),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
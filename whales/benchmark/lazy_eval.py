@@ -0,0 +1,122 @@
+"""
+Benchmark for lazy evaluation (see `whales.minimax_ab.static_eval`).
+Searches the test positions with and without it, at each of the given
+margins, and reports for each search the time taken, the leaves scored
+by the evaluation function and by the static score alone, and whether
+it chose the same move as the search without lazy evaluation.
+
+Run with `python -m whales.benchmark.lazy_eval`. Every search uses a
+fresh transposition table and MoveOrdering, and the neural net caches
+are cleared before each one, so that the searches don't help each
+other.
+"""
+
+import argparse
+import collections
+import time
+
+import whales.benchmark as benchmark
+import whales.benchmark.engine as engine
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+import whales.minimax_ab.static_eval as static_eval
+import whales.minimax_ab.transposition as transposition
+
+
+def search(board, evaluator, depth, lazy_eval):
+    """
+    Search a copy of the board to the given depth with the given
+    evaluator (see `benchmark.get_evaluator`) and LazyEval (or None),
+    and return a tuple of the move found, the number of seconds taken
+    and the stats of the search.
+    """
+    engine.clear_neural_net_caches()
+    stats = collections.Counter()
+    start = time.perf_counter()
+    _, move = minimax.minimax(
+        board.copy(),
+        evaluator["eval_fn"],
+        depth,
+        batch_eval_fn=evaluator["batch_eval_fn"],
+        table=transposition.TranspositionTable(),
+        ordering=ordering.MoveOrdering(policy_fn=evaluator["policy_fn"]),
+        stats=stats,
+        lazy_eval=lazy_eval,
+    )
+    return move, time.perf_counter() - start, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark minimax search with and without lazy evaluation."
+    )
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument(
+        "--evaluator", choices=benchmark.EVALUATOR_NAMES, default="chess_alpha_zero"
+    )
+    parser.add_argument(
+        "--margins",
+        type=float,
+        nargs="+",
+        default=[1, 2, 4],
+        help="margins in pawns to try lazy evaluation with",
+    )
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    evaluator = benchmark.get_evaluator(args.evaluator)
+    positions = benchmark.load_positions(args.positions)
+    configs = [("off", None)] + [
+        ("margin {:g}".format(margin), static_eval.LazyEval(margin=margin))
+        for margin in args.margins
+    ]
+
+    print(
+        "{:<22} {:<12} {:>9} {:>7} {:>7} {:>6}".format(
+            "position", "lazy eval", "seconds", "evals", "lazy", "same"
+        )
+    )
+    totals = collections.OrderedDict(
+        (name, collections.Counter()) for name, _ in configs
+    )
+    for position_name, board in positions:
+        full_move = None
+        for name, lazy_eval in configs:
+            move, seconds, stats = search(board, evaluator, args.depth, lazy_eval)
+            if lazy_eval is None:
+                full_move = move
+            same = move == full_move
+            print(
+                "{:<22} {:<12} {:>9.3f} {:>7} {:>7} {:>6}".format(
+                    position_name,
+                    name,
+                    seconds,
+                    stats["evals"],
+                    stats["lazy_evals"],
+                    "yes" if same else "no",
+                )
+            )
+            totals[name].update(
+                seconds=seconds,
+                evals=stats["evals"],
+                lazy_evals=stats["lazy_evals"],
+                same=int(same),
+            )
+
+    print()
+    full_evals = totals["off"]["evals"]
+    for name, total in totals.items():
+        print(
+            "{:<12} {:>9.3f} s {:>7} evals ({:.0%} fewer) {:>4}/{} same moves".format(
+                name,
+                total["seconds"],
+                total["evals"],
+                1 - total["evals"] / full_evals if full_evals else 0,
+                total["same"],
+                len(positions),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark that measures the playing strength of two models, by playing
+them against each other, and what it costs: the CPU time each of them
+takes per move. Each test position is played twice, once with each
+model moving first, and games that aren't over after --max-plies plies
+are scored as draws.
+
+Run with `python -m whales.benchmark.match`. By default it plays the
+Monte Carlo tree search model against "Hard", the minimax model using
+the same neural net, so that the two ways of using the neural net can
+be compared per CPU-second. Models are made afresh for every game (see
+`whales.models.make_models`), so they only reuse their trees and
+transposition tables within a game. CPU time is measured with
+`time.process_time`, which includes the threads of onnxruntime.
+"""
+
+import argparse
+import collections
+import time
+
+import chess
+
+import whales.benchmark as benchmark
+import whales.benchmark.engine as engine
+import whales.minimax_ab.minimax as minimax
+
+
+def play_game(board, players, max_plies, time_limit, totals):
+    """
+    Play a game from a copy of the board between the given models, a
+    dictionary mapping each color to the name of the model playing it,
+    and return its score for White (1, 0.5 or 0). Add the CPU seconds
+    and moves of each model to totals, a dictionary mapping model names
+    to Counters.
+    """
+    # Imported here so that --help doesn't have to load the neural nets.
+    import whales.models as models
+
+    callables = {name: info["callable"] for name, info in models.make_models().items()}
+    engine.clear_neural_net_caches()
+    board = board.copy()
+    for _ in range(max_plies):
+        if minimax.game_over_score(board) is not None:
+            break
+        name = players[board.turn]
+        start = time.process_time()
+        move = callables[name](board, time_limit=time_limit)
+        totals[name].update(cpu_seconds=time.process_time() - start, moves=1)
+        board.push(move)
+    # Convert the score from 100 to -100 into points, with games that
+    # aren't over counting as draws.
+    return ((minimax.game_over_score(board) or 0) + 100) / 200
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play two models against each other and compare their CPU time."
+    )
+    parser.add_argument("--model", default="mcts-chess-alpha-zero")
+    parser.add_argument("--opponent", default="neuralnet-depth1-chess-alpha-zero")
+    parser.add_argument("--max-plies", type=int, default=40)
+    parser.add_argument("--time-limit", type=float)
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    positions = benchmark.load_positions(args.positions)
+    totals = {args.model: collections.Counter(), args.opponent: collections.Counter()}
+    results = collections.Counter()
+
+    print("{:<22} {:<6} {:>6}".format("position", "color", "score"))
+    for position_name, board in positions:
+        for color in (chess.WHITE, chess.BLACK):
+            players = {color: args.model, not color: args.opponent}
+            white_score = play_game(
+                board, players, args.max_plies, args.time_limit, totals
+            )
+            score = white_score if color == chess.WHITE else 1 - white_score
+            results[score] += 1
+            print(
+                "{:<22} {:<6} {:>6}".format(
+                    position_name, "white" if color == chess.WHITE else "black", score
+                )
+            )
+
+    print()
+    games = sum(results.values())
+    points = sum(score * count for score, count in results.items())
+    print(
+        "{}: {} wins, {} draws, {} losses, {:.1f}/{} points ({:.0%})".format(
+            args.model,
+            results[1],
+            results[0.5],
+            results[0],
+            points,
+            games,
+            points / games,
+        )
+    )
+    for name, total in totals.items():
+        print(
+            "{}: {:.3f} CPU seconds per move over {} moves".format(
+                name, total["cpu_seconds"] / max(total["moves"], 1), total["moves"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark that measures how much move ordering helps alpha/beta pruning,
+by counting the nodes visited by minimax over the test positions with
+and without `whales.minimax_ab.ordering.MoveOrdering`.
+
+Run with `python -m whales.benchmark.ordering`.
+"""
+
+import argparse
+import collections
+
+import whales.benchmark as benchmark
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+
+
+def count_nodes(board, evaluator, depth, move_ordering):
+    """
+    Search the board to the given depth with the given evaluator (see
+    `benchmark.get_evaluator`) and MoveOrdering (or None), without a
+    transposition table or batching so that only the ordering differs.
+    Return a tuple of the search result and a Counter of its stats.
+    """
+    stats = collections.Counter()
+    result = minimax.minimax(
+        board.copy(),
+        evaluator["eval_fn"],
+        depth,
+        ordering=move_ordering,
+        stats=stats,
+    )
+    return result, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Count minimax nodes with and without move ordering."
+    )
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument(
+        "--evaluator", choices=benchmark.EVALUATOR_NAMES, default="chess_alpha_zero"
+    )
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    evaluator = benchmark.get_evaluator(args.evaluator)
+    totals = collections.Counter()
+    print(
+        "{:<24} {:>10} {:>10} {:>8}".format("position", "unordered", "ordered", "saved")
+    )
+    for name, board in benchmark.load_positions(args.positions):
+        before, before_stats = count_nodes(board, evaluator, args.depth, None)
+        move_ordering = ordering.MoveOrdering(policy_fn=evaluator["policy_fn"])
+        after, after_stats = count_nodes(board, evaluator, args.depth, move_ordering)
+        # Ordering must never change the minimax value, only how much
+        # work it takes to find it.
+        if before[0] != after[0]:
+            print("warning: value changed for {}".format(name))
+        totals["before"] += before_stats["nodes"]
+        totals["after"] += after_stats["nodes"]
+        saved = 1 - after_stats["nodes"] / before_stats["nodes"]
+        print(
+            "{:<24} {:>10} {:>10} {:>7.1%}".format(
+                name, before_stats["nodes"], after_stats["nodes"], saved
+            )
+        )
+    print(
+        "{:<24} {:>10} {:>10} {:>7.1%}".format(
+            "total",
+            totals["before"],
+            totals["after"],
+            1 - totals["after"] / totals["before"],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark for the parallel minimax search. Searches the test positions
+to a fixed depth serially and with `parallel.minimax_parallel` at
+several worker counts, checks that every parallel search picks the same
+move with the same score as the serial one, and reports the speedup.
+
+Every search gets a fresh MoveOrdering and transposition table, so that
+no search benefits from the work of another.
+
+Run with `python -m whales.benchmark.parallel`. Exits with a nonzero
+status if any parallel search disagrees with the serial search.
+"""
+
+import argparse
+import collections
+import functools
+import os
+import sys
+import time
+
+import whales.benchmark as benchmark
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+import whales.minimax_ab.parallel as parallel
+import whales.minimax_ab.transposition as transposition
+
+
+def run_search(board, evaluator, depth, search_fn):
+    """
+    Search the board to the given depth with the given evaluator (see
+    `benchmark.get_evaluator`) using search_fn, which takes the same
+    arguments as `minimax.minimax`. Return a tuple of the search result,
+    the number of nodes visited and the number of seconds taken.
+    """
+    stats = collections.Counter()
+    start = time.perf_counter()
+    result = search_fn(
+        board.copy(),
+        evaluator["eval_fn"],
+        depth,
+        batch_eval_fn=evaluator["batch_eval_fn"],
+        table=transposition.TranspositionTable(),
+        ordering=ordering.MoveOrdering(policy_fn=evaluator["policy_fn"]),
+        stats=stats,
+    )
+    return result, stats["nodes"], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare serial and parallel minimax search."
+    )
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument(
+        "--evaluator", choices=benchmark.EVALUATOR_NAMES, default="chess_alpha_zero"
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    evaluator = benchmark.get_evaluator(args.evaluator)
+    process_functions = None
+    if args.executor == "process":
+        process_functions = "benchmark"
+        parallel.register_process_functions(
+            process_functions,
+            evaluator["eval_fn"],
+            evaluator["batch_eval_fn"],
+            evaluator["policy_fn"],
+        )
+    executors = {
+        workers: parallel.make_executor(workers, args.executor)
+        for workers in args.workers
+    }
+    positions = benchmark.load_positions(args.positions)
+
+    print("cpus available: {}".format(os.cpu_count()))
+    print(
+        "{:<10} {:>10} {:>10} {:>10} {:>10}".format(
+            "workers", "seconds", "speedup", "nodes", "mismatches"
+        )
+    )
+    serial_seconds = 0
+    serial_nodes = 0
+    serial_results = {}
+    for name, board in positions:
+        result, nodes, seconds = run_search(
+            board, evaluator, args.depth, minimax.minimax
+        )
+        serial_results[name] = result
+        serial_nodes += nodes
+        serial_seconds += seconds
+    print(
+        "{:<10} {:>10.2f} {:>10.2f} {:>10} {:>10}".format(
+            "serial", serial_seconds, 1, serial_nodes, 0
+        )
+    )
+
+    total_mismatches = 0
+    for workers, executor in executors.items():
+        total_seconds = 0
+        total_nodes = 0
+        mismatches = []
+        search_fn = functools.partial(
+            parallel.minimax_parallel,
+            executor=executor,
+            process_functions=process_functions,
+        )
+        for name, board in positions:
+            result, nodes, seconds = run_search(board, evaluator, args.depth, search_fn)
+            total_nodes += nodes
+            total_seconds += seconds
+            if result != serial_results[name]:
+                mismatches.append((name, serial_results[name], result))
+        print(
+            "{:<10} {:>10.2f} {:>10.2f} {:>10} {:>10}".format(
+                workers,
+                total_seconds,
+                serial_seconds / total_seconds,
+                total_nodes,
+                len(mismatches),
+            )
+        )
+        for name, expected, actual in mismatches:
+            print("  mismatch on {}: {} != {}".format(name, actual, expected))
+        total_mismatches += len(mismatches)
+        executor.shutdown()
+
+    if total_mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
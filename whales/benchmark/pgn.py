@@ -0,0 +1,108 @@
+"""
+Benchmark for turning request PGN into a board and the reply back into
+PGN. Plays random games, and at each game length compares the time per
+request of the full python-chess parser and printer against
+`whales.util.chess.pgn_to_board` and `append_move_to_pgn`, with the
+board cache warmed up the way a client playing the game would leave
+it (by the server's reply to the previous move).
+
+Run with `python -m whales.benchmark.pgn`.
+"""
+
+import argparse
+import io
+import random
+import time
+
+import chess
+import chess.pgn
+
+import whales.util.chess
+
+
+def full_round_trip(pgn, move):
+    """
+    Convert the PGN into a board with the full python-chess parser, make
+    the move, and convert the board back into PGN, as was done for every
+    request before the fast path existed.
+    """
+    game = chess.pgn.read_game(
+        io.StringIO(pgn or "-"), Visitor=whales.util.chess.SilentGameCreator
+    )
+    board = game.end().board()
+    board.push(move)
+    return whales.util.chess.board_to_pgn(board)
+
+
+def fast_round_trip(pgn, move):
+    """
+    Convert the PGN into a board and add the move to the PGN the way
+    `whales.models.run_model` does.
+    """
+    board = whales.util.chess.pgn_to_board(pgn)
+    return whales.util.chess.append_move_to_pgn(pgn, board, move)
+
+
+def random_game(num_plies, rng):
+    """
+    Return a list of the moves of a random game of up to num_plies
+    plies.
+    """
+    board = chess.Board()
+    for _ in range(num_plies):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+    return board.move_stack
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time converting requests from and replies to PGN."
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=[20, 60, 120])
+    parser.add_argument("--games", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(
+        "{:<10} {:>12} {:>12} {:>10}".format("plies", "full us", "fast us", "speedup")
+    )
+    for length in args.lengths:
+        games = [random_game(length, rng) for _ in range(args.games)]
+        times = {"full": 0, "fast": 0}
+        requests = 0
+        for moves in games:
+            if len(moves) < 2:
+                continue
+            # The client sends the game up to and including its move,
+            # having last been sent the game up to the move before.
+            board = chess.Board()
+            for move in moves[:-2]:
+                board.push(move)
+            previous = whales.util.chess.board_to_pgn(board)
+            fast_round_trip(previous, moves[-2])
+            board.push(moves[-2])
+            request = whales.util.chess.board_to_pgn(board)
+            for name, round_trip in (
+                ("full", full_round_trip),
+                ("fast", fast_round_trip),
+            ):
+                start = time.perf_counter()
+                round_trip(request, moves[-1])
+                times[name] += time.perf_counter() - start
+            requests += 1
+        print(
+            "{:<10} {:>12.0f} {:>12.0f} {:>10.1f}".format(
+                length,
+                times["full"] / requests * 1e6,
+                times["fast"] / requests * 1e6,
+                times["full"] / times["fast"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
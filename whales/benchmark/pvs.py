@@ -0,0 +1,179 @@
+"""
+Benchmark and validation for principal variation search (see
+`whales.minimax_ab.pvs`). Searches the test positions to each of the
+given depths with both `minimax.minimax` and `pvs.pvs` (each with its
+own fresh transposition table and MoveOrdering), and reports the time
+and nodes of each, and whether they agree.
+
+They agree if they find the same score, and PVS's move has that score
+according to plain minimax (it may be a different move when several
+are equally good). Any disagreement is printed, and makes the benchmark
+exit with a nonzero status.
+
+Run with `python -m whales.benchmark.pvs`. With --iterative, both are
+run with iterative deepening (see `minimax.minimax_iterative`), which
+is how the models run them and lets PVS use aspiration windows.
+"""
+
+import argparse
+import collections
+import sys
+import time
+
+import whales.benchmark as benchmark
+import whales.benchmark.engine as engine
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+import whales.minimax_ab.pvs as pvs
+import whales.minimax_ab.transposition as transposition
+
+# Largest difference between scores that still counts as the same,
+# allowing for the evaluation function rounding differently when given
+# a different batch of leaves.
+TOLERANCE = 1e-6
+
+
+def search(search_fn, board, evaluator, depth, iterative):
+    """
+    Search a copy of the board to the given depth with search_fn
+    (`minimax.minimax` or `pvs.pvs`) and the given evaluator (see
+    `benchmark.get_evaluator`), and return a tuple of the score, the
+    move, the number of seconds taken and the stats of the search.
+    """
+    engine.clear_neural_net_caches()
+    stats = collections.Counter()
+    kwargs = dict(
+        batch_eval_fn=evaluator["batch_eval_fn"],
+        table=transposition.TranspositionTable(),
+        ordering=ordering.MoveOrdering(policy_fn=evaluator["policy_fn"]),
+        stats=stats,
+    )
+    start = time.perf_counter()
+    if iterative:
+        score, move = minimax.minimax_iterative(
+            board.copy(), evaluator["eval_fn"], depth, search_fn=search_fn, **kwargs
+        )
+    else:
+        score, move = search_fn(board.copy(), evaluator["eval_fn"], depth, **kwargs)
+    return score, move, time.perf_counter() - start, stats
+
+
+def move_score(board, move, evaluator, depth):
+    """
+    Return the score of making the given move on the board, from the
+    point of view of the player to move, according to plain minimax
+    searching the rest of the given depth.
+    """
+    board = board.copy()
+    board.push(move)
+    score, _ = minimax.minimax(
+        board,
+        evaluator["eval_fn"],
+        depth - 1,
+        batch_eval_fn=evaluator["batch_eval_fn"],
+    )
+    return -score
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare principal variation search against plain minimax."
+    )
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument(
+        "--evaluator", choices=benchmark.EVALUATOR_NAMES, default="material"
+    )
+    parser.add_argument("--iterative", action="store_true")
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    evaluator = benchmark.get_evaluator(args.evaluator)
+    positions = benchmark.load_positions(args.positions)
+
+    print(
+        "{:<22} {:>5} {:>10} {:>10} {:>9} {:>9} {:>6}".format(
+            "position",
+            "depth",
+            "ab nodes",
+            "pvs nodes",
+            "ab sec",
+            "pvs sec",
+            "agree",
+        )
+    )
+    totals = collections.Counter()
+    disagreements = []
+    for position_name, board in positions:
+        for depth in args.depths:
+            ab_score, ab_move, ab_seconds, ab_stats = search(
+                minimax.minimax, board, evaluator, depth, args.iterative
+            )
+            pvs_score, pvs_move, pvs_seconds, pvs_stats = search(
+                pvs.pvs, board, evaluator, depth, args.iterative
+            )
+            agree = abs(ab_score - pvs_score) <= TOLERANCE and (
+                pvs_move == ab_move
+                or abs(move_score(board, pvs_move, evaluator, depth) - ab_score)
+                <= TOLERANCE
+            )
+            if not agree:
+                disagreements.append(
+                    "{} depth {}: minimax {} {}, pvs {} {}".format(
+                        position_name, depth, ab_move, ab_score, pvs_move, pvs_score
+                    )
+                )
+            print(
+                "{:<22} {:>5} {:>10} {:>10} {:>9.3f} {:>9.3f} {:>6}".format(
+                    position_name,
+                    depth,
+                    ab_stats["nodes"],
+                    pvs_stats["nodes"],
+                    ab_seconds,
+                    pvs_seconds,
+                    "yes" if agree else "NO",
+                )
+            )
+            totals.update(
+                ab_nodes=ab_stats["nodes"],
+                pvs_nodes=pvs_stats["nodes"],
+                ab_evals=ab_stats["evals"],
+                pvs_evals=pvs_stats["evals"],
+                ab_seconds=ab_seconds,
+                pvs_seconds=pvs_seconds,
+                researches=pvs_stats["researches"],
+                aspiration_fails=pvs_stats["aspiration_fails"],
+            )
+
+    print()
+    print(
+        "nodes: {} minimax, {} pvs ({:.0%} fewer)".format(
+            totals["ab_nodes"],
+            totals["pvs_nodes"],
+            1 - totals["pvs_nodes"] / totals["ab_nodes"],
+        )
+    )
+    print(
+        "evals: {} minimax, {} pvs ({:.0%} fewer)".format(
+            totals["ab_evals"],
+            totals["pvs_evals"],
+            1 - totals["pvs_evals"] / totals["ab_evals"],
+        )
+    )
+    print(
+        "seconds: {:.3f} minimax, {:.3f} pvs".format(
+            totals["ab_seconds"], totals["pvs_seconds"]
+        )
+    )
+    print(
+        "pvs re-searches: {}, aspiration window fails: {}".format(
+            totals["researches"], totals["aspiration_fails"]
+        )
+    )
+    for message in disagreements:
+        print("disagreement: {}".format(message))
+    if disagreements:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark comparing the quantized chess_alpha_zero neural net (see
+`whales.neural_net.quantize`) against the original. Reports, for each
+batch size, the median time each takes to run a batch, and over a set
+of random positions, how closely the quantized net's outputs agree
+with the original's:
+
+* the mean and largest absolute difference of the values;
+* the fraction of positions where both values have the same sign,
+  that is, agree on who is better;
+* the fraction of positions where both policies rank the same legal
+  move first.
+
+Run with `python -m whales.benchmark.quantization`, after making the
+quantized net. The positions are different from the ones the quantized
+net was calibrated on. The sessions are run directly, without the
+neural net scheduler and cache, so only the neural nets are timed.
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+import whales.neural_net.chess_alpha_data as chess_alpha_data
+import whales.neural_net.quantize as quantize
+import whales.neural_net.session as session
+
+
+def time_batches(lazy_session, array, repeat):
+    """
+    Run the LazySession on the array repeat times, after running it
+    once to warm up, and return the median number of seconds a run
+    took.
+    """
+    lazy_session.run(array)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lazy_session.run(array)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def agreement(boards, outputs, quantized_outputs):
+    """
+    Return a dictionary of how closely the outputs (a list of [policies,
+    values]) of the quantized net for the given boards agree with those
+    of the original net.
+    """
+    policies, values = outputs
+    quantized_policies, quantized_values = quantized_outputs
+    differences = np.abs(values[:, 0] - quantized_values[:, 0])
+    same_best_move = 0
+    for i, board in enumerate(boards):
+        probabilities = chess_alpha_data.policy_to_move_probabilities(
+            policies[i], board
+        )
+        quantized_probabilities = chess_alpha_data.policy_to_move_probabilities(
+            quantized_policies[i], board
+        )
+        if max(probabilities, key=probabilities.get) == max(
+            quantized_probabilities, key=quantized_probabilities.get
+        ):
+            same_best_move += 1
+    return {
+        "mean_value_difference": float(differences.mean()),
+        "max_value_difference": float(differences.max()),
+        "same_value_sign": float(
+            np.mean(np.sign(values[:, 0]) == np.sign(quantized_values[:, 0]))
+        ),
+        "same_best_move": same_best_move / len(boards),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the quantized chess_alpha_zero neural net against "
+        "the original."
+    )
+    parser.add_argument("--model", default=quantize.MODEL_PATH)
+    parser.add_argument("--quantized-model", default=quantize.QUANTIZED_MODEL_PATH)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128, 256]
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--positions",
+        type=int,
+        default=1000,
+        help="number of random positions to compare the outputs on",
+    )
+    # A different seed from the default of `quantize`, so that the nets
+    # are compared on positions they weren't calibrated on.
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    original = session.LazySession(args.model)
+    quantized = session.LazySession(args.quantized_model)
+    boards = quantize.random_boards(
+        max(args.positions, max(args.batch_sizes)), args.seed
+    )
+    array = chess_alpha_data.boards_to_arrays_alpha_chess(boards)
+
+    print(
+        "{:>10} {:>12} {:>12} {:>8}".format("batch", "float ms", "int8 ms", "speedup")
+    )
+    for batch_size in args.batch_sizes:
+        batch = array[:batch_size]
+        seconds = time_batches(original, batch, args.repeat)
+        quantized_seconds = time_batches(quantized, batch, args.repeat)
+        print(
+            "{:>10} {:>12.3f} {:>12.3f} {:>7.2f}x".format(
+                batch_size,
+                seconds * 1000,
+                quantized_seconds * 1000,
+                seconds / quantized_seconds,
+            )
+        )
+
+    boards = boards[: args.positions]
+    array = array[: args.positions]
+    results = agreement(boards, original.run(array), quantized.run(array))
+    print()
+    print("over {} positions:".format(len(boards)))
+    print("  mean value difference: {:.4f}".format(results["mean_value_difference"]))
+    print("  max value difference:  {:.4f}".format(results["max_value_difference"]))
+    print("  same value sign:       {:.1%}".format(results["same_value_sign"]))
+    print("  same best move:        {:.1%}".format(results["same_best_move"]))
+
+
+if __name__ == "__main__":
+    main()
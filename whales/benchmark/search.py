@@ -0,0 +1,127 @@
+"""
+Benchmark for the raw speed of the minimax search core. Searches the
+test positions to a fixed depth and reports, for each position and in
+total, the nodes searched per second, the number of python-chess Boards
+copied per node (the largest allocations the search makes), and the
+peak memory allocated while searching.
+
+Run with `python -m whales.benchmark.search`. The peak memory is
+measured with `tracemalloc` in a separate run, since tracing slows the
+search down too much to time it at the same time.
+"""
+
+import argparse
+import collections
+import time
+import tracemalloc
+
+import chess
+
+import whales.benchmark as benchmark
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+import whales.minimax_ab.transposition as transposition
+
+
+class CopyCounter:
+    """
+    Context manager that counts calls to `chess.Board.copy` while it is
+    active, in its count attribute.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.original_copy = None
+
+    def __enter__(self):
+        self.original_copy = chess.Board.copy
+
+        def copy(board, *args, **kwargs):
+            self.count += 1
+            return self.original_copy(board, *args, **kwargs)
+
+        chess.Board.copy = copy
+        return self
+
+    def __exit__(self, *exc_info):
+        chess.Board.copy = self.original_copy
+
+
+def search(board, evaluator, depth):
+    """
+    Search the board to the given depth with the given evaluator (see
+    `benchmark.get_evaluator`), with a fresh transposition table and
+    MoveOrdering, and return a Counter of the search's stats.
+    """
+    stats = collections.Counter()
+    minimax.minimax(
+        board.copy(),
+        evaluator["eval_fn"],
+        depth,
+        batch_eval_fn=evaluator["batch_eval_fn"],
+        table=transposition.TranspositionTable(),
+        ordering=ordering.MoveOrdering(policy_fn=evaluator["policy_fn"]),
+        stats=stats,
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the speed and allocations of minimax search."
+    )
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument(
+        "--evaluator", choices=benchmark.EVALUATOR_NAMES, default="material"
+    )
+    parser.add_argument("--positions", default=benchmark.POSITIONS_FILE)
+    args = parser.parse_args()
+
+    evaluator = benchmark.get_evaluator(args.evaluator)
+    positions = benchmark.load_positions(args.positions)
+
+    print(
+        "{:<24} {:>10} {:>12} {:>12} {:>10}".format(
+            "position", "nodes", "nodes/sec", "copies/node", "peak KiB"
+        )
+    )
+    totals = collections.Counter()
+    for name, board in positions:
+        with CopyCounter() as copies:
+            start = time.perf_counter()
+            stats = search(board, evaluator, args.depth)
+            seconds = time.perf_counter() - start
+        # The benchmark's own copy of the board doesn't count.
+        num_copies = copies.count - 1
+
+        tracemalloc.start()
+        search(board, evaluator, args.depth)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        totals["nodes"] += stats["nodes"]
+        totals["seconds"] += seconds
+        totals["copies"] += num_copies
+        totals["peak"] = max(totals["peak"], peak)
+        print(
+            "{:<24} {:>10} {:>12.0f} {:>12.2f} {:>10.0f}".format(
+                name,
+                stats["nodes"],
+                stats["nodes"] / seconds,
+                num_copies / stats["nodes"],
+                peak / 1024,
+            )
+        )
+    print(
+        "{:<24} {:>10} {:>12.0f} {:>12.2f} {:>10.0f}".format(
+            "total",
+            totals["nodes"],
+            totals["nodes"] / totals["seconds"],
+            totals["copies"] / totals["nodes"],
+            totals["peak"] / 1024,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
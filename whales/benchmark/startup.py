@@ -0,0 +1,151 @@
+"""
+Benchmark for how quickly a freshly started server answers. Starts
+the server in new processes, without an HTTP server in front of it
+(the requests go through Flask's test client), and reports how long it
+took to import the server, and then to answer the first `get_move`
+for each model in turn, and how long loading the neural nets took
+(whether or not a request was waiting for it), with the neural nets'
+graph cache in each of these states:
+
+* cold: the cache is empty, as when the server first starts on a new
+  machine;
+* warm: the cache has the optimized graphs from the cold run, as when
+  the server is restarted;
+* no-cache: the cache is disabled, as before it existed;
+* warm-up: the cache is warm, and the neural nets are loaded in the
+  background from the start (WHALES_NN_WARMUP), while the server is
+  already answering requests.
+
+Run with `python -m whales.benchmark.startup`. Each scenario starts
+its own process and is run --repeat times, and the median times are
+reported. The cache used is a temporary directory, so the benchmark
+doesn't touch the server's own cache.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Position to ask each model for a move in.
+PGN = "1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 *"
+
+# Names of the scenarios, and the environment variables of each, with
+# "{cache_dir}" standing for the temporary cache directory.
+SCENARIOS = [
+    ("cold", {"WHALES_ONNX_CACHE_DIR": "{cache_dir}"}),
+    ("warm", {"WHALES_ONNX_CACHE_DIR": "{cache_dir}"}),
+    ("no-cache", {"WHALES_NO_ONNX_CACHE": "1"}),
+    (
+        "warm-up",
+        {"WHALES_ONNX_CACHE_DIR": "{cache_dir}", "WHALES_NN_WARMUP": "1"},
+    ),
+]
+
+
+def run_server(model_names):
+    """
+    Import the server, ask each of the given models for a move in turn,
+    and print a JSON object with the number of seconds the import, each
+    move and loading the neural nets took. Meant to be run in a new
+    process, by `measure`.
+    """
+    start = time.perf_counter()
+    import whales.server as server
+
+    result = {"import": time.perf_counter() - start}
+    client = server.app.test_client()
+    for model_name in model_names:
+        start = time.perf_counter()
+        response = client.post(
+            "/api/v1/http",
+            json={"command": "get_move", "model": model_name, "pgn": PGN},
+            # The server redirects plain HTTP to HTTPS.
+            base_url="https://localhost",
+        )
+        error = json.loads(response.get_data())["error"]
+        if error is not None:
+            raise RuntimeError("{}: {}".format(model_name, error))
+        result[model_name] = time.perf_counter() - start
+    neural_net = sys.modules.get("whales.neural_net.interface")
+    result["nn load"] = 0
+    if neural_net is not None:
+        for lazy_session in neural_net.NEURAL_NET_DICT.values():
+            result["nn load"] += lazy_session.get_stats()["load_seconds"]
+    print(json.dumps(result))
+
+
+def measure(model_names, env):
+    """
+    Run `run_server` for the given models in a new Python process with
+    the given environment variables added, and return its times (see
+    `run_server`), with "total" being the time from starting the
+    process until the last move.
+    """
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "whales.benchmark.startup", "--server"] + model_names,
+        env=dict(os.environ, **env),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+    result["total"] = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark how quickly a new server answers its first requests."
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=["random", "neuralnet-depth1-chess-alpha-zero"],
+        help="names of the models to ask for a move, in order",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--server", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.server:
+        run_server(args.server)
+        return
+
+    columns = ["import"] + args.models + ["nn load", "total"]
+    print(
+        "{:<10} ".format("scenario")
+        + " ".join("{:>{}}".format(column, len(column)) for column in columns)
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for scenario, env in SCENARIOS:
+            env = {key: value.format(cache_dir=cache_dir) for key, value in env.items()}
+            results = []
+            for _ in range(args.repeat):
+                results.append(measure(args.models, env))
+                if scenario == "cold":
+                    # Empty the cache again for the next run, so that
+                    # every run is cold.
+                    for name in os.listdir(cache_dir):
+                        os.remove(os.path.join(cache_dir, name))
+            if scenario == "cold":
+                # Leave the cache warm for the next scenarios.
+                measure(args.models, env)
+            print(
+                "{:<10} ".format(scenario)
+                + " ".join(
+                    "{:>{}.3f}".format(
+                        statistics.median(r[column] for r in results), len(column)
+                    )
+                    for column in columns
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
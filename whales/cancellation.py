@@ -0,0 +1,150 @@
+"""
+Module containing cooperative cancellation for API requests. The server
+creates a CancelToken for each request and cancels it when the client
+disconnects or the request runs past its deadline. The token is passed
+down through `whales.api.query` and `whales.models.run_model` into the
+models, whose long-running loops (like `minimax.minimax_helper`) check
+it regularly and raise Cancelled to abandon the work.
+
+Code that is too far down to be passed the token, like the neural net
+scheduler, can get the token of the work running in the current thread
+with `current_token`.
+"""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+# Number of seconds between checks of a token by code that waits for
+# something else to finish, like a neural net batch.
+POLL_SECONDS = 0.005
+
+# Reasons for cancelling a token.
+DISCONNECT = "disconnect"
+DEADLINE = "deadline"
+
+# Number of seconds after which an API request is cancelled, whether or
+# not the client is still waiting. Can be overridden with the
+# WHALES_REQUEST_TIMEOUT_SECONDS environment variable. By default it
+# matches the 60 second timeouts of gunicorn and the frontend, after
+# which nobody can be waiting for the response any more.
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("WHALES_REQUEST_TIMEOUT_SECONDS") or 60)
+
+
+class Cancelled(Exception):
+    """
+    Exception raised to abandon work whose CancelToken has been
+    cancelled. Its argument is the reason the token was cancelled.
+    """
+
+    pass
+
+
+class CancelToken:
+    """
+    Token that is cancelled, at most once, either explicitly with
+    `cancel` or automatically once the given deadline (a time as
+    returned by `time.monotonic`) has passed. Thread-safe.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def cancel(self, reason):
+        """
+        Cancel the token for the given reason, unless it was already
+        cancelled. Return whether this call cancelled it.
+        """
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.reason = reason
+            self.event.set()
+            return True
+
+    @property
+    def cancelled(self):
+        """
+        Whether the token has been cancelled.
+        """
+        if self.event.is_set():
+            return True
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancel(DEADLINE)
+            return True
+        return False
+
+    def check(self):
+        """
+        Raise Cancelled if the token has been cancelled.
+        """
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+
+def request_token():
+    """
+    Return a new CancelToken for an API request that starts now, with a
+    deadline REQUEST_TIMEOUT_SECONDS from now.
+    """
+    return CancelToken(deadline=time.monotonic() + REQUEST_TIMEOUT_SECONDS)
+
+
+# Token of the work running in the current thread, if any.
+CURRENT_TOKEN = contextvars.ContextVar("CURRENT_TOKEN", default=None)
+
+
+def current_token():
+    """
+    Return the CancelToken of the work running in the current thread,
+    as set by `using_token`, or None if there is none.
+    """
+    return CURRENT_TOKEN.get()
+
+
+@contextlib.contextmanager
+def using_token(token):
+    """
+    Context manager that makes the given CancelToken (or None) the token
+    returned by `current_token` while it is active.
+    """
+    reset_token = CURRENT_TOKEN.set(token)
+    try:
+        yield token
+    finally:
+        CURRENT_TOKEN.reset(reset_token)
+
+
+def wait_for_future(future, token, timeout=None):
+    """
+    Wait for the given `concurrent.futures.Future` and return its
+    result. If the given CancelToken (which may be None) is cancelled
+    first, cancel the future and raise Cancelled. If timeout is given
+    and the future isn't done within that many seconds, raise
+    `concurrent.futures.TimeoutError`, leaving the future alone.
+    """
+    if token is None:
+        return future.result(timeout=timeout)
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    while True:
+        token.check()
+        wait_seconds = POLL_SECONDS
+        if deadline is not None:
+            wait_seconds = min(wait_seconds, max(deadline - time.monotonic(), 0))
+        try:
+            return future.result(timeout=wait_seconds)
+        except concurrent.futures.TimeoutError:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise
+            continue
+        finally:
+            if token.cancelled:
+                future.cancel()
@@ -0,0 +1,134 @@
+"""
+Module containing the compute pool, the fixed set of threads that API
+requests are run on, and the batch pool, which the games of get_moves
+requests are run on. Work beyond what a pool's threads and queue can
+hold is turned away straight away, instead of everything slowing down
+together as the CPU is oversubscribed.
+"""
+
+import concurrent.futures
+import os
+import threading
+
+import whales.metrics
+
+
+class PoolFullError(Exception):
+    """
+    Exception raised when you try to submit work to a ComputePool whose
+    threads are all busy and whose queue is full.
+    """
+
+    pass
+
+
+class ComputePool:
+    """
+    Thread pool with a bounded queue. At most workers functions run at
+    once, and at most max_queued more wait for a thread; submitting any
+    more raises PoolFullError. The threads are named after the given
+    name.
+
+    The attributes completed and rejected count what has happened since
+    the pool was created.
+    """
+
+    def __init__(self, workers, max_queued, name="compute"):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        # Number of functions submitted that haven't finished (or been
+        # cancelled), and how many of those are running.
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn to be called with the given arguments on one of the
+        pool's threads, and return a `concurrent.futures.Future` for its
+        result. If the pool is full, raise PoolFullError.
+        """
+        with self.lock:
+            if self.pending >= self.workers + self.max_queued:
+                self.rejected += 1
+                raise PoolFullError
+            self.pending += 1
+
+        def run():
+            with self.lock:
+                self.running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        future = self.executor.submit(run)
+        future.add_done_callback(self.finish)
+        return future
+
+    def finish(self, future):
+        """
+        Count a future of the pool as finished, whether it ran or was
+        cancelled.
+        """
+        with self.lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def get_stats(self):
+        """
+        Return a dictionary with the number of threads in the pool, the
+        number of functions it can hold at once (running or waiting),
+        the number running and waiting (the queue depth), and the
+        counters of the pool.
+        """
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "capacity": self.workers + self.max_queued,
+                "running": self.running,
+                "queued": self.pending - self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+# Pool that the servers run API requests on. The number of threads and
+# the number of requests that may wait for one can be set with the
+# WHALES_COMPUTE_WORKERS and WHALES_COMPUTE_QUEUE environment variables.
+# By default there is one thread per CPU and up to four waiting requests
+# per thread.
+COMPUTE_WORKERS = int(os.environ.get("WHALES_COMPUTE_WORKERS") or os.cpu_count())
+COMPUTE_POOL = ComputePool(
+    COMPUTE_WORKERS,
+    int(os.environ.get("WHALES_COMPUTE_QUEUE") or 4 * COMPUTE_WORKERS),
+)
+whales.metrics.METRICS.add_collector(
+    whales.metrics.stats_collector(
+        "compute_pool", COMPUTE_POOL.get_stats, ["completed", "rejected"]
+    )
+)
+
+# Pool that the items of get_moves requests are run on, so that the
+# models of different games run at once and their neural net calls are
+# batched together (see `whales.neural_net.batching`). Items spend most
+# of their time waiting for the neural net, so by default there are 16
+# threads, whatever the number of CPUs, with room for 64 waiting items.
+# These can be set with the WHALES_BATCH_WORKERS and WHALES_BATCH_QUEUE
+# environment variables.
+BATCH_POOL = ComputePool(
+    int(os.environ.get("WHALES_BATCH_WORKERS") or 16),
+    int(os.environ.get("WHALES_BATCH_QUEUE") or 64),
+    name="batch",
+)
+whales.metrics.METRICS.add_collector(
+    whales.metrics.stats_collector(
+        "batch_pool", BATCH_POOL.get_stats, ["completed", "rejected"]
+    )
+)
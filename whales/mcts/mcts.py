@@ -0,0 +1,380 @@
+"""
+Module containing Monte Carlo tree search (MCTS) in the style of
+AlphaZero, driven by the policy and value outputs of a neural net such
+as chess_alpha_zero. Instead of scoring every leaf of a fixed-depth
+tree, the search grows the tree one position at a time towards the
+moves that look best so far, using the policy as a prior on which
+moves are worth looking at and the value to score new positions.
+
+Each playout walks down the tree from the root, choosing at every node
+the move with the highest PUCT score (see `Node.select`), until it
+reaches a position that hasn't been evaluated yet. That position is
+evaluated by the neural net, added to the tree, and its value is added
+to every node on the way back up. After the last playout, the most
+visited move at the root is played.
+
+To make good use of the neural net, playouts are run in batches: the
+leaves of several playouts are collected and evaluated with one call.
+While a playout is waiting for its leaf to be evaluated, every node on
+its path carries a "virtual loss", which makes it look worse, so that
+the other playouts in the batch spread out to other leaves instead of
+all choosing the same one.
+
+The trees below the opponent's replies to the move played can be kept
+in a `TreeStore`, so that the next search, after whichever reply they
+make, starts from what this one already found.
+"""
+
+import collections
+import math
+import threading
+import time
+
+import chess
+import numpy as np
+
+import whales.minimax_ab.minimax as minimax
+import whales.neural_net.chess_alpha_data as chess_alpha_data
+
+# Default exploration constant: how much the prior and the visit counts
+# matter compared to the values found so far.
+DEFAULT_C_PUCT = 1.5
+
+# Default number of leaves evaluated by the neural net at once.
+DEFAULT_BATCH_SIZE = 16
+
+# Default amount by which unvisited moves are assumed to be worse than
+# their parent position, so that the search looks at the moves with the
+# highest priors before trying every other move once.
+DEFAULT_FPU_REDUCTION = 0.2
+
+# Default largest number of Nodes a TreeStore keeps. Each Node takes
+# about 4 KB (mostly its list of legal moves), so this is roughly 64 MB.
+DEFAULT_MAX_NODES = 16000
+
+
+class Node:
+    """
+    Position in the search tree that has been evaluated by the neural
+    net (or where the game is over). Stores, for each legal move, its
+    prior probability, how many playouts have gone through it, and the
+    sum of their values from the point of view of the player to move at
+    this node, plus the node it leads to once that has been evaluated.
+    Not thread-safe.
+    """
+
+    def __init__(self, moves, priors, value, terminal=False):
+        self.moves = moves
+        self.priors = priors
+        # Value of the position from the point of view of the player
+        # to move, according to the neural net or the game result.
+        self.value = value
+        self.terminal = terminal
+        self.visits = np.zeros(len(moves), dtype=np.float64)
+        self.value_sums = np.zeros(len(moves), dtype=np.float64)
+        self.virtual_losses = np.zeros(len(moves), dtype=np.float64)
+        self.children = [None] * len(moves)
+
+    @property
+    def total_visits(self):
+        """
+        Number of playouts that have gone through this node, apart from
+        the one that evaluated it.
+        """
+        return float(self.visits.sum())
+
+    def mean_value(self):
+        """
+        Return the average value of the playouts through this node from
+        the point of view of the player to move, including its own
+        evaluation.
+        """
+        return (self.value + self.value_sums.sum()) / (1 + self.total_visits)
+
+    def select(self, c_puct, fpu_reduction):
+        """
+        Return the index of the move to explore next: the one with the
+        highest PUCT score, which is its average value (counting virtual
+        losses as losses) plus an exploration bonus that is larger for
+        moves with a high prior and few visits.
+        """
+        visits = self.visits + self.virtual_losses
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.where(
+                visits > 0,
+                (self.value_sums - self.virtual_losses) / visits,
+                self.mean_value() - fpu_reduction,
+            )
+        exploration = c_puct * self.priors * math.sqrt(visits.sum() + 1) / (1 + visits)
+        return int(np.argmax(values + exploration))
+
+
+def terminal_node(board, score):
+    """
+    Return a Node for a board where the game is over, given its score
+    as returned by `minimax.game_over_score`.
+    """
+    value = 0.0 if score == 0 else -1.0
+    return Node([], np.zeros(0), value, terminal=True)
+
+
+def prediction_node(board, policy, value):
+    """
+    Return a Node for a board, given the chess_alpha_zero policy and
+    value predicted for it. The priors are the policy's probabilities
+    of the legal moves, normalized to add up to one.
+    """
+    moves = list(board.legal_moves)
+    if board.turn == chess.WHITE:
+        label_index = chess_alpha_data.UCI_LABEL_INDEX
+    else:
+        label_index = chess_alpha_data.FLIPPED_UCI_LABEL_INDEX
+    priors = policy[[label_index[move.uci()] for move in moves]].astype(np.float64)
+    total = priors.sum()
+    if total > 0:
+        priors /= total
+    else:
+        priors[:] = 1 / len(moves)
+    return Node(moves, priors, float(value))
+
+
+def search(
+    board,
+    predict_fn,
+    playouts,
+    root=None,
+    deadline=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    c_puct=DEFAULT_C_PUCT,
+    fpu_reduction=DEFAULT_FPU_REDUCTION,
+    cancel_token=None,
+    stats=None,
+):
+    """
+    Run Monte Carlo tree search from board and return its root Node,
+    whose most visited move is the best move (see `best_move`).
+
+    Predict_fn takes a list of boards and returns [policies, values]
+    as `interface.NEURAL_NET_PREDICT` does. The search runs the given
+    number of playouts, or fewer if the deadline (a time as returned
+    by `time.monotonic`) passes first. If root is given, it is the Node
+    of the board from an earlier search, which is searched further.
+
+    Optionally take cancel_token, a `cancellation.CancelToken`. If it
+    is cancelled while the search is running, the search is abandoned
+    by raising `cancellation.Cancelled`.
+
+    Optionally take stats, a `collections.Counter` to which the number
+    of playouts ("nodes"), positions evaluated by the neural net
+    ("evals") and playouts that ended where the game was over
+    ("terminals") are added, and whose "depth" is set to the length of
+    the longest playout.
+
+    The board is left as it was when the search returns (or raises).
+    """
+    if stats is None:
+        stats = collections.Counter()
+    if root is None:
+        score = minimax.game_over_score(board)
+        if score is not None:
+            return terminal_node(board, score)
+        policies, values = predict_fn([board.copy(stack=False)])
+        stats["evals"] += 1
+        root = prediction_node(board, policies[0], values[0][0])
+    if root.terminal:
+        return root
+
+    done = 0
+    while done < playouts:
+        if cancel_token is not None:
+            cancel_token.check()
+        if deadline is not None and time.monotonic() > deadline:
+            break
+
+        # Paths of (node, move index) pairs from the root to each leaf
+        # to be evaluated, and copies of the leaves' boards.
+        paths = []
+        leaves = []
+        pending = set()
+        while len(paths) < min(batch_size, playouts - done):
+            path = []
+            node = root
+            while True:
+                index = node.select(c_puct, fpu_reduction)
+                path.append((node, index))
+                board.push(node.moves[index])
+                child = node.children[index]
+                if child is None or child.terminal:
+                    break
+                node = child
+            try:
+                if child is not None:
+                    # The game is over, so there's nothing to evaluate.
+                    backpropagate(path, child.value)
+                    stats["terminals"] += 1
+                elif (id(node), index) in pending:
+                    # Another playout in the batch is already waiting
+                    # for this leaf, so the batch is as spread out as
+                    # it is going to get.
+                    break
+                else:
+                    score = minimax.game_over_score(board)
+                    if score is not None:
+                        node.children[index] = terminal_node(board, score)
+                        backpropagate(path, node.children[index].value)
+                        stats["terminals"] += 1
+                    else:
+                        for path_node, path_index in path:
+                            path_node.virtual_losses[path_index] += 1
+                        pending.add((id(node), index))
+                        paths.append(path)
+                        leaves.append(board.copy(stack=False))
+                done += 1
+                stats["nodes"] += 1
+                stats["depth"] = max(stats["depth"], len(path))
+            finally:
+                for _ in path:
+                    board.pop()
+            if done >= playouts:
+                break
+
+        if leaves:
+            policies, values = predict_fn(leaves)
+            stats["evals"] += len(leaves)
+            for path, leaf, policy, value in zip(paths, leaves, policies, values):
+                for path_node, path_index in path:
+                    path_node.virtual_losses[path_index] -= 1
+                node, index = path[-1]
+                node.children[index] = prediction_node(leaf, policy, value[0])
+                backpropagate(path, node.children[index].value)
+    return root
+
+
+def backpropagate(path, value):
+    """
+    Add a playout that went down the given path of (node, move index)
+    pairs, and ended in a position with the given value from the point
+    of view of the player to move there, to the stats of every move on
+    the path.
+    """
+    for node, index in reversed(path):
+        # Each move is good for the player who made it exactly as much
+        # as the position it leads to is bad for the other player.
+        value = -value
+        node.visits[index] += 1
+        node.value_sums[index] += value
+
+
+def best_move(root):
+    """
+    Return the move to play after searching a root Node: the one with
+    the most visits, or of those, the best average value.
+    """
+    averages = root.value_sums / np.maximum(root.visits, 1)
+    index = max(range(len(root.moves)), key=lambda i: (root.visits[i], averages[i]))
+    return root.moves[index]
+
+
+class TreeStore:
+    """
+    Bounded, thread-safe store of search trees to reuse, keyed by the
+    position they were searched from. The store holds at most max_nodes
+    Nodes in all its trees together; when it would hold more, the least
+    recently stored trees are discarded.
+    """
+
+    def __init__(self, max_nodes=DEFAULT_MAX_NODES):
+        self.max_nodes = max_nodes
+        # Map from key to a tuple of the root Node of a tree and the
+        # number of Nodes in it.
+        self.trees = collections.OrderedDict()
+        self.num_nodes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def pop(self, board):
+        """
+        Remove and return the Node stored for the position of the given
+        board, or None if there is none.
+        """
+        with self.lock:
+            entry = self.trees.pop(tree_key(board), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            node, size = entry
+            self.num_nodes -= size
+            return node
+
+    def keep(self, board, root, move):
+        """
+        Store the subtrees of the given root Node (searched from the
+        given board) for the positions where the same player is to move
+        next: those after the given move and each reply to it that has
+        been searched. The subtrees don't overlap, so each can be
+        searched further by a different thread.
+        """
+        index = root.moves.index(move)
+        child = root.children[index]
+        if child is None or child.terminal:
+            return
+        board = board.copy()
+        board.push(move)
+        trees = []
+        for reply, grandchild in zip(child.moves, child.children):
+            if grandchild is not None and not grandchild.terminal:
+                size = count_nodes(grandchild)
+                # A tree too big for the whole store would only push
+                # everything else out and then be discarded itself.
+                if size <= self.max_nodes:
+                    board.push(reply)
+                    trees.append((tree_key(board), grandchild, size))
+                    board.pop()
+        with self.lock:
+            for key, node, size in trees:
+                old_entry = self.trees.pop(key, None)
+                if old_entry is not None:
+                    self.num_nodes -= old_entry[1]
+                self.trees[key] = (node, size)
+                self.num_nodes += size
+            while self.num_nodes > self.max_nodes:
+                _, (_, size) = self.trees.popitem(last=False)
+                self.num_nodes -= size
+
+    def get_stats(self):
+        """
+        Return a dictionary with the number of trees and Nodes stored,
+        and how many searches found a tree to reuse.
+        """
+        with self.lock:
+            return {
+                "trees": len(self.trees),
+                "nodes": self.num_nodes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def count_nodes(root):
+    """
+    Return the number of Nodes in the tree below (and including) the
+    given root Node.
+    """
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(child for child in node.children if child is not None)
+    return count
+
+
+def tree_key(board):
+    """
+    Return the key of the position of the given board in a TreeStore.
+    This is its FEN, which includes the move counters, so that trees
+    are only reused for the same point in the same game.
+    """
+    return board.fen()
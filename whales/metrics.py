@@ -0,0 +1,250 @@
+"""
+Module containing the telemetry that the server keeps about its work,
+such as how many nodes its searches visit, how long the neural net
+takes, and how many requests were cancelled and why. It can be read
+in the Prometheus text format, which the servers serve at `/metrics`.
+
+Metrics are counters and histograms, each identified by a name and
+optionally some labels, which are string key/value pairs that tell
+apart measurements of the same kind of event. Recording one is just
+an addition under a lock, and the text is only built when the metrics
+are scraped, so keeping them costs next to nothing when nobody is
+reading them. Code that already keeps its own statistics (such as the
+compute pool) doesn't record them twice, but registers a collector that
+reads them at scrape time.
+"""
+
+import bisect
+import collections
+import math
+import threading
+
+# Prefix of the name of every metric in the Prometheus text.
+PROMETHEUS_PREFIX = "whales_"
+
+# Content type of the Prometheus text format.
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the buckets of histograms of times, in seconds.
+SECONDS_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# Upper bounds of the buckets of histograms of neural net batch sizes.
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+# Upper bounds of the buckets of histograms of search depths.
+DEPTH_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10)
+
+
+class Histogram:
+    """
+    Distribution of observed values: the number of them at most each of
+    the given upper bounds, and their count and sum. Not thread-safe by
+    itself.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # Number of values in each bucket alone, with a last bucket for
+        # values above every bound.
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Add the given value to the histogram.
+        """
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Return a list of (upper bound, number of values at most that
+        bound) pairs, ending with infinity and the total count.
+        """
+        counts = []
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.bucket_counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class Metrics:
+    """
+    Set of counters and histograms, identified by name and labels, plus
+    collectors that report other values when the metrics are read.
+    Thread-safe.
+    """
+
+    def __init__(self):
+        # Map from (name, tuple of sorted label items) to count.
+        self.counters = collections.Counter()
+        # Map from (name, tuple of sorted label items) to Histogram.
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Add amount to the counter with the given name and labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        """
+        Add a value to the histogram with the given name and labels,
+        creating it with the given bucket upper bounds if needed.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """
+        Register a function to be called whenever the metrics are
+        rendered, which returns a list of (name, kind, labels, value)
+        tuples for values kept elsewhere. Kind is "counter" or "gauge",
+        and labels is a dictionary.
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def get_counts(self, name):
+        """
+        Return a list of (labels, count) pairs for every counter with
+        the given name, where labels is a dictionary.
+        """
+        with self.lock:
+            return [
+                (dict(labels), count)
+                for (counter_name, labels), count in sorted(self.counters.items())
+                if counter_name == name
+            ]
+
+    def render_prometheus(self):
+        """
+        Return every metric as a string in the Prometheus text format.
+        Counter names get a "_total" suffix, and every name gets
+        PROMETHEUS_PREFIX.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, histogram.cumulative_counts(), histogram.count, histogram.sum)
+                for key, histogram in self.histograms.items()
+            )
+            collectors = list(self.collectors)
+
+        # Map from full name to (kind, list of sample lines).
+        families = collections.OrderedDict()
+
+        def add_sample(name, kind, labels, value, suffix=""):
+            full_name = PROMETHEUS_PREFIX + name
+            family = families.setdefault(full_name, (kind, []))[1]
+            family.append(
+                "{}{}{} {}".format(
+                    full_name, suffix, format_labels(labels), format_value(value)
+                )
+            )
+
+        for (name, labels), count in counters:
+            add_sample(name + "_total", "counter", labels, count)
+        for (name, labels), cumulative_counts, count, total in histograms:
+            for bound, bucket_count in cumulative_counts:
+                bucket_labels = labels + (("le", format_value(bound)),)
+                add_sample(name, "histogram", bucket_labels, bucket_count, "_bucket")
+            add_sample(name, "histogram", labels, total, "_sum")
+            add_sample(name, "histogram", labels, count, "_count")
+        for collector in collectors:
+            for name, kind, labels, value in collector():
+                if kind == "counter":
+                    name += "_total"
+                add_sample(name, kind, tuple(sorted(labels.items())), value)
+
+        lines = []
+        for full_name, (kind, samples) in families.items():
+            lines.append("# TYPE {} {}".format(full_name, kind))
+            lines.extend(samples)
+        return "".join(line + "\n" for line in lines)
+
+
+def stats_collector(prefix, get_stats, counter_keys, **labels):
+    """
+    Return a collector (see `Metrics.add_collector`) that reports the
+    numbers in the dictionary returned by get_stats, with the given
+    labels. Each is named by prefix, an underscore and its key; the keys
+    in counter_keys are counters and the rest are gauges.
+    """
+
+    def collect():
+        return [
+            (
+                "{}_{}".format(prefix, key),
+                "counter" if key in counter_keys else "gauge",
+                labels,
+                value,
+            )
+            for key, value in get_stats().items()
+        ]
+
+    return collect
+
+
+def format_labels(labels):
+    """
+    Return the Prometheus text for a tuple of label items, including
+    the braces, or an empty string if there are none.
+    """
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for key, value in labels
+        )
+    )
+
+
+def format_value(value):
+    """
+    Return the Prometheus text for a number.
+    """
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+# Metrics of the server.
+METRICS = Metrics()
@@ -1,31 +1,225 @@
+import time
+
 import chess
 import numpy as np
 
+import whales.minimax_ab.transposition as transposition
+
+# Smallest halfmove clock at which a position can have occurred five
+# times: the shortest way back to a position is four plies, none of
+# which can be captures or pawn moves.
+FIVEFOLD_REPETITION_PLIES = 16
+
+
+class SearchTimeout(Exception):
+    """
+    Exception raised inside a minimax search when its deadline has
+    passed, to abandon the search.
+    """
+
+    pass
+
+
+class SearchContext:
+    """
+    Settings shared by every node of a single minimax search, so that
+    they don't all have to be passed separately through each recursive
+    call. See `minimax` for the meaning of each attribute.
+    """
+
+    def __init__(
+        self,
+        eval_fn,
+        starting_player,
+        batch_eval_fn=None,
+        table=None,
+        deadline=None,
+        ordering=None,
+        stats=None,
+        cancel_token=None,
+        lazy_eval=None,
+    ):
+        self.eval_fn = eval_fn
+        self.starting_player = starting_player
+        self.batch_eval_fn = batch_eval_fn
+        self.table = table
+        self.deadline = deadline
+        self.ordering = ordering
+        self.stats = stats
+        self.cancel_token = cancel_token
+        self.lazy_eval = lazy_eval
+
 
-def minimax(board, eval_fn, max_depth):
+def game_over_score(board):
+    """
+    Return the score of the board if the game is over (100 if White has
+    won, -100 if Black has won and 0 for a draw), or None if it is not.
+
+    This gives the same answer as `chess.Board.is_game_over` and
+    `chess.Board.result`, but is much cheaper for positions where the
+    game is not over, which is almost all of them: it stops at the first
+    legal move instead of generating them all, and only looks for a
+    fivefold repetition when the halfmove clock allows one.
+    """
+    if not any(board.generate_legal_moves()):
+        if board.is_check():
+            # Checkmate: the player to move has lost.
+            return -100 if board.turn == chess.WHITE else 100
+        # Stalemate.
+        return 0
+    if (
+        board.is_insufficient_material()
+        or board.halfmove_clock >= 150
+        or (
+            board.halfmove_clock >= FIVEFOLD_REPETITION_PLIES
+            and board.is_fivefold_repetition()
+        )
+    ):
+        return 0
+    return None
+
+
+def minimax(
+    board,
+    eval_fn,
+    max_depth,
+    batch_eval_fn=None,
+    table=None,
+    deadline=None,
+    ordering=None,
+    stats=None,
+    cancel_token=None,
+    lazy_eval=None,
+):
     """
     Perform minimax search with alpha/beta pruning through board up
     to a depth of max_depth.
 
     Take in a board with the current game state, an evaluation function
     called when depth is reached, and a max depth.
-    """
-    starting_player = board.turn
 
-    return minimax_helper(
-        board, eval_fn, max_depth, 0, float("-inf"), float("inf"), starting_player
+    Optionally take batch_eval_fn, a function that takes a list of
+    boards and returns a list with the value eval_fn would return for
+    each of them. If it is given, all the leaves that are children of
+    the same node are scored with a single call to batch_eval_fn rather
+    than one call to eval_fn each. The result of the search is the
+    same, but evaluation functions with a large per-call overhead (like
+    neural nets) run much faster, at the cost of also scoring leaves
+    that alpha/beta pruning would have skipped.
+
+    Optionally take table, a `transposition.TranspositionTable` in which
+    to look up and store the results of searching interior nodes. The
+    same table may be reused across searches, but only by searches that
+    use the same evaluation function. The best move stored for a node
+    is searched first, which makes pruning more effective.
+
+    Optionally take deadline, a time as returned by `time.monotonic`.
+    If the search is still running at that time, it is abandoned by
+    raising SearchTimeout.
+
+    Optionally take ordering, an `ordering.MoveOrdering` used to decide
+    which moves to search first at each node. Otherwise moves are
+    searched in the order python-chess generates them.
+
+    Optionally take stats, a `collections.Counter` to which the number
+    of nodes visited ("nodes"), leaves evaluated ("evals"), nodes where
+    the game was over ("terminals") and nodes cut off by alpha/beta
+    pruning ("cutoffs") by the search are added. Leaves scored by lazy
+    evaluation (see below) are counted in "lazy_evals" instead of
+    "evals".
+
+    Optionally take cancel_token, a `cancellation.CancelToken`. If it
+    is cancelled while the search is running, the search is abandoned
+    by raising `cancellation.Cancelled`.
+
+    Optionally take lazy_eval, a `static_eval.LazyEval`, to skip the
+    evaluation function at leaves whose cheap static score shows that
+    they can't fall inside the alpha/beta window; such a leaf is
+    scored with the bound of its static score instead. This requires
+    eval_fn to score boards from -1 to 1, and makes the result differ
+    from a full search wherever the static score is off by more than
+    the margin.
+
+    The search makes and unmakes moves on board itself rather than
+    copying it, and leaves it as it was when it returns (or raises).
+    So eval_fn and the functions of ordering are passed a board that
+    changes after they return, and must not keep it. The boards passed
+    to batch_eval_fn are copies of the position only, without the moves
+    that led to it.
+    """
+    context = SearchContext(
+        eval_fn,
+        board.turn,
+        batch_eval_fn=batch_eval_fn,
+        table=table,
+        deadline=deadline,
+        ordering=ordering,
+        stats=stats,
+        cancel_token=cancel_token,
+        lazy_eval=lazy_eval,
     )
 
+    return minimax_helper(board, context, max_depth, 0, float("-inf"), float("inf"))
+
 
-def minimax_helper(board, eval_fn, max_depth, curr_depth, alpha, beta, starting_player):
+def minimax_iterative(
+    board, eval_fn, max_depth, time_limit=None, table=None, search_fn=None, **kwargs
+):
+    """
+    Perform minimax search (see `minimax`) to depth 1, then depth 2,
+    and so on up to max_depth, stopping early once time_limit seconds
+    have passed. Return the result of the deepest search that finished.
+    Cancelling the cancel_token passed in the keyword arguments, unlike
+    running out of time, abandons the whole search.
+
+    The searches share a transposition table (a temporary one is used
+    if table is not given), so each search tries the best moves found
+    by the previous ones first. The depth 1 search is always allowed to
+    finish, so that there is a move to return no matter how small
+    time_limit is.
+
+    Each search is done with search_fn, which defaults to `minimax` and
+    must take the same arguments (for example, `functools.partial`
+    applied to `parallel.minimax_parallel`). Any other keyword arguments
+    are passed on to search_fn. If they include stats, its "depth" is
+    set to the depth of the deepest search that finished.
+    """
+    if search_fn is None:
+        search_fn = minimax
+    deadline = None
+    if time_limit is not None:
+        deadline = time.monotonic() + time_limit
+    if table is None:
+        table = transposition.TranspositionTable()
+
+    stats = kwargs.get("stats")
+
+    result = search_fn(board, eval_fn, min(max_depth, 1), table=table, **kwargs)
+    if stats is not None:
+        stats["depth"] = min(max_depth, 1)
+    for depth in range(2, max_depth + 1):
+        try:
+            result = search_fn(
+                board, eval_fn, depth, table=table, deadline=deadline, **kwargs
+            )
+        except SearchTimeout:
+            break
+        if stats is not None:
+            stats["depth"] = depth
+    return result
+
+
+def minimax_helper(board, context, max_depth, curr_depth, alpha, beta):
     """
     Perform minimax search with alpha/beta pruning through board up
     to a depth of max_depth.
 
-    Take in a board with the current game state, a max depth, a current
-    depth, alpha and beta for pruning, an evaluation function called
-    when depth is reached, and a starting player.
+    Take in a board with the current game state, a SearchContext, a max
+    depth, a current depth, and alpha and beta for pruning.
     """
+    eval_fn = context.eval_fn
+    batch_eval_fn = context.batch_eval_fn
+    starting_player = context.starting_player
 
     curr_agent = board.turn
 
@@ -35,36 +229,89 @@ def minimax_helper(board, eval_fn, max_depth, curr_depth, alpha, beta, starting_
     # flip that.
     multiplier = 1 if starting_player == chess.WHITE else -1
 
-    if board.is_game_over():
-        result = board.result()
+    if context.deadline is not None and time.monotonic() > context.deadline:
+        raise SearchTimeout
 
-        score = 0
+    if context.cancel_token is not None:
+        context.cancel_token.check()
 
-        # Strongly prioritize/deprioritize checkmate boards.
-
-        if result == "1-0":
-            # This is the case where White has won.
-            score = 100
-        elif result == "0-1":
-            # This is the case where Black has won.
-            score = -100
-        else:
-            # This is the case where the game is a draw. Here, assign
-            # a score of 0 because a tie is better than a black win.
-            score = 0
+    if context.stats is not None:
+        context.stats["nodes"] += 1
 
+    # Strongly prioritize/deprioritize checkmate boards. A draw scores
+    # 0, because a tie is better than a loss.
+    score = game_over_score(board)
+    if score is not None:
+        if context.stats is not None:
+            context.stats["terminals"] += 1
         return (multiplier * score, None)
 
     if curr_depth >= max_depth:
-        # If at a leaf node, evaluate the board.
+        # If at a leaf node, evaluate the board, unless it can't matter.
+        if context.lazy_eval is not None:
+            low, high = context.lazy_eval.bounds([board])[0]
+            bound = window_bound(multiplier, low, high, alpha, beta)
+            if bound is not None:
+                if context.stats is not None:
+                    context.stats["lazy_evals"] += 1
+                return (bound, None)
+        if context.stats is not None:
+            context.stats["evals"] += 1
         return (multiplier * eval_fn(board), None)
 
+    # Number of plies that will be searched below this node, which is
+    # how entries in the transposition table are compared.
+    remaining_depth = max_depth - curr_depth
+
+    key = None
+    entry = None
+    if context.table is not None:
+        key = transposition.position_key(board)
+        entry = context.table.lookup(key)
+        if entry is not None and entry.depth >= remaining_depth:
+            # Scores in the table are from White's point of view, so
+            # convert to the point of view of the starting player,
+            # which also swaps lower and upper bounds for Black.
+            score = multiplier * entry.score
+            bound = entry.bound
+            if multiplier == -1:
+                bound = transposition.flip_bound(bound)
+            # Use the stored result only where searching the node again
+            # would give the same answer. At the root we also need a
+            # move to return.
+            if bound == transposition.EXACT and (
+                curr_depth > 0 or entry.move is not None
+            ):
+                return (score, entry.move)
+            if bound == transposition.LOWER and score > beta and curr_depth > 0:
+                return (score, entry.move)
+            if bound == transposition.UPPER and score < alpha and curr_depth > 0:
+                return (score, entry.move)
+
+    # Remember the original window, to tell afterwards whether the
+    # score we find is exact or just a bound.
+    orig_alpha = alpha
+    orig_beta = beta
+
     # If it is the starting player's turn, maximize.
     is_maximizing = curr_agent == starting_player
     is_minimizing = not is_maximizing
 
     legal_actions = list(board.legal_moves)
 
+    # Search the best move from an earlier search of this position
+    # first, since it is likely to be best again and lets us prune more.
+    hash_move = None
+    if entry is not None:
+        hash_move = entry.move
+    if context.ordering is not None:
+        legal_actions = context.ordering.order_moves(
+            board, legal_actions, curr_depth, remaining_depth, hash_move=hash_move
+        )
+    elif hash_move in legal_actions:
+        legal_actions.remove(hash_move)
+        legal_actions.insert(0, hash_move)
+
     best_action = None
     v = 0
 
@@ -73,17 +320,65 @@ def minimax_helper(board, eval_fn, max_depth, curr_depth, alpha, beta, starting_
     else:
         v = float("inf")
 
+    # If the children are leaves, score all of them up front with one
+    # call to the batch evaluation function. Children where the game is
+    # over are left out, since they are scored by the result instead.
+    leaf_vals = {}
+    if batch_eval_fn is not None and curr_depth + 1 >= max_depth:
+        leaf_indices = []
+        leaves = []
+        for i, action in enumerate(legal_actions):
+            board.push(action)
+            if game_over_score(board) is None:
+                leaf_indices.append(i)
+                # The leaves are evaluated after the moves are unmade,
+                # so they need copies, but only of the position.
+                leaves.append(board.copy(stack=False))
+            board.pop()
+        if context.stats is not None:
+            context.stats["nodes"] += len(leaves)
+        if leaves and context.lazy_eval is not None:
+            # The window only narrows as the children are searched, so
+            # leaves outside it now would still be outside it when
+            # their turn came.
+            eval_indices = []
+            eval_leaves = []
+            for i, leaf, (low, high) in zip(
+                leaf_indices, leaves, context.lazy_eval.bounds(leaves)
+            ):
+                bound = window_bound(multiplier, low, high, alpha, beta)
+                if bound is None:
+                    eval_indices.append(i)
+                    eval_leaves.append(leaf)
+                else:
+                    leaf_vals[i] = bound
+            if context.stats is not None:
+                context.stats["lazy_evals"] += len(leaves) - len(eval_leaves)
+            leaf_indices = eval_indices
+            leaves = eval_leaves
+        if context.stats is not None:
+            context.stats["evals"] += len(leaves)
+        if leaves:
+            for i, val in zip(leaf_indices, batch_eval_fn(leaves)):
+                leaf_vals[i] = multiplier * val
+
     for i in range(len(legal_actions)):
         action = legal_actions[i]
 
-        # Simulate the move to pass to children.
-        successor = board.copy()
-        successor.push(action)
-
-        # Recurse with same parameters, except one level deeper.
-        successor_val = minimax_helper(
-            successor, eval_fn, max_depth, curr_depth + 1, alpha, beta, starting_player
-        )[0]
+        if i in leaf_vals:
+            successor_val = leaf_vals[i]
+        else:
+            # Simulate the move to pass to children, and take it back
+            # afterwards even if the search is abandoned, since the
+            # caller still owns the board.
+            board.push(action)
+            try:
+                # Recurse with same parameters, except one level deeper.
+                successor_val = minimax_helper(
+                    board, context, max_depth, curr_depth + 1, alpha, beta
+                )[0]
+            finally:
+                board.pop()
 
         if (successor_val > v and is_maximizing) or (
             successor_val < v and is_minimizing
@@ -92,9 +387,16 @@ def minimax_helper(board, eval_fn, max_depth, curr_depth, alpha, beta, starting_
             v = successor_val
 
         # Here is the pruning case, stop considering branch. The move
-        # chosen doesn't matter here; it will not be used.
+        # chosen doesn't matter to our caller, but it is remembered in
+        # the transposition table.
         if (v > beta and is_maximizing) or (v < alpha and is_minimizing):
-            return (v, best_action)
+            if context.stats is not None:
+                context.stats["cutoffs"] += 1
+            if context.ordering is not None:
+                context.ordering.record_cutoff(
+                    board, action, curr_depth, remaining_depth
+                )
+            break
 
         # Update parameters for pruning.
         if is_maximizing:
@@ -102,5 +404,36 @@ def minimax_helper(board, eval_fn, max_depth, curr_depth, alpha, beta, starting_
         else:
             beta = min(beta, v)
 
+    if context.table is not None:
+        # Whether maximizing or minimizing, a score below the original
+        # window is an upper bound (we either failed low or pruned) and
+        # a score above it is a lower bound.
+        if v < orig_alpha:
+            bound = transposition.UPPER
+        elif v > orig_beta:
+            bound = transposition.LOWER
+        else:
+            bound = transposition.EXACT
+        if multiplier == -1:
+            bound = transposition.flip_bound(bound)
+        context.table.store(key, remaining_depth, bound, multiplier * v, best_action)
+
     # Return most optimized child's value along with action to take.
     return (v, best_action)
+
+
+def window_bound(multiplier, low, high, alpha, beta):
+    """
+    Given bounds low and high on the score of a leaf from White's point
+    of view, and the alpha/beta window from the point of view of the
+    starting player (whose multiplier is given, as in
+    `minimax_helper`), return the bound to score the leaf with if it
+    lies entirely outside the window, or None if it may lie inside.
+    """
+    if multiplier == -1:
+        low, high = -high, -low
+    if high < alpha:
+        return high
+    if low > beta:
+        return low
+    return None
@@ -0,0 +1,115 @@
+"""
+Module containing move ordering heuristics for minimax search. Alpha/beta
+pruning cuts off the most when the best move at each node is searched
+first, so the moves at each node are sorted by how promising they look
+before they are searched.
+"""
+
+import collections
+
+import chess
+
+# Number of killer moves remembered for each ply.
+NUM_KILLERS = 2
+
+# Rough value of each kind of piece, used to search captures of more
+# valuable pieces by less valuable pieces first.
+PIECE_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 100,
+}
+
+
+class MoveOrdering:
+    """
+    Move ordering state for minimax search. The same object should be
+    used for every node of a search, and may be reused by later searches
+    of the same position (such as the iterations of iterative
+    deepening), but not shared between threads.
+
+    If a policy function is given, it is used to order the moves of
+    nodes with at least policy_min_depth plies left to search below
+    them. The policy function takes a python-chess Board and returns a
+    dictionary mapping legal moves to their probability of being best
+    (for example, the policy output of a neural net); the most probable
+    moves are searched first.
+
+    All other nodes use heuristics learned during the search: captures
+    first (most valuable victim first, then least valuable attacker),
+    then the killer moves for the ply (quiet moves that recently caused
+    a cutoff at the same ply), then the remaining moves by their history
+    score (how much search they have saved by causing cutoffs anywhere
+    in the tree).
+    """
+
+    def __init__(self, policy_fn=None, policy_min_depth=2):
+        self.policy_fn = policy_fn
+        self.policy_min_depth = policy_min_depth
+        # Map from ply to list of killer moves, most recent first.
+        self.killers = collections.defaultdict(list)
+        # Map from (color, from square, to square) to history score.
+        self.history = collections.defaultdict(int)
+
+    def order_moves(self, board, moves, ply, remaining_depth, hash_move=None):
+        """
+        Return a new list with the given legal moves of the given board
+        sorted so that the most promising are first. The board is ply
+        plies below the root of the search and has remaining_depth plies
+        left to search below it. If hash_move is given and legal, it is
+        always put first.
+        """
+        priors = None
+        if self.policy_fn is not None and remaining_depth >= self.policy_min_depth:
+            priors = self.policy_fn(board)
+
+        if priors is not None:
+
+            def sort_key(move):
+                return -priors.get(move, 0)
+
+        else:
+            killers = self.killers.get(ply, [])
+
+            def sort_key(move):
+                if board.is_capture(move):
+                    if board.is_en_passant(move):
+                        victim = chess.PAWN
+                    else:
+                        victim = board.piece_type_at(move.to_square)
+                    attacker = board.piece_type_at(move.from_square)
+                    return (0, -PIECE_VALUES[victim], PIECE_VALUES[attacker])
+                if move in killers:
+                    return (1, killers.index(move), 0)
+                key = (board.turn, move.from_square, move.to_square)
+                return (2, -self.history.get(key, 0), 0)
+
+        # Sorting is stable, so moves that look equally promising stay
+        # in the order python-chess generated them.
+        ordered = sorted(moves, key=sort_key)
+        if hash_move is not None and hash_move in ordered:
+            ordered.remove(hash_move)
+            ordered.insert(0, hash_move)
+        return ordered
+
+    def record_cutoff(self, board, move, ply, remaining_depth):
+        """
+        Record that searching the given move of the given board (which
+        is ply plies below the root and has remaining_depth plies left
+        to search below it) caused the rest of its siblings to be
+        pruned.
+        """
+        # Captures are already searched early, so the killer and history
+        # heuristics only track quiet moves.
+        if board.is_capture(move):
+            return
+        killers = self.killers[ply]
+        if move in killers:
+            killers.remove(move)
+        killers.insert(0, move)
+        del killers[NUM_KILLERS:]
+        key = (board.turn, move.from_square, move.to_square)
+        self.history[key] += remaining_depth * remaining_depth
@@ -0,0 +1,301 @@
+"""
+Module containing a parallel version of minimax search, which splits the
+moves at the root of the tree between the workers of an executor.
+
+The first root move (the most promising one, after move ordering) is
+searched on its own to get a good alpha value, then the rest are
+searched at the same time, each with the best value known when it
+starts as its alpha. Because pruning in `minimax.minimax_helper` only
+happens on strict inequalities, every root move whose true value is the
+best is still scored exactly, and every other move scores strictly less,
+so taking the first best move in order gives the same move as the serial
+search.
+
+Thread executors work with any evaluation function, and are the right
+choice for neural nets: onnxruntime releases the GIL while it runs, and
+the leaves of all the workers are batched together by
+`whales.neural_net.batching`. Process executors also parallelize the
+Python side of the search, but need their functions registered with
+`register_process_functions` before the worker processes are started,
+and should only be used with evaluation functions that are safe to call
+after a fork (which onnxruntime is not).
+
+Cancelling a search stops thread workers at their next node, since they
+share the search's `cancellation.CancelToken`. Process workers can't
+share it, so their root moves are cancelled if they haven't started,
+and otherwise left to finish while the search itself stops waiting.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+
+import chess
+
+import whales.cancellation as cancellation
+import whales.minimax_ab.minimax as minimax
+from whales.minimax_ab.ordering import MoveOrdering
+import whales.minimax_ab.transposition as transposition
+
+# Map from name to dictionary of search functions ("eval_fn",
+# "batch_eval_fn", "policy_fn" and "lazy_eval"), for worker processes to
+# look up.
+# Worker processes inherit it when they are forked.
+PROCESS_FUNCTIONS = {}
+
+
+def register_process_functions(
+    name, eval_fn, batch_eval_fn=None, policy_fn=None, lazy_eval=None
+):
+    """
+    Register search functions (and the lazy evaluation settings, see
+    `minimax.minimax`) under the given name, so that they can be used
+    by `minimax_parallel` with a process executor created afterwards by
+    `make_executor`.
+    """
+    PROCESS_FUNCTIONS[name] = {
+        "eval_fn": eval_fn,
+        "batch_eval_fn": batch_eval_fn,
+        "policy_fn": policy_fn,
+        "lazy_eval": lazy_eval,
+    }
+
+
+def make_executor(workers, kind="thread"):
+    """
+    Return a new executor with the given number of workers, suitable for
+    `minimax_parallel`. Kind is either "thread" or "process". Process
+    executors fork their workers, which inherit every function
+    registered with `register_process_functions` up to the time each
+    worker is started.
+    """
+    if kind == "thread":
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="minimax"
+        )
+    if kind == "process":
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        )
+    raise ValueError("unknown executor kind {}".format(repr(kind)))
+
+
+def search_root_move(
+    board,
+    max_depth,
+    alpha,
+    starting_player,
+    functions,
+    table,
+    deadline,
+    cancel_token=None,
+):
+    """
+    Search the given board, which is one move below the root of a
+    minimax search started by starting_player, and return a tuple of its
+    score and a Counter of the search's stats.
+
+    Functions is either a dictionary of search functions (as registered
+    with `register_process_functions`) or the name they were registered
+    under. Alpha is either a number or a list whose first element is
+    read when the search starts, so that threads can see the best score
+    found so far. Cancel_token is the CancelToken of the search, which
+    is also made the current token (see `cancellation.current_token`)
+    for the neural net to check while this thread waits for it.
+    """
+    if isinstance(functions, str):
+        functions = PROCESS_FUNCTIONS[functions]
+    if isinstance(alpha, list):
+        alpha = alpha[0]
+    stats = collections.Counter()
+    context = minimax.SearchContext(
+        functions["eval_fn"],
+        starting_player,
+        batch_eval_fn=functions["batch_eval_fn"],
+        table=table,
+        deadline=deadline,
+        ordering=MoveOrdering(policy_fn=functions["policy_fn"]),
+        stats=stats,
+        cancel_token=cancel_token,
+        lazy_eval=functions["lazy_eval"],
+    )
+    with cancellation.using_token(cancel_token):
+        score, _ = minimax.minimax_helper(
+            board, context, max_depth, 1, alpha, float("inf")
+        )
+    return score, stats
+
+
+def minimax_parallel(
+    board,
+    eval_fn,
+    max_depth,
+    executor,
+    batch_eval_fn=None,
+    table=None,
+    deadline=None,
+    ordering=None,
+    stats=None,
+    process_functions=None,
+    cancel_token=None,
+    lazy_eval=None,
+):
+    """
+    Perform minimax search like `minimax.minimax`, taking the same
+    arguments and returning the same result, but searching the root
+    moves in parallel on the given executor (see `make_executor`).
+
+    If the executor is a process executor, process_functions must be
+    the name that the search functions were registered under with
+    `register_process_functions`. Worker processes don't share the
+    transposition table; each uses the copy it inherited when it was
+    forked.
+
+    Every root move after the first is searched with a fresh
+    `MoveOrdering`, since they are not safe to share between
+    threads. The given ordering is used for the root and the first move.
+    """
+    # Searches too shallow to split, and boards with no moves to split,
+    # are done serially.
+    if max_depth < 2 or minimax.game_over_score(board) is not None:
+        return minimax.minimax(
+            board,
+            eval_fn,
+            max_depth,
+            batch_eval_fn=batch_eval_fn,
+            table=table,
+            deadline=deadline,
+            ordering=ordering,
+            stats=stats,
+            cancel_token=cancel_token,
+            lazy_eval=lazy_eval,
+        )
+
+    starting_player = board.turn
+    multiplier = 1 if starting_player == chess.WHITE else -1
+    if stats is not None:
+        stats["nodes"] += 1
+
+    # Look up and order the root exactly like the serial search does,
+    # so that both search the root moves in the same order.
+    key = None
+    hash_move = None
+    if table is not None:
+        key = transposition.position_key(board)
+        entry = table.lookup(key)
+        if entry is not None:
+            hash_move = entry.move
+            if (
+                entry.depth >= max_depth
+                and entry.bound == transposition.EXACT
+                and entry.move is not None
+            ):
+                return (multiplier * entry.score, entry.move)
+    moves = list(board.legal_moves)
+    if ordering is not None:
+        moves = ordering.order_moves(board, moves, 0, max_depth, hash_move=hash_move)
+    elif hash_move in moves:
+        moves.remove(hash_move)
+        moves.insert(0, hash_move)
+
+    context = minimax.SearchContext(
+        eval_fn,
+        starting_player,
+        batch_eval_fn=batch_eval_fn,
+        table=table,
+        deadline=deadline,
+        ordering=ordering,
+        stats=stats,
+        cancel_token=cancel_token,
+        lazy_eval=lazy_eval,
+    )
+    board.push(moves[0])
+    try:
+        first_score, _ = minimax.minimax_helper(
+            board, context, max_depth, 1, float("-inf"), float("inf")
+        )
+    finally:
+        board.pop()
+
+    if process_functions is not None:
+        functions = process_functions
+        alpha = first_score
+        shared_table = None
+        shared_token = None
+    else:
+        functions = {
+            "eval_fn": eval_fn,
+            "batch_eval_fn": batch_eval_fn,
+            "policy_fn": ordering.policy_fn if ordering is not None else None,
+            "lazy_eval": lazy_eval,
+        }
+        alpha = [first_score]
+        shared_table = table
+        shared_token = cancel_token
+
+    futures = []
+    for move in moves[1:]:
+        successor = board.copy()
+        successor.push(move)
+        futures.append(
+            executor.submit(
+                search_root_move,
+                successor,
+                max_depth,
+                alpha,
+                starting_player,
+                functions,
+                shared_table,
+                deadline,
+                shared_token,
+            )
+        )
+
+    future_scores = {}
+    not_done = set(futures)
+    try:
+        while not_done:
+            # Wake up regularly to check for cancellation, which process
+            # workers can't do themselves.
+            done, not_done = concurrent.futures.wait(
+                not_done,
+                timeout=None if cancel_token is None else cancellation.POLL_SECONDS,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if cancel_token is not None:
+                cancel_token.check()
+            for future in done:
+                score, task_stats = future.result()
+                future_scores[future] = score
+                if stats is not None:
+                    stats.update(task_stats)
+                # Let root moves that haven't started yet use the best
+                # score found so far as their alpha.
+                if isinstance(alpha, list) and score > alpha[0]:
+                    alpha[0] = score
+    except BaseException:
+        # Don't leave the rest of the root moves running, for example
+        # when one of them has run past the deadline or the search has
+        # been cancelled.
+        for future in futures:
+            future.cancel()
+        raise
+    scores = [first_score] + [future_scores[future] for future in futures]
+
+    # Take the first best move, as the serial search does.
+    best_score = float("-inf")
+    best_move = None
+    for move, score in zip(moves, scores):
+        if score > best_score:
+            best_score = score
+            best_move = move
+
+    if table is not None:
+        table.store(
+            key,
+            max_depth,
+            transposition.EXACT,
+            multiplier * best_score,
+            best_move,
+        )
+    return (best_score, best_move)
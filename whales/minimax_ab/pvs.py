@@ -0,0 +1,303 @@
+"""
+Module containing principal variation search (PVS), an alternative to
+the plain alpha/beta search of `minimax.minimax` that finds the same
+scores while visiting fewer nodes.
+
+The search is written in negamax form: every node scores the position
+from the point of view of the player to move, and negates the scores of
+its children, so maximizing and minimizing nodes are the same code.
+The first move of each node (the most promising one, after move
+ordering) is searched with the full alpha/beta window. Every other move
+is first searched with a null window, which only answers whether it is
+better than the best move so far and is much cheaper; only moves that
+turn out to be better are searched again with the full window. Cutoffs
+happen as soon as a score reaches beta, rather than exceeding it.
+
+On top of that, `pvs` starts with an aspiration window around the score
+of the previous, shallower search of the same position (found in the
+transposition table, as left by `minimax.minimax_iterative`), and only
+widens it if the true score turns out to lie outside it.
+"""
+
+import time
+
+import chess
+import numpy as np
+
+import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.transposition as transposition
+
+# Half the width of the first aspiration window, in the units of the
+# evaluation function. Each time the score falls outside the window,
+# the side it fell out of is made ASPIRATION_GROWTH times wider, and
+# after ASPIRATION_TRIES windows the search falls back to a full one.
+ASPIRATION_WINDOW = 0.1
+ASPIRATION_GROWTH = 4
+ASPIRATION_TRIES = 3
+
+
+def null_window_beta(alpha):
+    """
+    Return the beta of the null window above alpha: the smallest number
+    larger than alpha, so that a search with that window fails high
+    exactly when the score is larger than alpha.
+    """
+    return np.nextafter(alpha, np.inf)
+
+
+def pvs(
+    board,
+    eval_fn,
+    max_depth,
+    batch_eval_fn=None,
+    table=None,
+    deadline=None,
+    ordering=None,
+    stats=None,
+    cancel_token=None,
+    lazy_eval=None,
+    aspiration_window=ASPIRATION_WINDOW,
+):
+    """
+    Perform principal variation search through board up to a depth of
+    max_depth, and return a tuple of the score from the point of view
+    of the player to move and the best move, like `minimax.minimax`.
+    Takes the same arguments, with the same meaning, and so can be used
+    as the search_fn of `minimax.minimax_iterative`. Stats also get the
+    number of null window searches that had to be repeated with the
+    full window ("researches"), and of aspiration windows that the
+    score fell outside of ("aspiration_fails").
+
+    If table has an exact score for the board from an earlier search,
+    the search starts with a window aspiration_window either side of
+    that score. Pass an aspiration_window of None to always search with
+    the full window.
+
+    Without lazy evaluation or a deadline, the score is exactly the
+    score `minimax.minimax` would return. The move has that score too,
+    but may be a different one when several moves are equally good,
+    since the two searches order moves differently.
+    """
+    context = minimax.SearchContext(
+        eval_fn,
+        board.turn,
+        batch_eval_fn=batch_eval_fn,
+        table=table,
+        deadline=deadline,
+        ordering=ordering,
+        stats=stats,
+        cancel_token=cancel_token,
+        lazy_eval=lazy_eval,
+    )
+
+    guess = None
+    if table is not None and aspiration_window is not None:
+        entry = table.lookup(transposition.position_key(board))
+        if entry is not None and entry.bound == transposition.EXACT:
+            color = 1 if board.turn == chess.WHITE else -1
+            guess = color * entry.score
+    if guess is None:
+        return pvs_helper(board, context, max_depth, 0, float("-inf"), float("inf"))
+
+    below = above = aspiration_window
+    for _ in range(ASPIRATION_TRIES):
+        alpha = guess - below
+        beta = guess + above
+        score, move = pvs_helper(board, context, max_depth, 0, alpha, beta)
+        if alpha < score < beta:
+            return (score, move)
+        if stats is not None:
+            stats["aspiration_fails"] += 1
+        if score <= alpha:
+            below *= ASPIRATION_GROWTH
+        else:
+            above *= ASPIRATION_GROWTH
+    return pvs_helper(board, context, max_depth, 0, float("-inf"), float("inf"))
+
+
+def pvs_helper(board, context, max_depth, curr_depth, alpha, beta):
+    """
+    Perform principal variation search through board up to a depth of
+    max_depth, and return a tuple of the score from the point of view of
+    the player to move and the best move (None at leaves).
+
+    Take in a board with the current game state, a SearchContext, a max
+    depth, a current depth, and alpha and beta for pruning, from the
+    point of view of the player to move. The score is fail-soft: if it
+    is at most alpha it is an upper bound on the true score, and if it
+    is at least beta it is a lower bound.
+    """
+    # Multiply scores from White's point of view by this to get them
+    # from the point of view of the player to move.
+    color = 1 if board.turn == chess.WHITE else -1
+
+    if context.deadline is not None and time.monotonic() > context.deadline:
+        raise minimax.SearchTimeout
+
+    if context.cancel_token is not None:
+        context.cancel_token.check()
+
+    if context.stats is not None:
+        context.stats["nodes"] += 1
+
+    score = minimax.game_over_score(board)
+    if score is not None:
+        if context.stats is not None:
+            context.stats["terminals"] += 1
+        return (color * score, None)
+
+    if curr_depth >= max_depth:
+        if context.lazy_eval is not None:
+            low, high = context.lazy_eval.bounds([board])[0]
+            bound = minimax.window_bound(color, low, high, alpha, beta)
+            if bound is not None:
+                if context.stats is not None:
+                    context.stats["lazy_evals"] += 1
+                return (bound, None)
+        if context.stats is not None:
+            context.stats["evals"] += 1
+        return (color * context.eval_fn(board), None)
+
+    remaining_depth = max_depth - curr_depth
+
+    key = None
+    entry = None
+    if context.table is not None:
+        key = transposition.position_key(board)
+        entry = context.table.lookup(key)
+        if entry is not None and entry.depth >= remaining_depth:
+            score = color * entry.score
+            bound = entry.bound
+            if color == -1:
+                bound = transposition.flip_bound(bound)
+            # At the root we also need a move to return.
+            if bound == transposition.EXACT and (
+                curr_depth > 0 or entry.move is not None
+            ):
+                return (score, entry.move)
+            if bound == transposition.LOWER and score >= beta and curr_depth > 0:
+                return (score, entry.move)
+            if bound == transposition.UPPER and score <= alpha and curr_depth > 0:
+                return (score, entry.move)
+
+    orig_alpha = alpha
+
+    moves = list(board.legal_moves)
+    hash_move = None
+    if entry is not None:
+        hash_move = entry.move
+    if context.ordering is not None:
+        moves = context.ordering.order_moves(
+            board, moves, curr_depth, remaining_depth, hash_move=hash_move
+        )
+    elif hash_move in moves:
+        moves.remove(hash_move)
+        moves.insert(0, hash_move)
+
+    # If the children are leaves, score them all up front, as
+    # `minimax.minimax_helper` does. Their scores don't depend on the
+    # window, so they are never searched again.
+    leaf_scores = {}
+    if context.batch_eval_fn is not None and curr_depth + 1 >= max_depth:
+        leaf_scores = batch_leaf_scores(board, moves, context, color, alpha, beta)
+
+    best_score = float("-inf")
+    best_move = None
+    for i, move in enumerate(moves):
+        if i in leaf_scores:
+            score = leaf_scores[i]
+        else:
+            board.push(move)
+            try:
+                if best_move is None:
+                    score = -pvs_helper(
+                        board, context, max_depth, curr_depth + 1, -beta, -alpha
+                    )[0]
+                else:
+                    # Only check whether the move is better than the
+                    # best so far, and if so, find out by how much.
+                    score = -pvs_helper(
+                        board,
+                        context,
+                        max_depth,
+                        curr_depth + 1,
+                        -null_window_beta(alpha),
+                        -alpha,
+                    )[0]
+                    if alpha < score < beta:
+                        if context.stats is not None:
+                            context.stats["researches"] += 1
+                        score = -pvs_helper(
+                            board, context, max_depth, curr_depth + 1, -beta, -alpha
+                        )[0]
+            finally:
+                board.pop()
+
+        if score > best_score:
+            best_score = score
+            best_move = move
+        if score > alpha:
+            alpha = score
+        if alpha >= beta:
+            if context.stats is not None:
+                context.stats["cutoffs"] += 1
+            if context.ordering is not None:
+                context.ordering.record_cutoff(board, move, curr_depth, remaining_depth)
+            break
+
+    if context.table is not None:
+        if best_score <= orig_alpha:
+            bound = transposition.UPPER
+        elif best_score >= beta:
+            bound = transposition.LOWER
+        else:
+            bound = transposition.EXACT
+        if color == -1:
+            bound = transposition.flip_bound(bound)
+        context.table.store(key, remaining_depth, bound, color * best_score, best_move)
+
+    return (best_score, best_move)
+
+
+def batch_leaf_scores(board, moves, context, color, alpha, beta):
+    """
+    Return a dictionary mapping the index of each of the given moves of
+    the board that leads to a leaf (where the game is not over) to its
+    score from the point of view of the player to move on the board,
+    scoring them all with one call to the batch evaluation function
+    (except those skipped by lazy evaluation).
+    """
+    indices = []
+    leaves = []
+    for i, move in enumerate(moves):
+        board.push(move)
+        if minimax.game_over_score(board) is None:
+            indices.append(i)
+            leaves.append(board.copy(stack=False))
+        board.pop()
+    if context.stats is not None:
+        context.stats["nodes"] += len(leaves)
+
+    scores = {}
+    if leaves and context.lazy_eval is not None:
+        eval_indices = []
+        eval_leaves = []
+        for i, leaf, (low, high) in zip(
+            indices, leaves, context.lazy_eval.bounds(leaves)
+        ):
+            bound = minimax.window_bound(color, low, high, alpha, beta)
+            if bound is None:
+                eval_indices.append(i)
+                eval_leaves.append(leaf)
+            else:
+                scores[i] = bound
+        if context.stats is not None:
+            context.stats["lazy_evals"] += len(leaves) - len(eval_leaves)
+        indices = eval_indices
+        leaves = eval_leaves
+    if context.stats is not None:
+        context.stats["evals"] += len(leaves)
+    if leaves:
+        for i, value in zip(indices, context.batch_eval_fn(leaves)):
+            scores[i] = color * value
+    return scores
@@ -0,0 +1,236 @@
+"""
+Module containing a cheap static evaluation of chess positions, by
+material and piece-square tables, and lazy evaluation for minimax
+search built on it. Scoring a batch of boards takes a few numpy
+operations on their bitboards, so it costs next to nothing compared to
+a neural net, but it only knows about material and where pieces stand.
+
+Lazy evaluation (see `LazyEval`) uses it to skip the neural net at
+leaves whose score can't matter to the search: if even a generous
+margin around the cheap score lies outside the alpha/beta window, the
+leaf would be pruned whatever the neural net said, so the bound is
+returned instead. This is futility pruning at the leaves, and like it
+the result can differ from a full search when the neural net disagrees
+with the cheap score by more than the margin.
+
+The piece-square tables are from Tomasz Michniewski's "Simplified
+Evaluation Function", in centipawns.
+"""
+
+import math
+
+import chess
+import numpy as np
+
+# Value of each kind of piece in centipawns. The kings are never
+# captured, so they are worth nothing here.
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+
+# Bonus in centipawns for a White piece of each kind on each square,
+# with the eighth rank first, as the board is usually drawn. Black
+# pieces use the same tables mirrored.
+# fmt: off
+PIECE_SQUARE_TABLES = {
+    chess.PAWN: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    chess.KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    chess.BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    chess.ROOK: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    chess.QUEEN: [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    chess.KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+# fmt: on
+
+# Kinds of pieces, in the order of the rows of SQUARE_WEIGHTS.
+PIECE_TYPES = [
+    chess.PAWN,
+    chess.KNIGHT,
+    chess.BISHOP,
+    chess.ROOK,
+    chess.QUEEN,
+    chess.KING,
+]
+
+
+def make_square_weights():
+    """
+    Return a 12x64 float32 numpy array of the value in pawns of a piece
+    on each square, from White's point of view, with squares in
+    python-chess order (a1, b1, ..., h8). The rows are White's pieces
+    in the order of PIECE_TYPES, then Black's.
+    """
+    weights = np.empty((12, 64), dtype=np.float32)
+    for i, piece_type in enumerate(PIECE_TYPES):
+        table = PIECE_SQUARE_TABLES[piece_type]
+        for square in chess.SQUARES:
+            # The tables have the eighth rank first, so White's pieces
+            # need the square mirrored and Black's don't.
+            weights[i, square] = (
+                PIECE_VALUES[piece_type] + table[chess.square_mirror(square)]
+            )
+            weights[i + 6, square] = -(PIECE_VALUES[piece_type] + table[square])
+    return weights / 100
+
+
+# Value in pawns of each piece on each square (see
+# `make_square_weights`).
+SQUARE_WEIGHTS = make_square_weights()
+
+
+def static_scores(boards):
+    """
+    Return a float32 numpy array with the material and piece-square
+    score of each of the given python-chess Boards, in pawns from
+    White's point of view.
+    """
+    masks = np.empty((len(boards), 12), dtype="<u8")
+    for i, board in enumerate(boards):
+        white = board.occupied_co[chess.WHITE]
+        black = board.occupied_co[chess.BLACK]
+        for j, pieces in enumerate(
+            (
+                board.pawns,
+                board.knights,
+                board.bishops,
+                board.rooks,
+                board.queens,
+                board.kings,
+            )
+        ):
+            masks[i, j] = pieces & white
+            masks[i, j + 6] = pieces & black
+    # Unpack each bitboard into 64 bits, one per square, in python-chess
+    # order, and add up the weights of the squares that are set.
+    bits = np.unpackbits(masks.view(np.uint8), axis=1, bitorder="little")
+    return bits.reshape(len(boards), 12 * 64) @ SQUARE_WEIGHTS.reshape(12 * 64)
+
+
+def capture_threat(board):
+    """
+    Return the value in pawns of the most valuable piece that the
+    player to move can capture on the board, or infinity if they are in
+    check (when any score is unreliable). Only attacks are considered,
+    not whether the piece is defended.
+    """
+    if board.is_check():
+        return math.inf
+    us = board.turn
+    them = not us
+    for piece_type in (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT):
+        for square in chess.scan_forward(board.pieces_mask(piece_type, them)):
+            if board.is_attacked_by(us, square):
+                return PIECE_VALUES[piece_type] / 100
+    for square in chess.scan_forward(board.pieces_mask(chess.PAWN, them)):
+        if board.is_attacked_by(us, square):
+            return PIECE_VALUES[chess.PAWN] / 100
+    return 0
+
+
+class LazyEval:
+    """
+    Settings for lazy evaluation in minimax search (see
+    `minimax.minimax`). Cheap scores are in pawns, and are converted to
+    the range of the evaluation function (-1 to 1, from White's point
+    of view) by tanh(pawns / pawn_scale), so that with the default
+    pawn_scale being two pawns up is worth about 0.46.
+
+    A leaf is scored by the evaluation function unless the cheap score
+    plus or minus margin pawns falls entirely outside the alpha/beta
+    window. The margin is widened, quiescence-style, by the value of
+    the most valuable piece the player to move can capture (see
+    `capture_threat`), and leaves where they are in check get the
+    widest bounds (-1 to 1), so they are scored by the evaluation
+    function unless the window is beyond what it can return.
+    """
+
+    def __init__(self, margin=2, pawn_scale=4):
+        self.margin = margin
+        self.pawn_scale = pawn_scale
+
+    def bounds(self, boards):
+        """
+        Return a list of (low, high) tuples for the given python-chess
+        Boards, which bound what the evaluation function would return
+        for each of them (assuming it agrees with the cheap score to
+        within the margin), from White's point of view.
+        """
+        result = []
+        for board, score in zip(boards, static_scores(boards)):
+            threat = capture_threat(board)
+            if threat == math.inf:
+                result.append((-1.0, 1.0))
+                continue
+            # The capture can only help the player to move.
+            low = score - self.margin
+            high = score + self.margin
+            if board.turn == chess.WHITE:
+                high += threat
+            else:
+                low -= threat
+            result.append(
+                (
+                    math.tanh(low / self.pawn_scale),
+                    math.tanh(high / self.pawn_scale),
+                )
+            )
+        return result
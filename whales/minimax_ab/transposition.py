@@ -0,0 +1,120 @@
+"""
+Module containing a bounded transposition table for minimax search.
+The table remembers the result of searching a position so that the
+search doesn't have to be repeated when the same position is reached
+again, whether by a different move order in the same search or by a
+later search (for example, when a client retries a request or two
+games reach the same line).
+"""
+
+import collections
+import threading
+
+import chess.polyglot
+
+# Kinds of bound a stored score can be. An EXACT score is the true
+# minimax value of the position at the stored depth. A LOWER score
+# means the true value is at least that large (the search was cut off
+# because the score was already too good), and an UPPER score means the
+# true value is at most that large (every move failed low).
+EXACT = "exact"
+LOWER = "lower"
+UPPER = "upper"
+
+# Approximate number of bytes used by a single entry, including the key,
+# the entry tuple, the stored move and the dictionary overhead. This was
+# measured with tracemalloc and is used to turn a memory cap into a
+# maximum number of entries.
+ENTRY_BYTES = 350
+
+# Default memory cap for a table, in bytes.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# A single entry of the table. Depth is the number of plies that were
+# searched below the position. Score is always from White's point of
+# view, so that entries can be shared between searches started by
+# either player. Move is the best move found, or None if there is none
+# (for example if the search was cut off before any move improved the
+# score).
+TableEntry = collections.namedtuple("TableEntry", ["depth", "bound", "score", "move"])
+
+
+def position_key(board):
+    """
+    Return the key used to store the position of the given python-chess
+    Board in a transposition table. This is the Zobrist hash of the
+    position (as used by Polyglot opening books), which covers piece
+    placement, side to move, castling rights and en passant, but not
+    the move counters or repetition history.
+    """
+    return chess.polyglot.zobrist_hash(board)
+
+
+def flip_bound(bound):
+    """
+    Return the bound that a score of the given kind becomes when the
+    score is negated.
+    """
+    if bound == LOWER:
+        return UPPER
+    if bound == UPPER:
+        return LOWER
+    return bound
+
+
+class TranspositionTable:
+    """
+    Bounded, thread-safe mapping from position keys (see `position_key`)
+    to TableEntry objects.
+
+    Replacement policy: when a position is stored that is already in the
+    table, the new entry replaces the old one unless the old one was
+    searched strictly deeper. Eviction policy: when the table is full,
+    the least recently used entry (by lookup or store) is discarded.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Create an empty table that uses at most roughly max_bytes of
+        memory.
+        """
+        self.max_entries = max(1, max_bytes // ENTRY_BYTES)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        """
+        Return the TableEntry stored for the given key, or None if there
+        is none.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, depth, bound, score, move):
+        """
+        Store a search result for the given key, subject to the
+        replacement and eviction policies described on the class. The
+        score must be from White's point of view.
+        """
+        with self.lock:
+            old_entry = self.entries.get(key)
+            if old_entry is not None and old_entry.depth > depth:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = TableEntry(depth, bound, score, move)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove every entry from the table.
+        """
+        with self.lock:
+            self.entries.clear()
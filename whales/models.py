@@ -1,9 +1,24 @@
 """
 Module containing the backend models which users can select to play
-against in the app. A model is a function that takes a PGN string and
-returns a new PGN string with an additional move. Passing a model a PGN
-string that is a completed game produces an unspecified result, but
-should not be an error. (Malformed PGN may produce an InvalidPGNError.)
+against in the app. A model is a function that takes a python-chess
+Board and returns the move it chooses to make, as a python-chess Move.
+Models may make and unmake moves on the board while they think, but
+leave it as it was when they return. Passing a model a board where the
+game is over produces an unspecified result. A model also takes a
+time_limit keyword argument, which is either None or the number of
+seconds the model should try to return within; models that are always
+fast may ignore it. Likewise a model takes a cancel_token keyword
+argument, which is either None or a `cancellation.CancelToken`; models
+that take long should raise `cancellation.Cancelled` soon after it is
+cancelled. Finally a model takes a stats keyword argument, which is
+either None or a `collections.Counter` to which models that search add
+the stats of their search (see `minimax.minimax`). Models that search
+also set its "complete" to whether the search went as far as it would
+with no time limit, so that the move is as good as the model can find.
+Moves found any other way, such as from an opening book, leave it
+unset.
+
+Use `run_model` to run a model on a game given as a PGN string.
 
 For convenience, mostly this module defines functions which *return* a
 model, so that you can easily construct models with different parameters
@@ -11,12 +26,28 @@ substituted in.
 """
 
 import collections
+import functools
+import itertools
+import os
 import random
+import time
 
 import chess
 
+import whales.cancellation as cancellation
+import whales.mcts.mcts as mcts
 import whales.minimax_ab.minimax as minimax
+import whales.minimax_ab.ordering as ordering
+import whales.minimax_ab.parallel as parallel
+import whales.minimax_ab.pvs as pvs
+import whales.minimax_ab.static_eval as static_eval
+import whales.minimax_ab.transposition as transposition
+import whales.move_cache as move_cache
+import whales.neural_net.chess_alpha_data as chess_alpha_data
 import whales.neural_net.interface as neural_net
+import whales.opening_book as opening_book
+import whales.pondering as pondering
+import whales.util
 import whales.util.chess
 
 
@@ -37,40 +68,188 @@ class NoSuchNeuralNetError(Exception):
     pass
 
 
+# Memory cap for the transposition table of each minimax model, in
+# bytes. Can be overridden with the WHALES_TT_MEGABYTES environment
+# variable.
+TABLE_BYTES = int(os.environ.get("WHALES_TT_MEGABYTES") or 64) * 1024 * 1024
+
+# Default number of workers that each minimax model splits its search
+# between. Can be overridden with the WHALES_SEARCH_WORKERS environment
+# variable. One worker means the search is done serially, in the
+# request thread.
+SEARCH_WORKERS = int(os.environ.get("WHALES_SEARCH_WORKERS") or 1)
+
+# Default search algorithm of minimax models: "minimax" for plain
+# alpha/beta search (see `minimax.minimax`) or "pvs" for principal
+# variation search (see `pvs.pvs`). Can be overridden with the
+# WHALES_SEARCH_ALGORITHM environment variable.
+SEARCH_ALGORITHM = os.environ.get("WHALES_SEARCH_ALGORITHM") or "minimax"
+
+# Whether the Hard models use lazy evaluation (see `static_eval`). Its
+# margin hasn't been calibrated against the scores of chess_alpha_zero
+# yet, and it changes the moves the models play, so it is off unless
+# the WHALES_LAZY_EVAL environment variable is set to anything but 0.
+LAZY_EVAL = os.environ.get("WHALES_LAZY_EVAL") not in (None, "", "0")
+
+# Source of unique names for registering the search functions of models
+# that use process executors.
+PROCESS_FUNCTION_IDS = itertools.count()
+
+
 def model_random():
     """
     Return a model that makes random moves.
     """
 
-    def model(pgn):
-        board = whales.util.chess.pgn_to_board(pgn)
-        move = random.choice(list(board.legal_moves))
-        board.push(move)
-        return whales.util.chess.board_to_pgn(board)
+    def model(board, time_limit=None, cancel_token=None, stats=None):
+        return random.choice(list(board.legal_moves))
 
     return model
 
 
-def model_minimax(depth, eval_fn):
+def model_policy(nn_name, temperature=0):
+    """
+    Return a model that makes the move the neural net by the given name
+    (which must output a policy like chess_alpha_zero) thinks most
+    likely to be best, running it only once, on the current board.
+
+    If temperature is more than zero, the move is instead chosen at
+    random, with each legal move's probability raised to the power of
+    one over temperature, so that a temperature of one plays moves as
+    often as the policy predicts them, and higher temperatures play
+    more varied moves.
+    """
+    if nn_name not in neural_net.NEURAL_NET_NAMES:
+        raise NoSuchNeuralNetError
+
+    def model(board, time_limit=None, cancel_token=None, stats=None):
+        with cancellation.using_token(cancel_token):
+            prediction = neural_net.NEURAL_NET_PREDICT[nn_name](board)
+        if stats is not None:
+            stats["evals"] += 1
+        probabilities = minimax_chess_alpha_policy_transform(prediction, board)
+        moves = list(probabilities)
+        if temperature <= 0:
+            return max(moves, key=probabilities.get)
+        weights = [probabilities[move] ** (1 / temperature) for move in moves]
+        # The prediction cache only keeps the most likely moves of the
+        # policy, so the weights can all be zero in positions with very
+        # many legal moves.
+        if not any(weights):
+            weights = None
+        return random.choices(moves, weights=weights)[0]
+
+    return model
+
+
+def model_minimax(
+    depth,
+    eval_fn,
+    batch_eval_fn=None,
+    table_bytes=TABLE_BYTES,
+    time_limit=None,
+    policy_fn=None,
+    workers=SEARCH_WORKERS,
+    executor_kind="thread",
+    lazy_eval=None,
+    algorithm=SEARCH_ALGORITHM,
+):
     """
     Return a model that uses minimax to the given depth with the given
-    evaluation function to find the optimal move.
+    evaluation function to find the optimal move. If batch_eval_fn is
+    given, it is used to score many leaves at once (see
+    `minimax.minimax`).
+
+    Moves are searched in the order given by `ordering.MoveOrdering`.
+    If policy_fn is given, it is used to order the moves of nodes high
+    enough in the tree (see `ordering.MoveOrdering` for its format).
+
+    The search is done with iterative deepening (see
+    `minimax.minimax_iterative`), so that it can stop early and return
+    the best move found so far once its time limit runs out. The time
+    limit is time_limit seconds, or the limit passed to the model if
+    that is smaller. With no limit at all, the search always goes to the
+    full depth.
+
+    The model keeps a transposition table of at most roughly
+    table_bytes bytes, which is shared by every call to the model, so
+    that positions searched for one request are not searched again for
+    the next. Pass a table_bytes of zero to disable it.
+
+    If workers is more than one, the moves at the root of the search are
+    split between that many workers of an executor of the given kind
+    (see `parallel.minimax_parallel`), which is created once and shared
+    by every call to the model. Thread executors suit neural net
+    evaluation functions; process executors only suit evaluation
+    functions that are safe to call after a fork.
+
+    The search algorithm is either "minimax" or "pvs" (see
+    SEARCH_ALGORITHM). Both find the same scores, but principal
+    variation search can only be done serially, so it needs workers to
+    be one.
+
+    If lazy_eval is given, it is a `static_eval.LazyEval` used to skip
+    evaluating leaves that a cheap static evaluation shows can't matter
+    (see `minimax.minimax`).
+
+    The search is complete (see the stats of models) if it went to the
+    full depth.
 
     To use a neural net as the evaluation function, see
     `model_minimax_with_neural_net` instead.
     """
+    table = None
+    if table_bytes:
+        table = transposition.TranspositionTable(max_bytes=table_bytes)
+    model_time_limit = time_limit
+    search_fn = None
+    if algorithm == "pvs":
+        if workers > 1:
+            raise ValueError("principal variation search can't be parallel")
+        search_fn = pvs.pvs
+    elif algorithm != "minimax":
+        raise ValueError("unknown search algorithm {}".format(repr(algorithm)))
+    elif workers > 1:
+        process_functions = None
+        if executor_kind == "process":
+            process_functions = "model-{}".format(next(PROCESS_FUNCTION_IDS))
+            parallel.register_process_functions(
+                process_functions, eval_fn, batch_eval_fn, policy_fn, lazy_eval
+            )
+        search_fn = functools.partial(
+            parallel.minimax_parallel,
+            executor=parallel.make_executor(workers, executor_kind),
+            process_functions=process_functions,
+        )
 
-    def model(pgn):
-        board = whales.util.chess.pgn_to_board(pgn)
-        result = minimax.minimax(board, eval_fn, depth)
-        move = result[1]
-        board.push(move)
-        return whales.util.chess.board_to_pgn(board)
+    def model(board, time_limit=None, cancel_token=None, stats=None):
+        limits = [t for t in (time_limit, model_time_limit) if t is not None]
+        # Make the token current so that the neural net also gives up
+        # waiting once it is cancelled.
+        with cancellation.using_token(cancel_token):
+            result = minimax.minimax_iterative(
+                board,
+                eval_fn,
+                depth,
+                time_limit=min(limits, default=None),
+                batch_eval_fn=batch_eval_fn,
+                table=table,
+                search_fn=search_fn,
+                ordering=ordering.MoveOrdering(policy_fn=policy_fn),
+                cancel_token=cancel_token,
+                stats=stats,
+                lazy_eval=lazy_eval,
+            )
+        if stats is not None:
+            stats["complete"] = stats["depth"] == depth
+        return result[1]
 
     return model
 
 
-def model_minimax_with_neural_net(depth, nn_name, nn_result_transform):
+def model_minimax_with_neural_net(
+    depth, nn_name, nn_result_transform, nn_policy_transform=None, **kwargs
+):
     """
     Return a model that uses minimax to the given depth with the neural
     net by the given name as the evaluation function to find the optimal
@@ -83,6 +262,15 @@ def model_minimax_with_neural_net(depth, nn_name, nn_result_transform):
 
     nn_result_transform must take in both the result of the neural net
     and the input to eval_fn (board).
+
+    If nn_policy_transform is given, the neural net is also used to
+    order moves. nn_policy_transform must take in the result of the
+    neural net and the board, and return a dictionary mapping each legal
+    move to its probability of being the best move.
+
+    Leaves are evaluated in batches, so that the neural net is run once
+    for all the children of a node rather than once per leaf. Any other
+    keyword arguments are passed on to `model_minimax`.
     """
     if nn_name not in neural_net.NEURAL_NET_NAMES:
         raise NoSuchNeuralNetError
@@ -91,7 +279,88 @@ def model_minimax_with_neural_net(depth, nn_name, nn_result_transform):
         prediction = neural_net.NEURAL_NET_PREDICT[nn_name](board)
         return nn_result_transform(prediction, board)
 
-    return model_minimax(depth, eval_fn)
+    def batch_eval_fn(boards):
+        policies, values = neural_net.NEURAL_NET_PREDICT[nn_name](boards)
+        # Split the batched prediction back up so that
+        # nn_result_transform sees the same thing it would get from
+        # predicting a single board.
+        return [
+            nn_result_transform([policies[i : i + 1], values[i : i + 1]], board)
+            for i, board in enumerate(boards)
+        ]
+
+    def nn_policy_fn(board):
+        prediction = neural_net.NEURAL_NET_PREDICT[nn_name](board)
+        return nn_policy_transform(prediction, board)
+
+    policy_fn = None
+    if nn_policy_transform is not None:
+        policy_fn = nn_policy_fn
+
+    return model_minimax(
+        depth, eval_fn, batch_eval_fn=batch_eval_fn, policy_fn=policy_fn, **kwargs
+    )
+
+
+def model_mcts(
+    nn_name,
+    playouts,
+    time_limit=None,
+    batch_size=mcts.DEFAULT_BATCH_SIZE,
+    c_puct=mcts.DEFAULT_C_PUCT,
+    max_nodes=mcts.DEFAULT_MAX_NODES,
+):
+    """
+    Return a model that uses Monte Carlo tree search (see `mcts.search`)
+    with the neural net by the given name, which must output a policy
+    and value like chess_alpha_zero, to find the best move. The search
+    runs the given number of playouts, evaluating batch_size leaves
+    with each call to the neural net, unless its time limit runs out
+    first. The time limit is time_limit seconds, or the limit passed to
+    the model if that is smaller.
+
+    The model keeps the trees searched below the opponent's replies to
+    its moves in a `mcts.TreeStore` of at most max_nodes Nodes, shared
+    by every call to the model, so that the search for its next move in
+    a game starts from what it already found.
+
+    The search is complete (see the stats of models) if it ran every
+    playout.
+    """
+    if nn_name not in neural_net.NEURAL_NET_NAMES:
+        raise NoSuchNeuralNetError
+
+    store = mcts.TreeStore(max_nodes=max_nodes)
+    model_time_limit = time_limit
+
+    def model(board, time_limit=None, cancel_token=None, stats=None):
+        if stats is None:
+            stats = collections.Counter()
+        nodes = stats["nodes"]
+        limits = [t for t in (time_limit, model_time_limit) if t is not None]
+        deadline = None
+        if limits:
+            deadline = time.monotonic() + min(limits)
+        # Make the token current so that the neural net also gives up
+        # waiting once it is cancelled.
+        with cancellation.using_token(cancel_token):
+            root = mcts.search(
+                board,
+                neural_net.NEURAL_NET_PREDICT[nn_name],
+                playouts,
+                root=store.pop(board),
+                deadline=deadline,
+                batch_size=batch_size,
+                c_puct=c_puct,
+                cancel_token=cancel_token,
+                stats=stats,
+            )
+        stats["complete"] = stats["nodes"] - nodes >= playouts
+        move = mcts.best_move(root)
+        store.keep(board, root, move)
+        return move
+
+    return model
 
 
 def minimax_chess_alpha_transform(prediction, board):
@@ -115,35 +384,119 @@ def minimax_chess_alpha_transform(prediction, board):
     return value
 
 
-# NOTE: Keep models list here in sync with html/about.html!
-
-MODELS = collections.OrderedDict()
-
-MODELS["random"] = {
-    "display_name": "Easy",
-    "description": "Make random moves",
-    "callable": model_random(),
-}
+def minimax_chess_alpha_policy_transform(prediction, board):
+    """
+    Return a dictionary mapping each legal move of the board to its
+    probability according to the chess_alpha_zero policy output.
+    """
+    policies, _ = prediction
+    return chess_alpha_data.policy_to_move_probabilities(policies[0], board)
 
-MODELS["new"] = {
-    "display_name": "Intermediate",
-    "description": "Simple evaluation with neural net with alternative minimax",
-    "callable": model_minimax_with_neural_net(
-        depth=1,
-        nn_name="chess_alpha_zero",
-        nn_result_transform=minimax_chess_alpha_transform,
-    ),
-}
 
-MODELS["neuralnet-depth1-chess-alpha-zero"] = {
-    "display_name": "Hard",
-    "description": "Chess-Alpha-Zero neural net evaluation function using depth 1 minimax",
-    "callable": model_minimax_with_neural_net(
-        depth=2,
-        nn_name="chess_alpha_zero",
-        nn_result_transform=minimax_chess_alpha_transform,
-    ),
-}
+def make_models():
+    """
+    Return a new dictionary of every model, mapping from internal name
+    to a dictionary with the model's display name, description and
+    callable, and for models whose moves may be kept in the move cache
+    (see `find_move`), persistent set to True. Models keep state between
+    calls, such as transposition tables, so each call makes fresh ones.
+    """
+    # NOTE: Keep models list here in sync with html/about.html!
+
+    models = collections.OrderedDict()
+
+    # Models that ponder guess the player's answers with the neural
+    # net's policy (see `pondering.with_pondering`).
+    reply_fn = model_policy(nn_name="chess_alpha_zero")
+
+    models["random"] = {
+        "display_name": "Easy",
+        "description": "Make random moves",
+        "callable": model_random(),
+    }
+
+    models["policy-chess-alpha-zero"] = {
+        "display_name": "Casual",
+        "description": "Play the move the Chess-Alpha-Zero neural net likes best, without searching",
+        "callable": opening_book.with_opening_book(
+            model_policy(nn_name="chess_alpha_zero", temperature=0.5)
+        ),
+    }
+
+    models["new"] = {
+        "display_name": "Intermediate",
+        "description": "Simple evaluation with neural net with alternative minimax",
+        "persistent": True,
+        "callable": opening_book.with_opening_book(
+            model_minimax_with_neural_net(
+                depth=1,
+                nn_name="chess_alpha_zero",
+                nn_result_transform=minimax_chess_alpha_transform,
+                nn_policy_transform=minimax_chess_alpha_policy_transform,
+            )
+        ),
+    }
+
+    models["neuralnet-depth1-chess-alpha-zero"] = {
+        "display_name": "Hard",
+        "description": "Chess-Alpha-Zero neural net evaluation function using depth 1 minimax",
+        "persistent": True,
+        "callable": opening_book.with_opening_book(
+            pondering.with_pondering(
+                model_minimax_with_neural_net(
+                    depth=2,
+                    nn_name="chess_alpha_zero",
+                    nn_result_transform=minimax_chess_alpha_transform,
+                    nn_policy_transform=minimax_chess_alpha_policy_transform,
+                    # Stay well inside the 60 second timeouts of gunicorn
+                    # and the frontend.
+                    time_limit=30,
+                    lazy_eval=static_eval.LazyEval() if LAZY_EVAL else None,
+                ),
+                reply_fn,
+            )
+        ),
+    }
+
+    # Only offered once the quantized neural net has been made (see
+    # `whales.neural_net.quantize`).
+    if "chess_alpha_zero_int8" in neural_net.NEURAL_NET_NAMES:
+        models["neuralnet-depth2-chess-alpha-zero-int8"] = {
+            "display_name": "Hard (fast)",
+            "description": "Like Hard, but with a quantized neural net that is faster and slightly less accurate",
+            "persistent": True,
+            "callable": opening_book.with_opening_book(
+                pondering.with_pondering(
+                    model_minimax_with_neural_net(
+                        depth=2,
+                        nn_name="chess_alpha_zero_int8",
+                        nn_result_transform=minimax_chess_alpha_transform,
+                        nn_policy_transform=minimax_chess_alpha_policy_transform,
+                        time_limit=30,
+                        lazy_eval=static_eval.LazyEval() if LAZY_EVAL else None,
+                    ),
+                    reply_fn,
+                )
+            ),
+        }
+
+    models["mcts-chess-alpha-zero"] = {
+        "display_name": "Hard (tree search)",
+        "description": "Monte Carlo tree search guided by the Chess-Alpha-Zero neural net's policy and value",
+        "persistent": True,
+        "callable": opening_book.with_opening_book(
+            pondering.with_pondering(
+                model_mcts(nn_name="chess_alpha_zero", playouts=800, time_limit=30),
+                reply_fn,
+            )
+        ),
+    }
+
+    return models
+
+
+# Dictionary of the models that the API serves (see `make_models`).
+MODELS = make_models()
 
 
 def get_model_info():
@@ -163,12 +516,74 @@ def get_model_info():
     return info_list
 
 
-def run_model(model_name, pgn):
+def get_model(model_name):
     """
-    Given the internal name of a model and a PGN string, run the model
-    and return a PGN string. If there is no model by that name, raise
-    NoSuchModelError.
+    Return the model with the given internal name. If there is no model
+    by that name, raise NoSuchModelError.
     """
     if model_name not in MODELS:
         raise NoSuchModelError
-    return MODELS[model_name]["callable"](pgn)
+    return MODELS[model_name]["callable"]
+
+
+def find_move(
+    model_name,
+    board,
+    time_limit=None,
+    cancel_token=None,
+    stats=None,
+    cache=whales.util.UNSET,
+):
+    """
+    Run the model with the given internal name on the given board and
+    return its move, taking the same keyword arguments as a model.
+
+    For models that are marked persistent in `make_models`, the move is
+    looked up in the given MoveCache first, and stored in it after a
+    complete search (see the stats of models). Moves from searches cut
+    short by a time limit may be worse than the model can find, and
+    moves from an opening book or a background search aren't searched
+    for the request at all, so they are not stored. If no cache is
+    given, use `move_cache.MOVE_CACHE`; if the cache is None, always
+    search. If there is no model by that name, raise NoSuchModelError.
+    """
+    model = get_model(model_name)
+    if cache is whales.util.UNSET:
+        cache = move_cache.MOVE_CACHE
+    if cache is None or not MODELS[model_name].get("persistent"):
+        return model(
+            board, time_limit=time_limit, cancel_token=cancel_token, stats=stats
+        )
+    move = cache.lookup(model_name, board)
+    if move is not None:
+        return move
+    if stats is None:
+        stats = collections.Counter()
+    move = model(board, time_limit=time_limit, cancel_token=cancel_token, stats=stats)
+    if stats.get("complete"):
+        cache.store(model_name, board, move, depth=stats.get("depth"))
+    return move
+
+
+def run_model(model_name, pgn, time_limit=None, cancel_token=None, stats=None):
+    """
+    Given the internal name of a model and a PGN string, run the model
+    (see `find_move`) and return a PGN string with the model's move
+    added. If time_limit is given, the model tries to return within
+    that many seconds. If cancel_token is given, the model is abandoned
+    with `cancellation.Cancelled` soon after the token is cancelled. If
+    stats is given, the model adds the stats of its search to it. If
+    there is no model by that name, raise NoSuchModelError. Malformed
+    PGN raises InvalidPGNError.
+
+    If pondering is on, every background search is stopped, except
+    those for the position of the request (see `pondering.Ponderer`).
+    """
+    get_model(model_name)
+    board = whales.util.chess.pgn_to_board(pgn)
+    if pondering.PONDERER is not None:
+        pondering.PONDERER.claim(board)
+    move = find_move(
+        model_name, board, time_limit=time_limit, cancel_token=cancel_token, stats=stats
+    )
+    return whales.util.chess.append_move_to_pgn(pgn, board, move)
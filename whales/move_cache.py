@@ -0,0 +1,322 @@
+"""
+Module containing the move cache, which remembers on disk the move each
+model chose in each position, so that it can answer instantly the next
+time the position comes up, even after the server has been restarted.
+This matters because the server is stopped whenever it has been idle
+for a few minutes (see the Dockerfile), which throws away everything
+the models keep in memory, such as their transposition tables.
+
+The cache is an SQLite database, which can be shared safely by every
+thread and every worker process of the server. Positions are keyed by
+their EPD, which is their FEN without the move counters, so the same
+position reached in different ways is the same entry. When the cache
+grows past its maximum size, the least recently used entries are
+deleted.
+
+To fill the cache with the first moves of common openings before any
+players arrive, run
+
+    $ python -m whales.move_cache --plies 8
+
+which searches every position of the first 8 plies of the openings in
+COMMON_OPENINGS (and of the games in any PGN files given) with every
+model that uses the cache. The cache file is given by the
+WHALES_MOVE_CACHE environment variable (see `MOVE_CACHE`).
+"""
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+import chess
+import chess.pgn
+
+import whales.metrics
+
+# Default largest number of entries a cache keeps.
+DEFAULT_MAX_ENTRIES = 100000
+
+# Number of entries stored between checks of whether the cache has
+# grown past its maximum size.
+EVICTION_INTERVAL = 256
+
+# Number of seconds to wait for another thread or process to finish
+# writing to the database before giving up.
+BUSY_TIMEOUT_SECONDS = 5
+
+# Main lines of common openings, in SAN, for warming up the cache.
+COMMON_OPENINGS = [
+    "e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7",
+    "e4 e5 Nf3 Nc6 Bc4 Bc5 c3 Nf6 d4 exd4",
+    "e4 e5 Nf3 Nf6 Nxe5 d6 Nf3 Nxe4 d4 d5",
+    "e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6",
+    "e4 c5 Nf3 Nc6 d4 cxd4 Nxd4 Nf6 Nc3 e5",
+    "e4 e6 d4 d5 Nc3 Nf6 Bg5 Be7 e5 Nfd7",
+    "e4 c6 d4 d5 Nc3 dxe4 Nxe4 Bf5 Ng3 Bg6",
+    "e4 d5 exd5 Qxd5 Nc3 Qa5 d4 Nf6 Nf3 c6",
+    "d4 d5 c4 e6 Nc3 Nf6 Bg5 Be7 e3 O-O",
+    "d4 d5 c4 dxc4 Nf3 Nf6 e3 e6 Bxc4 c5",
+    "d4 d5 c4 c6 Nf3 Nf6 Nc3 dxc4 a4 Bf5",
+    "d4 Nf6 c4 g6 Nc3 Bg7 e4 d6 Nf3 O-O",
+    "d4 Nf6 c4 e6 Nc3 Bb4 e3 O-O Bd3 d5",
+    "d4 Nf6 c4 e6 Nf3 b6 g3 Ba6 b3 Bb4+",
+    "c4 e5 Nc3 Nf6 Nf3 Nc6 g3 d5 cxd5 Nxd5",
+    "Nf3 d5 g3 Nf6 Bg2 c6 O-O Bg4 d3 Nbd7",
+]
+
+
+class MoveCache:
+    """
+    Move cache in the SQLite database at the given path, which is
+    created if it doesn't exist. It keeps at most roughly max_entries
+    entries. Thread-safe, and safe to share between processes.
+
+    The attributes hits, misses, stores, evictions and errors count
+    what has happened since the cache was created. Errors from the
+    database, or from opening it (such as a path that can't be
+    written), are counted and otherwise ignored, so that a broken cache
+    only makes the models search instead of answering from it.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        # Each thread has its own connection, since connections can't
+        # be shared between threads.
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        """
+        Return the database connection of the current thread, opening
+        it (and creating the database) if needed.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None
+            )
+            # Write-ahead logging lets readers carry on while another
+            # thread or process writes.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS moves ("
+                "model TEXT NOT NULL, "
+                "position TEXT NOT NULL, "
+                "move TEXT NOT NULL, "
+                "depth INTEGER, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (model, position))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS moves_last_used ON moves (last_used)"
+            )
+            self.local.connection = connection
+        return connection
+
+    def lookup(self, model_name, board):
+        """
+        Return the move stored for the model by the given name in the
+        position of the given python-chess Board, or None if there is
+        none (or it is not legal, which only happens if the database
+        has been tampered with).
+        """
+        position = board.epd()
+        move = None
+        try:
+            connection = self.get_connection()
+            row = connection.execute(
+                "SELECT move FROM moves WHERE model = ? AND position = ?",
+                (model_name, position),
+            ).fetchone()
+            if row is not None:
+                move = chess.Move.from_uci(row[0])
+                if not board.is_legal(move):
+                    move = None
+            if move is not None:
+                connection.execute(
+                    "UPDATE moves SET last_used = ? WHERE model = ? AND position = ?",
+                    (time.time(), model_name, position),
+                )
+        except (sqlite3.Error, OSError, ValueError):
+            with self.lock:
+                self.errors += 1
+            return None
+        with self.lock:
+            if move is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return move
+
+    def store(self, model_name, board, move, depth=None):
+        """
+        Store the move that the model by the given name chose in the
+        position of the given python-chess Board, and the depth of the
+        search that found it (or None if it is not known).
+        """
+        try:
+            connection = self.get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO moves VALUES (?, ?, ?, ?, ?)",
+                (model_name, board.epd(), move.uci(), depth, time.time()),
+            )
+            with self.lock:
+                self.stores += 1
+                check = self.stores % EVICTION_INTERVAL == 0
+            if check:
+                self.evict()
+        except (sqlite3.Error, OSError):
+            with self.lock:
+                self.errors += 1
+
+    def evict(self):
+        """
+        Delete the least recently used entries until there are at most
+        max_entries.
+        """
+        try:
+            connection = self.get_connection()
+            (count,) = connection.execute("SELECT COUNT(*) FROM moves").fetchone()
+            if count <= self.max_entries:
+                return
+            connection.execute(
+                "DELETE FROM moves WHERE rowid IN "
+                "(SELECT rowid FROM moves ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+        except (sqlite3.Error, OSError):
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.evictions += count - self.max_entries
+
+    def get_stats(self):
+        """
+        Return a dictionary with the counters of the cache.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
+
+
+def opening_lines(pgn_paths=()):
+    """
+    Return a list of lines to warm up the cache with, each a list of
+    python-chess Moves from the starting position: those of
+    COMMON_OPENINGS, and the mainlines of the games in the PGN files at
+    the given paths.
+    """
+    lines = []
+    for opening in COMMON_OPENINGS:
+        board = chess.Board()
+        lines.append([board.push_san(san) for san in opening.split()])
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as pgn_file:
+            while True:
+                game = chess.pgn.read_game(pgn_file)
+                if game is None:
+                    break
+                lines.append(list(game.mainline_moves()))
+    return lines
+
+
+def warm_up(cache, model_names, lines, plies, log=print):
+    """
+    Make sure the given MoveCache has a move for each of the models by
+    the given names in every position of the first plies plies of each
+    of the given lines (see `opening_lines`), searching the positions
+    it doesn't have yet. Only complete searches are stored (see
+    `whales.models.find_move`), so positions in the opening book, or
+    whose search ran out of time, are searched again on the next run.
+    Return the number of positions searched.
+    """
+    # Imported here since the models use the cache.
+    import whales.models as models
+
+    searched = 0
+    for model_name in model_names:
+        seen = set()
+        for line in lines:
+            board = chess.Board()
+            for move in line[:plies]:
+                position = board.epd()
+                if position not in seen:
+                    seen.add(position)
+                    if cache.lookup(model_name, board) is None:
+                        models.find_move(model_name, board, cache=cache)
+                        searched += 1
+                        log("{}: {}".format(model_name, board.fen()))
+                board.push(move)
+    return searched
+
+
+# Move cache used by `whales.models.run_model`, or None if there is
+# none. The path of the database can be set with the WHALES_MOVE_CACHE
+# environment variable, and its maximum number of entries with
+# WHALES_MOVE_CACHE_ENTRIES.
+MOVE_CACHE = None
+if os.environ.get("WHALES_MOVE_CACHE"):
+    MOVE_CACHE = MoveCache(
+        os.environ["WHALES_MOVE_CACHE"],
+        max_entries=int(
+            os.environ.get("WHALES_MOVE_CACHE_ENTRIES") or DEFAULT_MAX_ENTRIES
+        ),
+    )
+    whales.metrics.METRICS.add_collector(
+        whales.metrics.stats_collector(
+            "move_cache",
+            MOVE_CACHE.get_stats,
+            ["hits", "misses", "stores", "evictions", "errors"],
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill the move cache with the first moves of common openings."
+    )
+    parser.add_argument("--plies", type=int, default=8)
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        help="internal names of the models to warm up (default: all that use the cache)",
+    )
+    parser.add_argument("pgn", nargs="*", help="PGN files of more games to use")
+    args = parser.parse_args()
+
+    # Imported here since the models use the cache.
+    import whales.models as models
+    import whales.move_cache
+
+    # When run with `python -m`, this module is __main__, and the models
+    # use the cache of the copy imported as whales.move_cache.
+    cache = whales.move_cache.MOVE_CACHE
+    if cache is None:
+        parser.error("set WHALES_MOVE_CACHE to the path of the cache")
+    model_names = args.models or [
+        name for name, info in models.MODELS.items() if info.get("persistent")
+    ]
+    searched = warm_up(cache, model_names, opening_lines(args.pgn), args.plies)
+    print("searched {} positions".format(searched))
+
+
+if __name__ == "__main__":
+    main()
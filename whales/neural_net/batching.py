@@ -0,0 +1,182 @@
+"""
+Module containing an in-process scheduler that batches neural net
+inference across threads. Every request thread that wants a prediction
+submits its input to the scheduler instead of running the neural net
+itself; a single worker thread gathers whatever inputs are waiting,
+runs them through the neural net as one batch, and hands each caller
+back its own rows of the output. Under load this means a few large
+batches instead of many tiny ones competing for the same cores.
+"""
+
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+import whales.cancellation as cancellation
+import whales.metrics
+
+# Default largest number of rows to put in one batch.
+DEFAULT_MAX_BATCH_SIZE = 256
+
+
+class InferenceScheduler:
+    """
+    Scheduler that coalesces inference requests from any number of
+    threads into batches for a single run function.
+
+    The run function takes a numpy array whose first dimension is the
+    batch, and returns a list of numpy arrays whose first dimensions are
+    the same batch (like `onnxruntime.InferenceSession.run` with a single
+    input).
+
+    Batches hold at most max_batch_size rows, except that a single
+    request larger than that is run as its own batch. When the worker
+    is free it runs whatever is waiting straight away; if max_latency is
+    positive, it instead waits up to that many seconds after the oldest
+    waiting request for more requests to fill the batch.
+
+    The attributes batches, requests and rows count what the scheduler
+    has run since it was created, and run_seconds is the total time
+    spent in the run function.
+    """
+
+    def __init__(
+        self, run_fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_latency=0, name=None
+    ):
+        self.run_fn = run_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.name = name or "inference-scheduler"
+        # List of (inputs, future, time submitted) for requests that
+        # haven't been started yet, oldest first.
+        self.pending = []
+        self.condition = threading.Condition()
+        self.worker = None
+        self.batches = 0
+        self.requests = 0
+        self.rows = 0
+        self.run_seconds = 0
+
+    def submit(self, inputs):
+        """
+        Queue a numpy array of inputs to be run, and return a
+        `concurrent.futures.Future` whose result will be the list of
+        output arrays for just those inputs.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            # Start the worker lazily, so that it is created in the
+            # process that uses it (and not, say, before a fork).
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(
+                    target=self.work, name=self.name, daemon=True
+                )
+                self.worker.start()
+            self.pending.append((inputs, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def run(self, inputs):
+        """
+        Run a numpy array of inputs as part of some batch, wait for it
+        to finish, and return the list of output arrays for those
+        inputs. Exceptions raised by the run function are re-raised.
+
+        If the current `cancellation.CancelToken` is cancelled while
+        waiting, stop waiting and raise `cancellation.Cancelled`. The
+        inputs are dropped from the queue if their batch hasn't started.
+        """
+        return cancellation.wait_for_future(
+            self.submit(inputs), cancellation.current_token()
+        )
+
+    def take_batch(self):
+        """
+        Wait for requests and remove a batch of them from the queue,
+        following the batching rules described on the class. Return a
+        list of (inputs, future) pairs.
+        """
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            if self.max_latency > 0:
+                deadline = self.pending[0][2] + self.max_latency
+                while sum(len(inputs) for inputs, _, _ in self.pending) < (
+                    self.max_batch_size
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(timeout=remaining)
+            batch = []
+            num_rows = 0
+            while self.pending:
+                inputs = self.pending[0][0]
+                if batch and num_rows + len(inputs) > self.max_batch_size:
+                    break
+                inputs, future, _ = self.pending.pop(0)
+                batch.append((inputs, future))
+                num_rows += len(inputs)
+            return batch
+
+    def work(self):
+        """
+        Body of the worker thread: run batches forever.
+        """
+        while True:
+            batch = self.take_batch()
+            # Skip requests whose callers have given up on them.
+            batch = [
+                (inputs, future)
+                for inputs, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+            start_time = time.perf_counter()
+            try:
+                if len(batch) == 1:
+                    outputs = self.run_fn(batch[0][0])
+                else:
+                    outputs = self.run_fn(
+                        np.concatenate([inputs for inputs, _ in batch])
+                    )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            run_seconds = time.perf_counter() - start_time
+            self.run_seconds += run_seconds
+            self.batches += 1
+            self.requests += len(batch)
+            start = 0
+            for inputs, future in batch:
+                end = start + len(inputs)
+                future.set_result([output[start:end] for output in outputs])
+                start = end
+            self.rows += start
+            whales.metrics.METRICS.observe(
+                "nn_batch_size",
+                start,
+                buckets=whales.metrics.BATCH_SIZE_BUCKETS,
+                scheduler=self.name,
+            )
+            whales.metrics.METRICS.observe(
+                "nn_run_seconds", run_seconds, scheduler=self.name
+            )
+
+    def get_stats(self):
+        """
+        Return a dictionary with the counters of the scheduler and the
+        number of requests currently waiting.
+        """
+        with self.condition:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "rows": self.rows,
+                "run_seconds": self.run_seconds,
+                "pending": len(self.pending),
+            }
@@ -0,0 +1,183 @@
+"""
+Module containing a memoizing cache for neural net predictions. The
+same positions are evaluated over and over (transpositions within a
+search, repeated requests for the same game, and common openings across
+users), so predictions are remembered by position and only positions
+that haven't been seen recently are sent to the neural net.
+"""
+
+import collections
+import threading
+
+import chess.polyglot
+import numpy as np
+
+# Number of policy entries kept per position by default. The policy of
+# the chess_alpha_zero neural net has 1968 entries, but almost all of
+# its probability is on the few dozen legal moves, so only the largest
+# entries are kept and the rest are treated as zero.
+DEFAULT_POLICY_TOP_K = 64
+
+# Approximate number of bytes used by an entry apart from its policy
+# arrays (the key, the entry tuple, the value and dictionary overhead).
+ENTRY_OVERHEAD_BYTES = 300
+
+# Default memory cap for a cache, in bytes.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# A single cached prediction: the value as a float, and the largest
+# policy entries as parallel arrays of indices (uint16) and
+# probabilities (float16).
+CacheEntry = collections.namedtuple(
+    "CacheEntry", ["value", "policy_indices", "policy_values", "nbytes"]
+)
+
+
+def position_key(board):
+    """
+    Return a key that identifies everything about the given python-chess
+    Board that the chess_alpha_zero neural net sees: the Zobrist hash of
+    the position (piece placement, side to move, castling rights and en
+    passant) plus the halfmove clock, which is one of its input planes.
+    """
+    return (chess.polyglot.zobrist_hash(board), board.halfmove_clock)
+
+
+class EvaluationCache:
+    """
+    Bounded, thread-safe, least recently used cache of neural net
+    predictions. The cache is bounded by number of entries, by bytes, or
+    both; whichever limit is reached first causes the least recently
+    used entries to be evicted.
+
+    The attributes hits, misses and evictions count what has happened
+    since the cache was created.
+    """
+
+    def __init__(
+        self,
+        max_entries=None,
+        max_bytes=DEFAULT_MAX_BYTES,
+        policy_top_k=DEFAULT_POLICY_TOP_K,
+    ):
+        """
+        Create an empty cache holding at most max_entries entries and at
+        most roughly max_bytes bytes (either may be None for no limit),
+        keeping the policy_top_k largest policy entries of each
+        prediction.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy_top_k = policy_top_k
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Return the CacheEntry for the given key, or None if there is
+        none. Count a hit or a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, policy, value):
+        """
+        Store the prediction for the given key, where policy is a 1D
+        numpy array and value is a number. Evict entries as needed to
+        stay within the limits of the cache.
+        """
+        top_k = min(self.policy_top_k, len(policy))
+        indices = np.argpartition(policy, -top_k)[-top_k:].astype(np.uint16)
+        values = policy[indices].astype(np.float16)
+        nbytes = ENTRY_OVERHEAD_BYTES + indices.nbytes + values.nbytes
+        entry = CacheEntry(float(value), indices, values, nbytes)
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.nbytes -= old_entry.nbytes
+            self.entries[key] = entry
+            self.nbytes += nbytes
+            while self.entries and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every entry from the cache. The counters are not reset.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def get_stats(self):
+        """
+        Return a dictionary with the counters of the cache, its current
+        number of entries and its approximate size in bytes.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+            }
+
+
+def cached_predict_fn(predict_fn, cache, policy_size, key_fn=position_key):
+    """
+    Wrap a prediction function like `interface.chess_alpha_zero_helper`
+    (taking a board or list of boards and returning [policies, values]
+    as numpy arrays with one row per board) so that predictions are
+    looked up in the given EvaluationCache first. Only the boards that
+    miss are passed to predict_fn, in a single call.
+
+    The returned function has the same interface as predict_fn, except
+    that cached policies contain only the largest entries of the
+    original policy (see `EvaluationCache`); the rest are zero. Values
+    are returned exactly. policy_size is the length of a policy vector,
+    and key_fn is used to turn a board into a cache key.
+    """
+
+    def predict(board_input):
+        boards = board_input if isinstance(board_input, list) else [board_input]
+        policies = np.zeros((len(boards), policy_size), dtype=np.float32)
+        values = np.empty((len(boards), 1), dtype=np.float32)
+
+        keys = [key_fn(board) for board in boards]
+        missing = []
+        for i, key in enumerate(keys):
+            entry = cache.get(key)
+            if entry is None:
+                missing.append(i)
+            else:
+                policies[i, entry.policy_indices] = entry.policy_values
+                values[i, 0] = entry.value
+
+        if missing:
+            new_policies, new_values = predict_fn([boards[i] for i in missing])
+            for row, i in enumerate(missing):
+                policies[i] = new_policies[row]
+                values[i, 0] = new_values[row][0]
+                cache.put(keys[i], new_policies[row], new_values[row][0])
+
+        return [policies, values]
+
+    return predict
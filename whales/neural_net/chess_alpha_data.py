@@ -4,8 +4,10 @@ board to the list representation understood by the chess_alpha_zero
 neural network. The majority of this file is copied directly from
 chess-alpha-zero/src/chess_zero/env/chess_env.py.
 """
+
 import enum
 
+import chess
 import numpy as np
 
 
@@ -22,6 +24,112 @@ def board_to_arrays_alpha_chess(board):
     return canon_input_planes(board.fen())
 
 
+def boards_to_arrays_alpha_chess(boards, out=None):
+    """
+    Create an Nx18x8x8 float32 numpy array representing a list of N
+    chess boards, in the format understood by the chess_alpha_zero
+    neural net. The result is identical to stacking the results of
+    `board_to_arrays_alpha_chess` for each board, but is computed
+    straight from the python-chess bitboards instead of going through
+    FEN strings, which is much faster.
+
+    If out is given, it must be a float32 array with shape Mx18x8x8 for
+    some M >= N, and the result is written into its first N entries
+    (and returned) instead of allocating a new array.
+    """
+    num_boards = len(boards)
+    if out is None:
+        out = np.empty((num_boards, 18, 8, 8), dtype=np.float32)
+    else:
+        out = out[:num_boards]
+
+    # One bitboard per piece plane, and the values of the auxiliary
+    # planes, for each board.
+    masks = np.empty((num_boards, 12), dtype="<u8")
+    aux = np.zeros((num_boards, 5), dtype=np.float32)
+    white_to_move = np.empty(num_boards, dtype=bool)
+    en_passant = []
+
+    for i, board in enumerate(boards):
+        # The neural net sees the board from the point of view of the
+        # player to move, whose pieces come first.
+        us = board.turn
+        them = not us
+        white_to_move[i] = us == chess.WHITE
+        j = 0
+        for color in (us, them):
+            color_mask = board.occupied_co[color]
+            for pieces in (
+                board.kings,
+                board.queens,
+                board.rooks,
+                board.bishops,
+                board.knights,
+                board.pawns,
+            ):
+                masks[i, j] = pieces & color_mask
+                j += 1
+        # In standard chess, castling rights that are still valid are
+        # exactly the corner squares of the rooks that can castle.
+        rights = board.clean_castling_rights()
+        if us == chess.WHITE:
+            kingside, queenside = chess.BB_H1, chess.BB_A1
+            their_kingside, their_queenside = chess.BB_H8, chess.BB_A8
+        else:
+            kingside, queenside = chess.BB_H8, chess.BB_A8
+            their_kingside, their_queenside = chess.BB_H1, chess.BB_A1
+        aux[i, 0] = bool(rights & kingside)
+        aux[i, 1] = bool(rights & queenside)
+        aux[i, 2] = bool(rights & their_kingside)
+        aux[i, 3] = bool(rights & their_queenside)
+        aux[i, 4] = board.halfmove_clock
+        # Like the FEN, only mark the en passant square if an en passant
+        # capture is actually legal. Unlike the rest of the planes, the
+        # square is not flipped when Black is to move (as in
+        # `canon_input_planes`).
+        if board.ep_square is not None and board.has_legal_en_passant():
+            en_passant.append(
+                (
+                    i,
+                    7 - chess.square_rank(board.ep_square),
+                    chess.square_file(board.ep_square),
+                )
+            )
+
+    # Unpack each bitboard into 64 bits, one per square, in the order
+    # a1, b1, ..., h1, a2, ..., h8. The planes have the rank furthest
+    # from the player to move in their first row, so the rows are
+    # reversed when White is to move (and the board is flipped for
+    # Black, so they are already in order).
+    bits = np.unpackbits(masks.view(np.uint8), axis=1, bitorder="little")
+    bits = bits.reshape(num_boards, 12, 8, 8)
+    bits[white_to_move] = bits[white_to_move, :, ::-1]
+    out[:, :12] = bits
+    out[:, 12:17] = aux[:, :, np.newaxis, np.newaxis]
+    out[:, 17] = 0
+    for i, row, col in en_passant:
+        out[i, 17, row, col] = 1
+    return out
+
+
+def policy_to_move_probabilities(policy, board):
+    """
+    Given a size 1968 policy vector output by the chess_alpha_zero
+    neural net for a python-chess Board, return a dictionary mapping
+    each legal move on the board to its probability.
+
+    The neural net always sees the board from the point of view of the
+    player to move (see `canon_input_planes`), so when Black is to move
+    its policy refers to moves on the flipped board and is looked up
+    with the flipped move labels.
+    """
+    if board.turn == chess.WHITE:
+        label_index = UCI_LABEL_INDEX
+    else:
+        label_index = FLIPPED_UCI_LABEL_INDEX
+    return {move: float(policy[label_index[move.uci()]]) for move in board.legal_moves}
+
+
 ####
 # Below this point, the code is copied directly from chess-alpha-zero
 ####
@@ -39,6 +147,74 @@ castling_order = "KQkq"  # 4x8x8
 ind = {pieces_order[i]: i for i in range(12)}
 
 
+def create_uci_labels():
+    """
+    Creates the labels for the universal chess interface into an array and returns them
+    :return:
+    """
+    labels_array = []
+    letters = ["a", "b", "c", "d", "e", "f", "g", "h"]
+    numbers = ["1", "2", "3", "4", "5", "6", "7", "8"]
+    promoted_to = ["q", "r", "b", "n"]
+
+    for l1 in range(8):
+        for n1 in range(8):
+            destinations = (
+                [(t, n1) for t in range(8)]
+                + [(l1, t) for t in range(8)]
+                + [(l1 + t, n1 + t) for t in range(-7, 8)]
+                + [(l1 + t, n1 - t) for t in range(-7, 8)]
+                + [
+                    (l1 + a, n1 + b)
+                    for (a, b) in [
+                        (-2, -1),
+                        (-1, -2),
+                        (-2, 1),
+                        (1, -2),
+                        (2, -1),
+                        (-1, 2),
+                        (2, 1),
+                        (1, 2),
+                    ]
+                ]
+            )
+            for l2, n2 in destinations:
+                if (l1, n1) != (l2, n2) and l2 in range(8) and n2 in range(8):
+                    move = letters[l1] + numbers[n1] + letters[l2] + numbers[n2]
+                    labels_array.append(move)
+    for l1 in range(8):
+        letter = letters[l1]
+        for p in promoted_to:
+            labels_array.append(letter + "2" + letter + "1" + p)
+            labels_array.append(letter + "7" + letter + "8" + p)
+            if l1 > 0:
+                l_l = letters[l1 - 1]
+                labels_array.append(letter + "2" + l_l + "1" + p)
+                labels_array.append(letter + "7" + l_l + "8" + p)
+            if l1 < 7:
+                l_r = letters[l1 + 1]
+                labels_array.append(letter + "2" + l_r + "1" + p)
+                labels_array.append(letter + "7" + l_r + "8" + p)
+    return labels_array
+
+
+def flipped_uci_labels():
+    """
+    Seems somewhat based on the uci labels but with the ranks flipped
+    """
+
+    def repl(x):
+        return "".join([(str(9 - int(a)) if a.isdigit() else a) for a in x])
+
+    return [repl(x) for x in create_uci_labels()]
+
+
+# Map from each move label to its index in the policy vector, for White
+# to move and (on the flipped board) for Black to move.
+UCI_LABEL_INDEX = {label: i for i, label in enumerate(create_uci_labels())}
+FLIPPED_UCI_LABEL_INDEX = {label: i for i, label in enumerate(flipped_uci_labels())}
+
+
 def canon_input_planes(fen):
     """
 
@@ -1,16 +1,24 @@
 """
-Module containing the neural nets. When this file is run, it loads all
-neural nets and stores them in NEURAL_NETS. Outside actors wanting to
-get the prediction of a chess board from a neural net named 'net_name'
-should call NEURAL_NET_PREDICT[net_name](board). This can also be used
-to get the predictions of a list of boards.
+Module containing the neural nets. When this file is run, it sets up
+all neural nets and stores them in NEURAL_NETS, without loading them:
+each is loaded the first time it is needed, or in the background right
+away if the WHALES_NN_WARMUP environment variable is set.
+
+Outside actors wanting to get the prediction of a chess board from a
+neural net named 'net_name' should call
+NEURAL_NET_PREDICT[net_name](board). This can also be used to get the
+predictions of a list of boards.
 """
-import os
 
-import numpy as np
-import onnxruntime as ort
+import functools
+import os
+import time
 
-from whales.neural_net.chess_alpha_data import board_to_arrays_alpha_chess
+import whales.metrics
+import whales.neural_net.batching as batching
+import whales.neural_net.cache as cache
+import whales.neural_net.session as session
+from whales.neural_net.chess_alpha_data import boards_to_arrays_alpha_chess
 
 
 def save_neural_nets(neural_nets):
@@ -28,21 +36,23 @@ def save_neural_nets(neural_nets):
 
 def load_neural_nets(net_names):
     """
-    Load a list of Keras neural net Models from .json and .h5 files in
-    the format net_name.json and net_name.h5, whose files are located
-    in the same directory as this file.
+    Return a list of LazySessions for the neural nets with the given
+    names, whose files net_name.onnx are located in the same directory
+    as this file. The sessions are only loaded when first needed; see
+    `whales.neural_net.session`.
     """
-    neural_nets = []
-    for index, name in enumerate(net_names):
-        file_dir = os.path.dirname(__file__)
-        file_path = os.path.join(file_dir, name)
-        neural_nets.append(ort.InferenceSession(file_path + ".onnx"))
-    return neural_nets
+    file_dir = os.path.dirname(__file__)
+    return [
+        session.LazySession(os.path.join(file_dir, name + ".onnx"))
+        for name in net_names
+    ]
 
 
-def chess_alpha_zero_helper(board_input):
+def chess_alpha_zero_helper(board_input, net_name="chess_alpha_zero"):
     """
-    Get a prediction from the chess_alpha_zero neural net.
+    Get a prediction from the chess_alpha_zero neural net, or from
+    another neural net by the given name with the same inputs and
+    outputs, such as its quantized copy chess_alpha_zero_int8.
     Return [policy, value], where policy is a size 1968 vector of
     probabilities associated with each chess move to make next (higher
     probability seems to indicate a better move), and value is a number
@@ -51,27 +61,40 @@ def chess_alpha_zero_helper(board_input):
 
     Board_input can be either a single board or a list of boards. In
     either case the policy and value returned will be vectors.
+
+    The boards are run through the neural net by its scheduler, in a
+    batch together with the boards of any other threads that are
+    waiting for predictions at the same time.
     """
     if not isinstance(board_input, list):
         # Chess_alpha_zero's neural net wants prediction input to be in
-        # the form nx18x8x8, so wrap the 18x8x8 board_input array in
-        # another list.
-        array = [board_to_arrays_alpha_chess(board_input)]
-    else:
-        # Otherwise we can just convert each chess board to the
-        # nx18x8x8 representation because they're already in a list.
-        array = [board_to_arrays_alpha_chess(b) for b in board_input]
+        # the form nx18x8x8, so wrap the single board in a list.
+        board_input = [board_input]
 
-    # Convert to numpy and feed to the neural net.
-    np_array = np.array(array, dtype=np.float32)
+    # Convert each chess board to the nx18x8x8 representation and feed
+    # them to the neural net.
+    start = time.perf_counter()
+    np_array = boards_to_arrays_alpha_chess(board_input)
+    whales.metrics.METRICS.observe(
+        "nn_encode_seconds", time.perf_counter() - start, net=net_name
+    )
+    whales.metrics.METRICS.increment("nn_calls", net=net_name)
+    whales.metrics.METRICS.increment("nn_boards", len(board_input), net=net_name)
 
-    return NEURAL_NET_DICT["chess_alpha_zero"].run(None, {"input_1": np_array})
+    return NEURAL_NET_SCHEDULERS[net_name].run(np_array)
 
 
 # Hardcoded list of names of neural nets to use.
 NEURAL_NET_NAMES = ["chess_alpha_zero"]
 
-# Load every neural net, then store them in a dictionary mapping from
+# The quantized copy of chess_alpha_zero is only used if it has been
+# made (see `whales.neural_net.quantize`).
+if os.path.exists(
+    os.path.join(os.path.dirname(__file__), "chess_alpha_zero_int8.onnx")
+):
+    NEURAL_NET_NAMES.append("chess_alpha_zero_int8")
+
+# Set up every neural net, then store them in a dictionary mapping from
 # name to neural net.
 NEURAL_NETS = load_neural_nets(NEURAL_NET_NAMES)
 
@@ -79,7 +102,74 @@ NEURAL_NET_DICT = {}
 for i, net_name in enumerate(NEURAL_NET_NAMES):
     NEURAL_NET_DICT[net_name] = NEURAL_NETS[i]
 
+# Schedulers that batch together the inputs of every thread for each
+# neural net. The largest batch size and the longest time to wait for a
+# batch to fill, in milliseconds, can be set with the
+# WHALES_NN_MAX_BATCH_SIZE and WHALES_NN_BATCH_WAIT_MS environment
+# variables. By default batches are run as soon as the neural net is
+# free, without waiting.
+NEURAL_NET_SCHEDULERS = {
+    net_name: batching.InferenceScheduler(
+        NEURAL_NET_DICT[net_name].run,
+        max_batch_size=int(
+            os.environ.get("WHALES_NN_MAX_BATCH_SIZE")
+            or batching.DEFAULT_MAX_BATCH_SIZE
+        ),
+        max_latency=float(os.environ.get("WHALES_NN_BATCH_WAIT_MS") or 0) / 1000,
+        name="{}-scheduler".format(net_name),
+    )
+    for net_name in NEURAL_NET_NAMES
+}
+
+# Caches of recent predictions for each neural net, shared by every
+# model and request thread. The memory cap of each cache, in megabytes,
+# can be set with the WHALES_NN_CACHE_MEGABYTES environment variable.
+NEURAL_NET_CACHES = {
+    net_name: cache.EvaluationCache(
+        max_bytes=int(os.environ.get("WHALES_NN_CACHE_MEGABYTES") or 64) * 1024 * 1024
+    )
+    for net_name in NEURAL_NET_NAMES
+}
+
 # A dictionary mapping from the name of a neural net to a function that
 # takes in a board or list of boards, and returns that neural net's
-# prediction of that input.
-NEURAL_NET_PREDICT = {"chess_alpha_zero": chess_alpha_zero_helper}
+# prediction of that input. Predictions go through the cache for that
+# neural net; see `cache.cached_predict_fn` for how cached predictions
+# differ from the neural net's output.
+NEURAL_NET_PREDICT = {
+    net_name: cache.cached_predict_fn(
+        functools.partial(chess_alpha_zero_helper, net_name=net_name),
+        NEURAL_NET_CACHES[net_name],
+        policy_size=1968,
+    )
+    for net_name in NEURAL_NET_NAMES
+}
+
+for net_name in NEURAL_NET_NAMES:
+    whales.metrics.METRICS.add_collector(
+        whales.metrics.stats_collector(
+            "nn_cache",
+            NEURAL_NET_CACHES[net_name].get_stats,
+            ["hits", "misses", "evictions"],
+            net=net_name,
+        )
+    )
+    whales.metrics.METRICS.add_collector(
+        whales.metrics.stats_collector(
+            "nn_scheduler",
+            NEURAL_NET_SCHEDULERS[net_name].get_stats,
+            ["batches", "requests", "rows", "run_seconds"],
+            net=net_name,
+        )
+    )
+    whales.metrics.METRICS.add_collector(
+        whales.metrics.stats_collector(
+            "nn_session", NEURAL_NET_DICT[net_name].get_stats, [], net=net_name
+        )
+    )
+
+# Load the neural nets in the background, so that the first request that
+# needs one doesn't wait for it, while the server can already answer
+# requests that don't.
+if os.environ.get("WHALES_NN_WARMUP") not in (None, "", "0"):
+    session.warm_up_in_background(NEURAL_NETS)
@@ -0,0 +1,156 @@
+"""
+Module to make a quantized copy of the chess_alpha_zero neural net,
+whose weights (and, with static quantization, activations) are 8-bit
+integers instead of 32-bit floats. The copy is smaller and cheaper to
+run on the CPU, at the cost of some accuracy; see
+`whales.benchmark.quantization` to measure both.
+
+Run with `python -m whales.neural_net.quantize`. The copy is written
+next to the original, as chess_alpha_zero_int8.onnx, where
+`whales.neural_net.interface` finds it and makes it available as the
+chess_alpha_zero_int8 neural net.
+
+Static quantization, the default, needs calibration inputs to choose
+the range of each activation. These are positions from random games,
+encoded by `chess_alpha_data.boards_to_arrays_alpha_chess` just as for
+real predictions. Dynamic quantization needs no calibration, but
+chooses the ranges of the activations at run time, which costs some of
+the speedup.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+
+import chess
+import onnx
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from whales.neural_net.chess_alpha_data import boards_to_arrays_alpha_chess
+
+# Path of the neural net that is quantized.
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "chess_alpha_zero.onnx")
+
+# Path the quantized neural net is written to.
+QUANTIZED_MODEL_PATH = os.path.join(
+    os.path.dirname(__file__), "chess_alpha_zero_int8.onnx"
+)
+
+# Ways to quantize the neural net, for the --method argument.
+METHODS = ["static", "dynamic"]
+
+
+def random_boards(count, seed=0, max_plies=80):
+    """
+    Return a list of count python-chess Boards from random games, each
+    after a random number of plies (at most max_plies) from the
+    starting position. Games that end before then are skipped, since
+    the neural net is never asked about finished games. The same seed
+    always gives the same boards.
+    """
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = chess.Board()
+        for _ in range(rng.randint(0, max_plies)):
+            if board.is_game_over():
+                break
+            board.push(rng.choice(list(board.legal_moves)))
+        if not board.is_game_over():
+            boards.append(board)
+    return boards
+
+
+class BoardCalibrationReader(CalibrationDataReader):
+    """
+    Calibration inputs for `quantize_static`: the given boards, encoded
+    in batches of batch_size for the input by the given name.
+    """
+
+    def __init__(self, boards, input_name, batch_size=32):
+        self.batches = iter(
+            [
+                {input_name: boards_to_arrays_alpha_chess(boards[i : i + batch_size])}
+                for i in range(0, len(boards), batch_size)
+            ]
+        )
+
+    def get_next(self):
+        return next(self.batches, None)
+
+
+def quantize(
+    model_path=MODEL_PATH,
+    output_path=QUANTIZED_MODEL_PATH,
+    method="static",
+    calibration_boards=None,
+):
+    """
+    Write a quantized copy of the neural net at model_path to
+    output_path, using the given method (one of METHODS). Static
+    quantization is calibrated on calibration_boards, a list of
+    python-chess Boards, which defaults to 512 boards from
+    `random_boards`.
+    """
+    if method not in METHODS:
+        raise ValueError("unknown quantization method {}".format(repr(method)))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Infer the shapes of every tensor and fold constants first, as
+        # the quantizer works best on a graph prepared that way. The
+        # shapes of this convolutional net only depend on the batch
+        # size, so ONNX's own shape inference is enough, without the
+        # symbolic one (which needs sympy).
+        prepared_path = os.path.join(temp_dir, "prepared.onnx")
+        quant_pre_process(model_path, prepared_path, skip_symbolic_shape=True)
+        if method == "dynamic":
+            quantize_dynamic(prepared_path, output_path, weight_type=QuantType.QInt8)
+            return
+        if calibration_boards is None:
+            calibration_boards = random_boards(512)
+        input_name = onnx.load(prepared_path).graph.input[0].name
+        quantize_static(
+            prepared_path,
+            output_path,
+            BoardCalibrationReader(calibration_boards, input_name),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make a quantized copy of the chess_alpha_zero neural net."
+    )
+    parser.add_argument("--method", choices=METHODS, default="static")
+    parser.add_argument(
+        "--calibration-positions",
+        type=int,
+        default=512,
+        help="number of random positions to calibrate static quantization on",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--output", default=QUANTIZED_MODEL_PATH)
+    args = parser.parse_args()
+
+    quantize(
+        args.model,
+        args.output,
+        method=args.method,
+        calibration_boards=random_boards(args.calibration_positions, args.seed),
+    )
+    print("wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
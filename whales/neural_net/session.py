@@ -0,0 +1,228 @@
+"""
+Module containing how the onnxruntime sessions of the neural nets are
+loaded. Sessions are loaded lazily, the first time a prediction is
+needed, so that the server can start (and serve models that don't use
+a neural net) without waiting for them. They can also be warmed up in
+the background as soon as the server starts, so that the first request
+that needs one doesn't pay for loading it either.
+
+Loading a session means parsing the model and optimizing its graph.
+The optimized graph is saved to a cache directory the first time, and
+later loads (for example, after the server is restarted) read it from
+there and skip the optimization. The cache is keyed by the model file,
+the onnxruntime version, the CPU architecture and the optimization
+level, since an optimized graph may only work on the setup that made
+it.
+
+The session options can be set with environment variables:
+
+* WHALES_ONNX_INTRA_OP_THREADS and WHALES_ONNX_INTER_OP_THREADS: the
+  number of threads used within and between operators. The default of
+  0 lets onnxruntime choose.
+* WHALES_ONNX_EXECUTION_MODE: "sequential" (the default) or
+  "parallel".
+* WHALES_ONNX_OPTIMIZATION: the graph optimization level, one of
+  "disable", "basic", "extended" or "all" (the default).
+* WHALES_ONNX_CACHE_DIR: the directory to cache optimized graphs in,
+  by default `~/.cache/whales/onnx`. Set WHALES_NO_ONNX_CACHE to
+  disable the cache.
+"""
+
+import hashlib
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+# Graph optimization levels, by the names accepted in the
+# WHALES_ONNX_OPTIMIZATION environment variable.
+OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Execution modes, by the names accepted in the
+# WHALES_ONNX_EXECUTION_MODE environment variable.
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+# Session settings, from the environment variables described above.
+INTRA_OP_THREADS = int(os.environ.get("WHALES_ONNX_INTRA_OP_THREADS") or 0)
+INTER_OP_THREADS = int(os.environ.get("WHALES_ONNX_INTER_OP_THREADS") or 0)
+EXECUTION_MODE = os.environ.get("WHALES_ONNX_EXECUTION_MODE") or "sequential"
+OPTIMIZATION = os.environ.get("WHALES_ONNX_OPTIMIZATION") or "all"
+
+# Execution providers to run the neural nets with.
+PROVIDERS = ["CPUExecutionProvider"]
+
+# Directory to cache optimized graphs in, or None to not cache them.
+CACHE_DIR = None
+if os.environ.get("WHALES_NO_ONNX_CACHE") in (None, "", "0"):
+    CACHE_DIR = os.environ.get("WHALES_ONNX_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "whales", "onnx"
+    )
+
+
+def make_session_options(optimization=OPTIMIZATION):
+    """
+    Return onnxruntime SessionOptions with the settings from the
+    environment, and the given graph optimization level (one of the
+    keys of OPTIMIZATION_LEVELS).
+    """
+    if optimization not in OPTIMIZATION_LEVELS:
+        raise ValueError("unknown optimization level {}".format(repr(optimization)))
+    if EXECUTION_MODE not in EXECUTION_MODES:
+        raise ValueError("unknown execution mode {}".format(repr(EXECUTION_MODE)))
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = INTRA_OP_THREADS
+    options.inter_op_num_threads = INTER_OP_THREADS
+    options.execution_mode = EXECUTION_MODES[EXECUTION_MODE]
+    options.graph_optimization_level = OPTIMIZATION_LEVELS[optimization]
+    return options
+
+
+def cached_model_path(model_path, optimization, cache_dir=CACHE_DIR):
+    """
+    Return the path in cache_dir of the optimized graph of the model
+    file at model_path, for the given optimization level.
+    """
+    stat = os.stat(model_path)
+    key = "\0".join(
+        [
+            os.path.realpath(model_path),
+            str(stat.st_size),
+            str(stat.st_mtime_ns),
+            ort.__version__,
+            platform.machine(),
+            optimization,
+        ]
+    )
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, "{}-{}-{}.onnx".format(name, optimization, digest))
+
+
+def load_session(model_path, optimization=OPTIMIZATION, cache_dir=CACHE_DIR):
+    """
+    Return an onnxruntime InferenceSession for the model file at
+    model_path, with the settings from the environment and the given
+    optimization level. If cache_dir is not None, reuse the optimized
+    graph cached there, or else cache it there for next time.
+    """
+    if cache_dir is None or optimization == "disable":
+        return ort.InferenceSession(
+            model_path, make_session_options(optimization), providers=PROVIDERS
+        )
+
+    cached_path = cached_model_path(model_path, optimization, cache_dir)
+    if os.path.exists(cached_path):
+        # The graph is already optimized, so don't spend time trying to
+        # optimize it again.
+        return ort.InferenceSession(
+            cached_path, make_session_options("disable"), providers=PROVIDERS
+        )
+
+    options = make_session_options(optimization)
+    # Write to a temporary file and rename it into place, so that other
+    # processes never load a half-written graph. If the cache directory
+    # can't be written to, just don't cache.
+    temp_path = "{}.{}.tmp".format(cached_path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        options.optimized_model_filepath = temp_path
+        # Don't log the warning that the saved graph may only work on
+        # this machine, which the cache key already accounts for.
+        options.log_severity_level = 3
+    except OSError:
+        temp_path = None
+    session = ort.InferenceSession(model_path, options, providers=PROVIDERS)
+    if temp_path is not None:
+        try:
+            os.replace(temp_path, cached_path)
+        except OSError:
+            pass
+    return session
+
+
+class LazySession:
+    """
+    The onnxruntime InferenceSession of the model file at the given
+    path, loaded the first time it is needed. Thread-safe.
+
+    The attribute load_seconds is the time it took to load the session,
+    or None if it hasn't been loaded.
+    """
+
+    def __init__(self, model_path, optimization=OPTIMIZATION, cache_dir=CACHE_DIR):
+        self.model_path = model_path
+        self.optimization = optimization
+        self.cache_dir = cache_dir
+        self.session = None
+        self.load_seconds = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the InferenceSession, loading it if needed. Threads that
+        need it while it is loading wait for it.
+        """
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    start = time.perf_counter()
+                    self.session = load_session(
+                        self.model_path, self.optimization, self.cache_dir
+                    )
+                    self.load_seconds = time.perf_counter() - start
+        return self.session
+
+    def run(self, array):
+        """
+        Run the session with the given numpy array as its only input,
+        and return the list of outputs.
+        """
+        session = self.get()
+        return session.run(None, {session.get_inputs()[0].name: array})
+
+    def warm_up(self):
+        """
+        Load the session and run it once on a batch of zeros, so that
+        the first real prediction doesn't pay for either.
+        """
+        session = self.get()
+        shape = [
+            dim if isinstance(dim, int) else 1 for dim in session.get_inputs()[0].shape
+        ]
+        self.run(np.zeros(shape, dtype=np.float32))
+
+    def get_stats(self):
+        """
+        Return a dictionary with whether the session has been loaded,
+        and how long that took in seconds (zero if it hasn't).
+        """
+        return {
+            "loaded": int(self.session is not None),
+            "load_seconds": self.load_seconds or 0,
+        }
+
+
+def warm_up_in_background(sessions):
+    """
+    Start a daemon thread that warms up each of the given LazySessions
+    in turn, and return it.
+    """
+
+    def warm_up():
+        for session in sessions:
+            session.warm_up()
+
+    thread = threading.Thread(target=warm_up, name="nn-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,278 @@
+"""
+Module containing the opening book, which lets models answer instantly
+in positions that come up in many games instead of searching them
+again every time.
+
+Books are in the Polyglot format: a file of 16-byte entries sorted by
+the Zobrist hash of the position, each giving a move and a weight. At
+runtime the book file is memory-mapped and binary-searched by
+`chess.polyglot.MemoryMappedReader`, so lookups take microseconds and
+the book is never loaded into the Python heap. Since the format is
+standard, books built by other tools work too.
+
+To build a book from a collection of PGN files, run
+
+    $ python -m whales.opening_book book.bin games.pgn [more.pgn ...]
+
+and then point the WHALES_OPENING_BOOK environment variable at the
+book. Models opt in to using it by being wrapped with
+`with_opening_book`.
+"""
+
+import argparse
+import collections
+import os
+import random
+import struct
+import threading
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+import whales.util
+
+# Layout of a Polyglot book entry: the Zobrist hash of the position, the
+# move, its weight and a learning value that we don't use, big-endian.
+ENTRY_STRUCT = struct.Struct(">QHHI")
+
+# Largest weight an entry can have.
+MAX_WEIGHT = 0xFFFF
+
+# Promotion pieces, by their number in the Polyglot move encoding.
+POLYGLOT_PROMOTIONS = {
+    chess.KNIGHT: 1,
+    chess.BISHOP: 2,
+    chess.ROOK: 3,
+    chess.QUEEN: 4,
+}
+
+# Default number of plies from the start of each game to add to a book.
+DEFAULT_MAX_PLIES = 24
+
+# Default number of games in which a move must be played from a
+# position for it to be added to a book.
+DEFAULT_MIN_GAMES = 3
+
+
+def polyglot_move(board, move):
+    """
+    Return the Polyglot encoding of the given python-chess Move, which
+    must be legal on the given python-chess Board. Polyglot writes
+    castling as the king capturing its own rook.
+    """
+    to_square = move.to_square
+    if board.is_castling(move):
+        if chess.square_file(to_square) > chess.square_file(move.from_square):
+            to_square = chess.square(7, chess.square_rank(to_square))
+        else:
+            to_square = chess.square(0, chess.square_rank(to_square))
+    return (
+        chess.square_file(to_square)
+        | chess.square_rank(to_square) << 3
+        | chess.square_file(move.from_square) << 6
+        | chess.square_rank(move.from_square) << 9
+        | POLYGLOT_PROMOTIONS.get(move.promotion, 0) << 12
+    )
+
+
+def book_move_to_move(board, move):
+    """
+    Convert a python-chess Move read from a Polyglot book, where
+    castling is written as the king capturing its own rook, into the
+    python-chess Move it stands for on the given python-chess Board.
+    """
+    us = board.occupied_co[board.turn]
+    if board.kings & us & chess.BB_SQUARES[move.from_square] and (
+        board.rooks & us & chess.BB_SQUARES[move.to_square]
+    ):
+        if move.to_square > move.from_square:
+            to_file = 6
+        else:
+            to_file = 2
+        return chess.Move(
+            move.from_square,
+            chess.square(to_file, chess.square_rank(move.from_square)),
+        )
+    return move
+
+
+def game_score(result, color):
+    """
+    Return how many points a game with the given PGN result was worth
+    to the player of the given color: 2 for a win, 1 for a draw and 0
+    for a loss or an unknown result.
+    """
+    if result == "1/2-1/2":
+        return 1
+    if result == ("1-0" if color == chess.WHITE else "0-1"):
+        return 2
+    return 0
+
+
+def build_book(
+    pgn_paths,
+    book_path,
+    max_plies=DEFAULT_MAX_PLIES,
+    min_games=DEFAULT_MIN_GAMES,
+):
+    """
+    Build a Polyglot opening book from the games in the PGN files at the
+    given paths, and write it to book_path. Return the number of
+    entries written.
+
+    The first max_plies plies of the mainline of every game are added.
+    A move is kept if it was played from its position in at least
+    min_games games, and scored at least one point in total for the
+    players who made it (a win counts 2 and a draw 1). Its weight is its
+    total score, scaled down if needed so that the largest weight fits
+    in an entry.
+    """
+    # Map from (Zobrist hash, Polyglot move) to [number of games, total
+    # score].
+    counts = collections.defaultdict(lambda: [0, 0])
+    for pgn_path in pgn_paths:
+        with open(pgn_path) as pgn_file:
+            while True:
+                game = chess.pgn.read_game(pgn_file)
+                if game is None:
+                    break
+                result = game.headers.get("Result", "*")
+                board = game.board()
+                for ply, move in enumerate(game.mainline_moves()):
+                    if ply >= max_plies:
+                        break
+                    key = (
+                        chess.polyglot.zobrist_hash(board),
+                        polyglot_move(board, move),
+                    )
+                    counts[key][0] += 1
+                    counts[key][1] += game_score(result, board.turn)
+                    board.push(move)
+
+    entries = [
+        (key, move, score)
+        for (key, move), (num_games, score) in counts.items()
+        if num_games >= min_games and score > 0
+    ]
+    entries.sort()
+    max_score = max((score for _, _, score in entries), default=0)
+    scale = min(1, MAX_WEIGHT / max_score) if max_score else 1
+    with open(book_path, "wb") as book_file:
+        for key, move, score in entries:
+            weight = max(1, int(score * scale))
+            book_file.write(ENTRY_STRUCT.pack(key, move, weight, 0))
+    return len(entries)
+
+
+class OpeningBook:
+    """
+    Polyglot opening book read from a file, which is memory-mapped the
+    first time it is needed. Lookups are thread-safe.
+
+    The attributes hits and misses count lookups since the book was
+    created.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_reader(self):
+        """
+        Return the `chess.polyglot.MemoryMappedReader` for the book,
+        opening it if needed.
+        """
+        if self.reader is None:
+            with self.lock:
+                if self.reader is None:
+                    self.reader = chess.polyglot.open_reader(self.path)
+        return self.reader
+
+    def lookup(self, board, rng=random):
+        """
+        Return a legal move from the book for the given python-chess
+        Board, chosen at random in proportion to the weights of the
+        moves, or None if the position is not in the book.
+        """
+        # Look up the entries by hash rather than by board, and only
+        # check that the chosen move is legal, which is much faster than
+        # checking every entry.
+        key = chess.polyglot.zobrist_hash(board)
+        entries = list(self.get_reader().find_all(key))
+        move = None
+        while entries:
+            weights = [entry.weight for entry in entries]
+            entry = rng.choices(entries, weights=weights)[0]
+            move = book_move_to_move(board, entry.move)
+            if board.is_legal(move):
+                break
+            # The position only has the same hash as one in the book.
+            entries.remove(entry)
+            move = None
+        with self.lock:
+            if move is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return move
+
+    def get_stats(self):
+        """
+        Return a dictionary with the counters of the book.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def with_opening_book(model, book=whales.util.UNSET):
+    """
+    Return a model that plays a move from the given OpeningBook when
+    the position is in it, and otherwise calls the given model. If no
+    book is given, use `BOOK`. If the book is None, return the model
+    unchanged.
+    """
+    if book is whales.util.UNSET:
+        book = BOOK
+    if book is None:
+        return model
+
+    def book_model(board, time_limit=None, cancel_token=None, stats=None):
+        move = book.lookup(board)
+        if move is not None:
+            return move
+        return model(
+            board, time_limit=time_limit, cancel_token=cancel_token, stats=stats
+        )
+
+    return book_model
+
+
+# Opening book used by models that opt in to one, or None if there is
+# none. The path of the book file can be set with the
+# WHALES_OPENING_BOOK environment variable.
+BOOK = None
+if os.environ.get("WHALES_OPENING_BOOK"):
+    BOOK = OpeningBook(os.environ["WHALES_OPENING_BOOK"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a Polyglot opening book from PGN files."
+    )
+    parser.add_argument("book", help="path to write the book to")
+    parser.add_argument("pgn", nargs="+", help="PGN files of games")
+    parser.add_argument("--max-plies", type=int, default=DEFAULT_MAX_PLIES)
+    parser.add_argument("--min-games", type=int, default=DEFAULT_MIN_GAMES)
+    args = parser.parse_args()
+    num_entries = build_book(
+        args.pgn, args.book, max_plies=args.max_plies, min_games=args.min_games
+    )
+    print("wrote {} entries to {}".format(num_entries, args.book))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Module containing pondering: thinking about the next move while the
+player is thinking about theirs. After a model replies, it guesses the
+player's most likely answer and, in the background, searches the
+position that answer would lead to. If the player does make that move,
+the model's next move is already known (or nearly so); if they make
+another, the background search is cancelled. Either way the model's
+transposition table or search tree has been warmed up by what it
+searched.
+
+Pondering uses CPU time that would otherwise go unused, so background
+searches are not started while other requests are running or waiting,
+and running ones stop as soon as any request (or item of a get_moves
+request) comes in, except the search that the request is for (see
+`Ponderer.claim`). Each background search also has a time limit.
+Pondering is off unless the WHALES_PONDER environment variable is set
+(see `PONDERER`).
+"""
+
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+import whales.cancellation as cancellation
+import whales.compute
+import whales.metrics
+import whales.util
+
+# Reasons for cancelling a background search, besides those of
+# `cancellation`.
+MISMATCH = "mismatch"
+LOAD = "load"
+
+# Default number of seconds that each background search may take.
+DEFAULT_PONDER_SECONDS = 10
+
+# Default number of background searches that are kept at once. Older
+# ones are cancelled to make room for new ones.
+DEFAULT_MAX_JOBS = 64
+
+# Number of seconds that the compute pools must have had requests in
+# them before a background search notices and stops itself. Requests
+# for models stop the searches straight away (see `Ponderer.claim`),
+# so this only has to give the player's request time to claim the
+# search for its position before the search stops itself.
+CLAIM_SECONDS = 0.1
+
+
+class PonderToken(cancellation.CancelToken):
+    """
+    CancelToken of a background search of the given Ponderer, which
+    also cancels itself for LOAD when it is checked after the compute
+    pools have had requests in them for CLAIM_SECONDS (see `busy`),
+    unless taken has been set because the player's request is for the
+    search.
+    """
+
+    def __init__(self, ponderer, deadline=None):
+        super().__init__(deadline=deadline)
+        self.ponderer = ponderer
+        self.taken = False
+        # Time since which the compute pools have had requests in
+        # them, or None if they were empty when last checked.
+        self.busy_since = None
+
+    @property
+    def cancelled(self):
+        if not self.taken and not self.event.is_set():
+            now = time.monotonic()
+            if not busy(in_request=False):
+                self.busy_since = None
+            elif self.busy_since is None:
+                self.busy_since = now
+            elif now - self.busy_since >= CLAIM_SECONDS and self.cancel(LOAD):
+                with self.ponderer.lock:
+                    self.ponderer.shed += 1
+        return super().cancelled
+
+
+class PonderJob:
+    """
+    Background search of a model for the position after the player's
+    most likely answer to one of its moves. The attributes are:
+
+    - token: PonderToken of the search
+    - guessed: `threading.Event` set once the answer has been guessed,
+      or the search was abandoned before it was
+    - reply: the answer that was guessed, or None until it has been
+    - stats: `collections.Counter` of the stats of the search
+    - future: `concurrent.futures.Future` for the move the model found,
+      or for None if the search was abandoned
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.guessed = threading.Event()
+        self.reply = None
+        self.stats = collections.Counter()
+        self.future = None
+
+
+class Ponderer:
+    """
+    Thread-safe manager of background searches, which runs them on an
+    executor with the given number of threads. Each search is given
+    ponder_seconds seconds, and at most max_jobs are kept at once.
+
+    The attributes started, hits, misses, partial and shed count
+    searches that were started, that guessed the player's move right,
+    that guessed it wrong, that guessed it right but couldn't be used
+    because they hadn't finished in time, and that were cancelled
+    because of load.
+    """
+
+    def __init__(
+        self,
+        workers=1,
+        ponder_seconds=DEFAULT_PONDER_SECONDS,
+        max_jobs=DEFAULT_MAX_JOBS,
+    ):
+        self.ponder_seconds = ponder_seconds
+        self.max_jobs = max_jobs
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ponder"
+        )
+        # Maps from (model, FEN) pairs, where the FEN is of the position
+        # after the model's move, to the PonderJob for the position the
+        # player's answer is guessed to lead to.
+        self.jobs = collections.OrderedDict()
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.partial = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def claim(self, board):
+        """
+        Called when a request for a move on the given board comes in.
+        Mark the background searches for the board's position as taken,
+        so that they carry on for the request, and cancel every other
+        search because of the load.
+        """
+        fen = None
+        if board.move_stack:
+            reply = board.pop()
+            fen = board.fen()
+            board.push(reply)
+        with self.lock:
+            for key, job in list(self.jobs.items()):
+                if key[1] == fen:
+                    job.token.taken = True
+                else:
+                    del self.jobs[key]
+                    if job.token.cancel(LOAD):
+                        self.shed += 1
+
+    def take(self, model, board, time_limit=None, cancel_token=None):
+        """
+        Return the move that the background search of the given model
+        found for the board, or None if there was none or it wasn't
+        complete (see the stats of `whales.models`). If the answer
+        hasn't been guessed yet, wait for the guess. If the search is
+        still running, wait for it to finish, for at most time_limit
+        seconds if that is given. If there was a search for another
+        answer to the model's last move, cancel it.
+
+        If the given CancelToken is cancelled while waiting, raise
+        `cancellation.Cancelled`.
+        """
+        if not board.move_stack:
+            return None
+        reply = board.pop()
+        key = (model, board.fen())
+        board.push(reply)
+        with self.lock:
+            job = self.jobs.pop(key, None)
+            if job is None:
+                return None
+            job.token.taken = True
+        try:
+            # Guessing is a single call to the neural net, so this
+            # doesn't take long.
+            while not job.guessed.wait(cancellation.POLL_SECONDS):
+                if cancel_token is not None:
+                    cancel_token.check()
+            move = None
+            if job.reply == reply:
+                with self.lock:
+                    self.hits += 1
+                move = cancellation.wait_for_future(
+                    job.future, cancel_token, timeout=time_limit
+                )
+            elif job.reply is not None:
+                with self.lock:
+                    self.misses += 1
+                job.token.cancel(MISMATCH)
+                return None
+        except concurrent.futures.TimeoutError:
+            job.token.cancel(cancellation.DEADLINE)
+        except cancellation.Cancelled:
+            job.token.cancel(MISMATCH)
+            raise
+        if job.reply is None:
+            # The search was abandoned before it guessed.
+            return None
+        if move is None or not job.stats.get("complete"):
+            with self.lock:
+                self.partial += 1
+            return None
+        return move
+
+    def start(self, model, board, move, reply_fn):
+        """
+        Start a background search of the given model for the position
+        after the given move on the board and the player's most likely
+        answer to it, as guessed by reply_fn (a model that is quick to
+        answer). The guess is made by the search, so as not to hold up
+        the request. Do nothing if other requests are waiting for the
+        CPU.
+        """
+        if busy():
+            return
+        board = board.copy()
+        board.push(move)
+        if board.is_game_over():
+            return
+        key = (model, board.fen())
+        token = PonderToken(self, deadline=time.monotonic() + 2 * self.ponder_seconds)
+        job = PonderJob(token)
+
+        def ponder():
+            try:
+                with cancellation.using_token(token):
+                    try:
+                        token.check()
+                        job.reply = reply_fn(board, cancel_token=token)
+                    finally:
+                        job.guessed.set()
+                    board.push(job.reply)
+                    if board.is_game_over():
+                        return None
+                    return model(
+                        board,
+                        time_limit=self.ponder_seconds,
+                        cancel_token=token,
+                        stats=job.stats,
+                    )
+            except cancellation.Cancelled:
+                return None
+
+        with self.lock:
+            old_job = self.jobs.pop(key, None)
+            if old_job is not None:
+                old_job.token.cancel(MISMATCH)
+            self.jobs[key] = job
+            while len(self.jobs) > self.max_jobs:
+                _, old_job = self.jobs.popitem(last=False)
+                if old_job.token.cancel(LOAD):
+                    self.shed += 1
+            job.future = self.executor.submit(ponder)
+            self.started += 1
+
+    def cancel_all(self, reason):
+        """
+        Cancel every background search for the given reason.
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.token.cancel(reason) and reason == LOAD:
+                    self.shed += 1
+            self.jobs.clear()
+
+    def get_stats(self):
+        """
+        Return a dictionary with the number of background searches kept,
+        the counters of the Ponderer, and the fraction of guesses that
+        were right (hit_rate, or None before the first).
+        """
+        with self.lock:
+            guesses = self.hits + self.misses
+            return {
+                "jobs": len(self.jobs),
+                "started": self.started,
+                "hits": self.hits,
+                "misses": self.misses,
+                "partial": self.partial,
+                "shed": self.shed,
+                "hit_rate": self.hits / guesses if guesses else None,
+            }
+
+
+def busy(in_request=True):
+    """
+    Return whether requests or items of get_moves requests are running
+    or waiting in the compute pool and the batch pool, so that
+    pondering would slow them down. If in_request is True, the caller
+    is running in one of those requests, which doesn't count. (A
+    get_moves item is in both pools, so pondering is never started for
+    one.)
+    """
+    requests = 0
+    for pool in (whales.compute.COMPUTE_POOL, whales.compute.BATCH_POOL):
+        stats = pool.get_stats()
+        requests += stats["running"] + stats["queued"]
+    return requests > (1 if in_request else 0)
+
+
+def with_pondering(model, reply_fn, ponderer=whales.util.UNSET):
+    """
+    Return a model that ponders with the given Ponderer after each
+    move of the given model: it guesses the player's answer with
+    reply_fn (a model that is quick to answer) and searches the position
+    after it in the background. When the player does make that answer
+    and the background search is complete, the move found is returned
+    instead of searching again. A time limit given to the model is
+    split between waiting for the background search and searching
+    again. If no Ponderer is given, use `PONDERER`. If the Ponderer is
+    None, return the model unchanged.
+    """
+    if ponderer is whales.util.UNSET:
+        ponderer = PONDERER
+    if ponderer is None:
+        return model
+
+    def pondering_model(board, time_limit=None, cancel_token=None, stats=None):
+        start = time.monotonic()
+        move = ponderer.take(
+            model,
+            board,
+            time_limit=None if time_limit is None else time_limit / 2,
+            cancel_token=cancel_token,
+        )
+        if move is None:
+            if time_limit is not None:
+                time_limit -= time.monotonic() - start
+            move = model(
+                board, time_limit=time_limit, cancel_token=cancel_token, stats=stats
+            )
+        ponderer.start(model, board, move, reply_fn)
+        return move
+
+    return pondering_model
+
+
+# Ponderer used by models that opt in to pondering, or None if
+# pondering is off. Pondering is turned on by setting the WHALES_PONDER
+# environment variable to anything but 0. The number of seconds each
+# background search may take can be set with WHALES_PONDER_SECONDS.
+PONDERER = None
+if os.environ.get("WHALES_PONDER") not in (None, "", "0"):
+    PONDERER = Ponderer(
+        ponder_seconds=float(
+            os.environ.get("WHALES_PONDER_SECONDS") or DEFAULT_PONDER_SECONDS
+        )
+    )
+    whales.metrics.METRICS.add_collector(
+        whales.metrics.stats_collector(
+            "ponder",
+            # Prometheus has no null, so leave out the hit rate until
+            # there is one.
+            lambda: {
+                key: value
+                for key, value in PONDERER.get_stats().items()
+                if value is not None
+            },
+            ["started", "hits", "misses", "partial", "shed"],
+        )
+    )
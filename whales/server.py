@@ -2,15 +2,20 @@
 Module that contains our Flask app.
 """
 
+import concurrent.futures
 import os
-import threading
+import select
+import socket
+import time
 
 import flask
 import flask.json
 import flask_talisman
 
 import whales.api
-import whales.util
+import whales.cancellation
+import whales.compute
+import whales.metrics
 
 app = flask.Flask(__name__, static_folder=None, template_folder="html")
 
@@ -20,33 +25,99 @@ if os.environ.get("WHALES_NO_SSL") in (None, "", "0"):
 analytics_enabled = bool(os.environ.get("WHALES_ANALYTICS"))
 
 
+def client_disconnected(sock):
+    """
+    Return whether the client has closed its end of the given socket,
+    which may be None if the WSGI server doesn't expose it, in which
+    case the answer is always no. Doesn't block or consume any data.
+    """
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A closed connection is readable, but has nothing to read.
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # The socket can't be peeked at, such as an SSL socket.
+        return False
+    except OSError:
+        return True
+
+
+def request_socket():
+    """
+    Return the client socket of the current request, if the WSGI server
+    exposes it (gunicorn and the Werkzeug development server do), or
+    None otherwise.
+    """
+    environ = flask.request.environ
+    return environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+
+
 def stream_json(ping_secs):
     """
     Wrap a view that returns a Python object so that the object is
     JSONified before being returned. If the view takes longer than
     ping_secs to compute its result, send a byte of whitespace to the
     client so the connection is kept alive by Heroku.
+
+    The view is run on `whales.compute.COMPUTE_POOL`. If the pool is
+    full, respond straight away with a 503 and an API error instead.
+
+    The view is passed a cancel_token keyword argument, a
+    `whales.cancellation.CancelToken` that is cancelled when the client
+    disconnects before the result is ready, or when the request runs
+    past its deadline (see `whales.cancellation.request_token`).
     """
 
     def decorator(orig_view):
         def new_view(*args, **kwargs):
+            token = whales.cancellation.request_token()
+            sock = request_socket()
+
+            @flask.copy_current_request_context
+            def handle():
+                return flask.json.dumps(orig_view(*args, cancel_token=token, **kwargs))
+
+            try:
+                future = whales.compute.COMPUTE_POOL.submit(handle)
+            except whales.compute.PoolFullError:
+                return flask.Response(
+                    flask.json.dumps(whales.api.error_response("server busy")),
+                    status=503,
+                    mimetype="application/json",
+                )
+
             def generate():
-                result = whales.util.UNSET
-                done = threading.Event()
-
-                @flask.copy_current_request_context
-                def handle():
-                    nonlocal result
-                    result = flask.json.dumps(orig_view(*args, **kwargs))
-                    done.set()
-
-                thread = threading.Thread(target=handle, daemon=True)
-                thread.start()
-                while True:
-                    if done.wait(timeout=ping_secs):
+                last_ping = time.monotonic()
+                try:
+                    while True:
+                        # Wake up regularly to notice the client going
+                        # away. The WSGI server closes this generator
+                        # if sending a ping fails, but that can take
+                        # several pings.
+                        try:
+                            result = future.result(
+                                timeout=whales.cancellation.POLL_SECONDS
+                            )
+                        except concurrent.futures.TimeoutError:
+                            if client_disconnected(sock):
+                                return
+                            if time.monotonic() - last_ping >= ping_secs:
+                                yield " "
+                                last_ping = time.monotonic()
+                            continue
                         yield result
                         break
-                    yield " "
+                finally:
+                    if not future.done():
+                        token.cancel(whales.cancellation.DISCONNECT)
+                        # Requests that never started are counted here,
+                        # and the rest by `whales.api.query`.
+                        if future.cancel():
+                            whales.metrics.METRICS.increment(
+                                "cancelled_requests", reason=token.reason
+                            )
 
             generator = flask.stream_with_context(generate())
             return flask.Response(generator, mimetype="application/json")
@@ -90,7 +161,7 @@ def http_endpoint_get():
 
 @app.route("/api/v1/http", methods=["POST"])
 @stream_json(20)
-def http_endpoint():
+def http_endpoint(cancel_token):
     """
     HTTP endpoint for API.
     """
@@ -98,12 +169,31 @@ def http_endpoint():
     print(request)
 
     if request is not None:
-        response = whales.api.query(request)
+        response = whales.api.query(request, cancel_token=cancel_token)
     else:
         response = whales.api.error_response("invalid or missing JSON")
     return response
 
 
+@app.route("/api/v1/status")
+def status_endpoint():
+    """
+    Report the load on the server (see `whales.api.status`).
+    """
+    return flask.jsonify(whales.api.status())
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Serve the metrics of the server in the Prometheus text format.
+    """
+    return flask.Response(
+        whales.metrics.METRICS.render_prometheus(),
+        content_type=whales.metrics.PROMETHEUS_CONTENT_TYPE,
+    )
+
+
 @app.route("/<path:path>")
 def static(path):
     """
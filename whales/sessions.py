@@ -0,0 +1,220 @@
+"""
+Module containing server-side game sessions. A session holds the live
+python-chess Board of one game against one model, so that a client can
+send just its latest move and get back just the model's reply, instead
+of sending the whole game as PGN every turn and having it parsed and
+rebuilt each time.
+
+Sessions are kept in memory by a `SessionStore`. Sessions that go unused
+for too long expire, and the least recently used sessions are dropped
+when the store grows past its memory cap. A client whose session has
+disappeared can always start a new one from the PGN of its game.
+"""
+
+import collections
+import os
+import secrets
+import threading
+import time
+
+import whales.metrics
+
+# Approximate number of bytes used by a session apart from its moves
+# (the Board, the session object, its ID and dictionary overhead), and
+# by each move in the game (the Move and the board state python-chess
+# keeps to take it back).
+SESSION_OVERHEAD_BYTES = 4096
+MOVE_BYTES = 512
+
+# Default number of seconds a session may go unused before it expires.
+DEFAULT_IDLE_SECONDS = 30 * 60
+
+# Default memory cap for a store, in bytes.
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+class NoSuchSessionError(Exception):
+    """
+    Exception raised when you try to use a session that doesn't exist,
+    or that has expired or been evicted.
+    """
+
+    pass
+
+
+class Session:
+    """
+    A game in progress against a model. The attributes are:
+
+    - session_id: string identifying the session to clients
+    - model_name: internal name of the model the game is against
+    - board: python-chess Board with the game so far
+    - state: dictionary for keeping data about the game between moves,
+      such as the results of searches
+    - lock: lock held by whoever is using the board, since a session
+      may get requests from several threads at once
+    - last_used: `time.monotonic` time at which it was last used
+    """
+
+    def __init__(self, session_id, model_name, board):
+        self.session_id = session_id
+        self.model_name = model_name
+        self.board = board
+        self.state = {}
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def nbytes(self):
+        """
+        Return the approximate number of bytes used by the session.
+        """
+        return SESSION_OVERHEAD_BYTES + MOVE_BYTES * len(self.board.move_stack)
+
+
+class SessionStore:
+    """
+    Bounded, thread-safe store of sessions by ID. Sessions expire once
+    they have gone unused for idle_seconds, and the least recently used
+    sessions are evicted whenever the sessions take up more than roughly
+    max_bytes bytes.
+
+    The attributes created, expired and evicted count what has happened
+    since the store was created.
+    """
+
+    def __init__(self, idle_seconds=DEFAULT_IDLE_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        # Map from session ID to Session, least recently used first,
+        # and the size of each session when it was last used.
+        self.sessions = collections.OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, model_name, board):
+        """
+        Create a new session for a game against the model with the given
+        internal name, starting from the given python-chess Board, and
+        return it.
+        """
+        session = Session(secrets.token_urlsafe(16), model_name, board)
+        with self.lock:
+            self.expire()
+            self.sessions[session.session_id] = session
+            self.sizes[session.session_id] = 0
+            self.created += 1
+            self.update_size(session)
+        return session
+
+    def get(self, session_id):
+        """
+        Return the session with the given ID and mark it as used. If
+        there is no such session, raise NoSuchSessionError.
+        """
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise NoSuchSessionError
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def touch(self, session):
+        """
+        Mark the given session as used and recompute its size, for
+        example after moves have been added to its board. Evict sessions
+        as needed to stay within the memory cap of the store.
+        """
+        with self.lock:
+            if session.session_id not in self.sessions:
+                return
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session.session_id)
+            self.update_size(session)
+
+    def delete(self, session_id):
+        """
+        Remove the session with the given ID. If there is no such
+        session, raise NoSuchSessionError.
+        """
+        with self.lock:
+            if session_id not in self.sessions:
+                raise NoSuchSessionError
+            self.remove(session_id)
+
+    def update_size(self, session):
+        """
+        Recompute the size of the given session, which must be in the
+        store, and evict least recently used sessions (other than that
+        one) until the store is within its memory cap. The lock must be
+        held.
+        """
+        nbytes = session.nbytes()
+        self.nbytes += nbytes - self.sizes[session.session_id]
+        self.sizes[session.session_id] = nbytes
+        while self.nbytes > self.max_bytes and len(self.sessions) > 1:
+            session_id = next(iter(self.sessions))
+            if session_id == session.session_id:
+                break
+            self.remove(session_id)
+            self.evicted += 1
+
+    def expire(self):
+        """
+        Remove every session that has gone unused for longer than the
+        idle time of the store. The lock must be held.
+        """
+        cutoff = time.monotonic() - self.idle_seconds
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.last_used >= cutoff:
+                break
+            self.remove(session_id)
+            self.expired += 1
+
+    def remove(self, session_id):
+        """
+        Remove the session with the given ID, which must be in the
+        store. The lock must be held.
+        """
+        del self.sessions[session_id]
+        self.nbytes -= self.sizes.pop(session_id)
+
+    def get_stats(self):
+        """
+        Return a dictionary with the counters of the store, its current
+        number of sessions and their approximate size in bytes.
+        """
+        with self.lock:
+            return {
+                "created": self.created,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "sessions": len(self.sessions),
+                "bytes": self.nbytes,
+            }
+
+
+# Store holding the sessions of every client of the server. The idle
+# time in seconds and the memory cap in megabytes can be set with the
+# WHALES_SESSION_IDLE_SECONDS and WHALES_SESSION_MEGABYTES environment
+# variables.
+SESSIONS = SessionStore(
+    idle_seconds=float(
+        os.environ.get("WHALES_SESSION_IDLE_SECONDS") or DEFAULT_IDLE_SECONDS
+    ),
+    max_bytes=int(os.environ.get("WHALES_SESSION_MEGABYTES") or 32) * 1024 * 1024,
+)
+whales.metrics.METRICS.add_collector(
+    whales.metrics.stats_collector(
+        "session_store", SESSIONS.get_stats, ["created", "expired", "evicted"]
+    )
+)
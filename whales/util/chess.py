@@ -2,11 +2,40 @@
 Module containing utility functions wrapping python-chess.
 """
 
+import collections
 import io
+import os
+import re
+import threading
 
 import chess.pgn
 import chess
 
+# Regular expression matching a plain mainline PGN like the ones sent
+# by the frontend: moves in SAN, each optionally preceded by a move
+# number ("12." or "12..."), separated by whitespace and optionally
+# followed by a result. Anything else, like headers, comments,
+# variations, annotations or run-together moves, doesn't match.
+PLAIN_PGN_REGEX = re.compile(
+    r"\s*(?:(?:[0-9]+\.(?:\.\.)?\s*)?"
+    r"(?:[KQRBN]?[a-h]?[1-8]?x?[a-h][1-8](?:=[QRBN])?|O-O(?:-O)?)[+#]?"
+    r"(?:\s+|$))*"
+    r"(?:(?:1-0|0-1|1/2-1/2|\*)\s*)?"
+)
+
+# Game results, as they appear in PGN.
+PGN_RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+
+# Regular expression matching the result at the end of a PGN string,
+# along with the whitespace around it.
+PGN_RESULT_SUFFIX_REGEX = re.compile(r"\s*(?:1-0|0-1|1/2-1/2|\*)?\s*$")
+
+# Number of moves back from the end of a game to look for a cached
+# board, when the board for the whole game isn't cached. A client
+# normally sends the game it was last sent plus its own move, which is
+# one move further than the cached board.
+MAX_CACHE_BACKTRACK = 4
+
 
 class InvalidPGNError(Exception):
     """
@@ -16,6 +45,14 @@ class InvalidPGNError(Exception):
     pass
 
 
+class InvalidMoveError(Exception):
+    """
+    Error raised when parsing a move that is malformed or illegal.
+    """
+
+    pass
+
+
 class SilentGameCreator(chess.pgn.GameBuilder):
     """
     Visitor for chess.pgn.read_game that raises InvalidPGNError on an
@@ -26,12 +63,129 @@ class SilentGameCreator(chess.pgn.GameBuilder):
         raise InvalidPGNError
 
 
+class BoardCache:
+    """
+    Bounded, thread-safe, least recently used cache of python-chess
+    Boards by the tuple of SAN moves that leads to them from the
+    starting position. Boards are copied on the way in and out, so
+    callers are free to change them.
+
+    The attributes hits and misses count lookups since the cache was
+    created.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.boards = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.boards)
+
+    def get_longest_prefix(self, moves, max_backtrack):
+        """
+        Find the longest prefix of the given tuple of SAN moves, no more
+        than max_backtrack moves shorter than the whole tuple, whose
+        board is cached. Return a tuple of a copy of that board and the
+        length of the prefix, or (None, 0) if there is none. Count a hit
+        or a miss.
+        """
+        with self.lock:
+            shortest = max(len(moves) - max_backtrack, 0)
+            for length in range(len(moves), shortest - 1, -1):
+                board = self.boards.get(moves[:length])
+                if board is not None:
+                    self.hits += 1
+                    self.boards.move_to_end(moves[:length])
+                    break
+            else:
+                self.misses += 1
+                return None, 0
+        return board.copy(), length
+
+    def put(self, moves, board):
+        """
+        Store a copy of the board for the given tuple of SAN moves,
+        evicting the least recently used board if the cache is full.
+        """
+        if self.max_entries <= 0:
+            return
+        board = board.copy()
+        with self.lock:
+            self.boards[moves] = board
+            self.boards.move_to_end(moves)
+            while len(self.boards) > self.max_entries:
+                self.boards.popitem(last=False)
+
+    def get_stats(self):
+        """
+        Return a dictionary with the counters of the cache and its
+        current number of entries.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+
+# Cache of the boards of games recently returned by
+# `append_move_to_pgn`, shared by every request.
+# The number of boards kept can be set with the WHALES_PGN_CACHE_SIZE
+# environment variable.
+BOARD_CACHE = BoardCache(int(os.environ.get("WHALES_PGN_CACHE_SIZE") or 1024))
+
+
+def tokenize_plain_pgn(pgn):
+    """
+    If the PGN string is a plain mainline (see `PLAIN_PGN_REGEX`),
+    return a tuple of its moves in SAN. Otherwise return None.
+    """
+    if PLAIN_PGN_REGEX.fullmatch(pgn) is None:
+        return None
+    # Split move numbers off the moves they are written against, and
+    # then drop them along with the result.
+    return tuple(
+        token
+        for token in pgn.replace(".", ". ").split()
+        if not token.endswith(".") and token not in PGN_RESULTS
+    )
+
+
+def plain_pgn_to_board(moves):
+    """
+    Convert a tuple of moves in SAN, as returned by
+    `tokenize_plain_pgn`, into a python-chess Board, replaying only the
+    moves after the longest recently seen prefix of the game (see
+    `BOARD_CACHE`). Return None if any move is illegal.
+    """
+    board, start = BOARD_CACHE.get_longest_prefix(moves, MAX_CACHE_BACKTRACK)
+    if board is None:
+        board = chess.Board()
+    try:
+        for san in moves[start:]:
+            board.push_san(san)
+    except ValueError:
+        return None
+    return board
+
+
 def pgn_to_board(pgn):
     """
     Convert a PGN string into a python-chess Board object.
 
     Interpret an empty PGN string as a game with no moves.
+
+    Plain mainline PGN (like the frontend sends) is replayed directly,
+    starting from the board of a game recently returned by
+    `append_move_to_pgn` where possible. Anything else, including PGN
+    with illegal moves, is parsed in full by python-chess, and raises
+    InvalidPGNError if that fails.
     """
+    moves = tokenize_plain_pgn(pgn)
+    if moves is not None:
+        board = plain_pgn_to_board(moves)
+        if board is not None:
+            return board
     if not pgn:
         pgn = "-"
     game = chess.pgn.read_game(io.StringIO(pgn), Visitor=SilentGameCreator)
@@ -45,3 +199,47 @@ def board_to_pgn(board):
     game = chess.pgn.Game.from_board(board)
     game.headers.clear()
     return str(game)
+
+
+def append_move_to_pgn(pgn, board, move):
+    """
+    Given a PGN string, the python-chess Board it was converted into by
+    `pgn_to_board`, and a legal move on that board, make the move on the
+    board and return a PGN string for the game with the move added.
+
+    For plain mainline PGN, the move is appended to the given string
+    (after removing its result) rather than converting the whole game
+    back into PGN, and the new board is cached for the next request.
+    Otherwise the result is the same as `board_to_pgn`.
+    """
+    moves = tokenize_plain_pgn(pgn)
+    if moves is None or len(moves) != len(board.move_stack):
+        board.push(move)
+        return board_to_pgn(board)
+    san = board.san(move)
+    if board.turn == chess.WHITE:
+        text = "{}. {}".format(board.fullmove_number, san)
+    else:
+        text = san
+    board.push(move)
+    BOARD_CACHE.put(moves + (san,), board)
+    prefix = PGN_RESULT_SUFFIX_REGEX.sub("", pgn)
+    if prefix:
+        text = prefix + " " + text
+    return text + " *"
+
+
+def uci_to_move(board, uci):
+    """
+    Convert a move in UCI format (like "e2e4", or "e7e8q" for a
+    promotion) into a python-chess Move object, checking that it is
+    legal on the given python-chess Board. Raise InvalidMoveError if it
+    is malformed or illegal.
+    """
+    try:
+        move = chess.Move.from_uci(uci)
+    except ValueError:
+        raise InvalidMoveError
+    if not board.is_legal(move):
+        raise InvalidMoveError
+    return move